@@ -1,12 +1,14 @@
 import asyncio
+import services.recorder
+import services.results
 import services.send_message_queue
 import logging
 import os
 import sounddevice as sd
 import threading
-import numpy as np
-from scipy.io import wavfile
+import queue
 import datetime
+import uuid
 
 # Introducing logging to detect exceptions
 logging.basicConfig(level=logging.INFO)
@@ -24,6 +26,12 @@ elif os.name == "mac":
     # sd.default.device = "Built-in Microphone"
 
 is_recording = False
+# Meetings are recorded to files of this many seconds, which are uploaded one at a time, so a long meeting never has to
+# fit in memory. None to record a single file.
+RECORDING_SEGMENT_SECONDS = 15 * 60
+# Seconds of a live meeting that may wait to be sent while the network or the server is slow. Blocks beyond that are
+# left out of the stream (the local recording still has them), and the whole recording is sent afterwards instead.
+STREAM_QUEUE_SECONDS = 30
 
 
 def read_audio_file(path: str) -> bytes:
@@ -40,15 +48,111 @@ def read_audio_file(path: str) -> bytes:
 
 
 # The system is trained with recordings sampled at 16kHz (single channel)
-def record_audio(filename, fs=16000, channels=1):
+def record_audio(filename, fs=16000, channels=1, segment_seconds=None, files=None):
+    """
+    Records audio until stop_recording, straight to disk (see services.recorder.WavRecorder)
+    :param segment_seconds: Split the recording into files of this many seconds, see RECORDING_SEGMENT_SECONDS
+    :param files: List that the recorded files are appended to, since this runs in its own thread
+    """
     global is_recording
     is_recording = True
-    with sd.InputStream(samplerate=fs, channels=channels) as stream:
-        audio_data = []
+    with services.recorder.WavRecorder(filename, fs, channels, segment_seconds=segment_seconds,
+                                       on_segment=files.append if files is not None else None) as recorder, \
+            sd.InputStream(samplerate=fs, channels=channels) as stream:
         while is_recording:
             data, overflowed = stream.read(fs)
-            audio_data.append(data)
-        wavfile.write(filename, fs, np.concatenate(audio_data, axis=0))
+            if overflowed:
+                logging.warning("The audio input overflowed, part of the recording was lost")
+            recorder.write(data)
+
+
+def stream_audio(filename, fs=16000, channels=1):
+    """
+    Records audio like record_audio, but also streams every block to the server while recording, so the meeting is
+    transcribed live. Runs its own event loop, since it runs in the recording thread.
+    """
+    asyncio.run(stream_audio_blocks(filename, fs, channels))
+
+
+async def stream_audio_blocks(filename, fs=16000, channels=1):
+    global is_recording
+    session_id = str(uuid.uuid4())
+    files = []
+    # This runs in its own thread and event loop, so it needs its own sender
+    message_sender = services.send_message_queue.MessageSender()
+    # The blocks that are waiting to be sent, one second each
+    blocks = queue.Queue(maxsize=STREAM_QUEUE_SECONDS)
+    dropped_blocks = []
+
+    def read_microphone():
+        # The microphone is read in its own thread, so waiting for the server never makes the input overflow. Keep a
+        # local copy of the recording as well.
+        with services.recorder.WavRecorder(filename, fs, channels, segment_seconds=RECORDING_SEGMENT_SECONDS,
+                                           on_segment=files.append) as recorder, \
+                sd.InputStream(samplerate=fs, channels=channels) as stream:
+            while is_recording:
+                data, overflowed = stream.read(fs)
+                if overflowed:
+                    logging.warning("The audio input overflowed, part of the recording was lost")
+                recorder.write(data)
+                try:
+                    blocks.put_nowait(data.tobytes())
+                except queue.Full:
+                    if not dropped_blocks:
+                        logging.warning("The stream can't keep up, the recording will be sent when it is done")
+                    dropped_blocks.append(len(data))
+
+    async def read_blocks():
+        while True:
+            try:
+                yield await asyncio.to_thread(blocks.get, timeout=0.5)
+            except queue.Empty:
+                # Everything is sent once the microphone thread is done and the queue is empty
+                if not microphone_thread.is_alive() and blocks.empty():
+                    return
+
+    is_recording = True
+    microphone_thread = threading.Thread(target=read_microphone)
+    microphone_thread.start()
+    success = await services.send_message_queue.send_audio_stream_to_server(read_blocks(), session_id,
+                                                                            sample_rate=fs,
+                                                                            message_sender=message_sender)
+    # The stream may have stopped early because of an error, the recording goes on until it is stopped
+    await asyncio.to_thread(microphone_thread.join)
+    success = success and not dropped_blocks
+    print(f"Streaming finished, success: {success}, job id: {session_id}")
+
+    # If some of the stream was lost, send the whole recording instead (it is spooled if the server is down)
+    if files and not success:
+        print("Sending the whole recording, since the stream was incomplete...")
+        job_ids = await submit_recording(files, "meeting", message_sender=message_sender)
+        print_job_ids(job_ids)
+    message_sender.close()
+
+
+async def submit_recording(files, processing_type, speaker=None, message_sender=None) -> list:
+    """
+    Sends a recording to the server, one file at a time
+    :param files: The files of the recording, see record_audio
+    :return: The job id of every file, None for the files that were not acknowledged
+    """
+    job_ids = []
+    for i, file in enumerate(files):
+        if len(files) > 1:
+            print(f"Sending part {i + 1} of {len(files)}...")
+        job_ids.append(await services.send_message_queue.send_audio_clip_to_server(read_audio_file(file),
+                                                                                   processing_type=processing_type,
+                                                                                   speaker=speaker,
+                                                                                   message_sender=message_sender))
+    return job_ids
+
+
+def print_job_ids(job_ids):
+    for job_id in job_ids:
+        if job_id:
+            print(f"Submitted, job id: {job_id}")
+        else:
+            print("The server did not acknowledge the recording, see above")
 
 
 async def stop_recording():
@@ -69,12 +173,17 @@ async def stop_recording():
 
 
 async def main() -> None:
+    # Send the recordings that could not be delivered earlier, whenever the server is reachable
+    services.send_message_queue.start_spool_drainer()
+
     while True:
         print("What do you want to do?")
         print("1. Enroll a speaker")
         print("2. Process an audio clip")
         print("3. Record a new audio clip")
-        print("4. Exit")
+        print("4. Stream a live meeting")
+        print("5. Get the transcript of a job")
+        print("6. Exit")
 
         choice = input("Enter your choice: ")
         try:
@@ -98,17 +207,17 @@ async def main() -> None:
                 submit = input("Do you want to submit the recording? (Y/n): ")
                 if not submit.lower().startswith("n"):
                     audio_clip = read_audio_file(filename)
-                    success = await services.send_message_queue.send_audio_clip_to_server(audio_clip,
-                                                                                          processing_type="enroll",
-                                                                                          speaker=speaker_name)
-                    print(f"Success: {success}")
+                    job_id = await services.send_message_queue.send_audio_clip_to_server(audio_clip,
+                                                                                         processing_type="enroll",
+                                                                                         speaker=speaker_name)
+                    print_job_ids([job_id])
                 else:
                     print("Recording discarded.")
             elif choice == "2":
                 audio_file = input("Enter path to audio file (wav): ").strip()
                 audio_clip = read_audio_file(audio_file)
-                success = await services.send_message_queue.send_audio_clip_to_server(audio_clip)
-                print(f"Success: {success}")
+                job_id = await services.send_message_queue.send_audio_clip_to_server(audio_clip)
+                print_job_ids([job_id])
             elif choice == "3":
                 # Check if recordings directory exists, if not, create it
                 if not os.path.exists("recordings"):
@@ -117,7 +226,10 @@ async def main() -> None:
                 # Make filename from current time
                 filename = f"recordings/meeting-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.wav"
 
-                recording_thread = threading.Thread(target=record_audio, args=(filename,))
+                files = []
+                recording_thread = threading.Thread(target=record_audio, args=(filename,),
+                                                    kwargs={"segment_seconds": RECORDING_SEGMENT_SECONDS,
+                                                            "files": files})
                 input("Press Enter to start recording...")
                 recording_thread.start()
                 await stop_recording()
@@ -126,13 +238,30 @@ async def main() -> None:
 
                 submit = input("Do you want to submit the recording? (Y/n): ")
                 if not submit.lower().startswith("n"):
-                    audio_clip = read_audio_file(filename)
-                    success = await services.send_message_queue.send_audio_clip_to_server(audio_clip,
-                                                                                          processing_type="meeting")
-                    print(f"Success: {success}")
+                    print_job_ids(await submit_recording(files, "meeting"))
                 else:
                     print("Recording discarded.")
             elif choice == "4":
+                # Check if recordings directory exists, if not, create it
+                if not os.path.exists("recordings"):
+                    os.mkdir("recordings")
+
+                # Make filename from current time
+                filename = f"recordings/stream-{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.wav"
+
+                recording_thread = threading.Thread(target=stream_audio, args=(filename,))
+                input("Press Enter to start streaming...")
+                recording_thread.start()
+                await stop_recording()
+                recording_thread.join()
+                print("Streaming stopped.")
+            elif choice == "5":
+                job_id = input("Enter the job id: ").strip()
+                print("Waiting for the job to finish...")
+                job = await services.results.wait_for_result(job_id)
+                if job:
+                    print(services.results.format_result(job))
+            elif choice == "6":
                 print("Exiting...")
                 exit(0)
         except Exception as e:
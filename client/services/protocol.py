@@ -0,0 +1,61 @@
+import io
+import json
+import uuid
+import wave
+
+try:
+    import soundfile
+except ImportError:
+    # Optional, without it audio is sent uncompressed
+    soundfile = None
+
+# Must match the PROTOCOL_VERSION of the server
+PROTOCOL_VERSION = 1
+
+
+def build_message(message_type, audio, speaker=None, sample_rate=16000, codec="wav", job_id=None, sequence=None):
+    """
+    Builds a multipart message for the server: a JSON header frame and an audio frame
+    :param message_type: meeting, enroll, stream or stream-end
+    :param audio: The audio bytes, a WAV or FLAC file, or raw 16-bit PCM for streams
+    :param speaker: The name of the speaker, for enroll
+    :param sample_rate: The sample rate of the audio
+    :param codec: wav, flac or pcm
+    :param job_id: The id of the job (or stream session), a new one is made if not given
+    :param sequence: The sequence number of the chunk, for streams
+    :return: The list of frames to send
+    """
+    header = {
+        "version": PROTOCOL_VERSION,
+        "type": message_type,
+        "speaker": speaker,
+        "sample_rate": sample_rate,
+        "codec": codec,
+        "job_id": job_id if job_id else str(uuid.uuid4())
+    }
+    if sequence is not None:
+        header["sequence"] = sequence
+    return [json.dumps(header).encode("utf-8"), audio]
+
+
+def compress_wav(audio_clip: bytes):
+    """
+    Compresses a WAV file losslessly with FLAC, if soundfile is installed
+    :param audio_clip: The bytes of the WAV file
+    :return: Tuple of the audio bytes, the codec and the sample rate
+    """
+    if soundfile is None:
+        return audio_clip, "wav", read_wav_sample_rate(audio_clip)
+
+    data, sample_rate = soundfile.read(io.BytesIO(audio_clip), dtype="int16")
+    compressed = io.BytesIO()
+    soundfile.write(compressed, data, sample_rate, format="FLAC")
+    return compressed.getvalue(), "flac", sample_rate
+
+
+def read_wav_sample_rate(audio_clip: bytes) -> int:
+    try:
+        with wave.open(io.BytesIO(audio_clip), "rb") as wave_file:
+            return wave_file.getframerate()
+    except (wave.Error, EOFError):
+        return 16000
@@ -0,0 +1,180 @@
+import os
+import struct
+import threading
+from typing import Callable, Optional
+import numpy as np
+
+# Seconds of audio the ring buffer holds between the recording thread and the writer thread, so a slow SD card doesn't
+# make the recording drop audio
+RING_BUFFER_SECONDS = 10
+# Seconds of audio between updating the WAV header, so a crash leaves a playable file with all but the last few seconds
+HEADER_PATCH_SECONDS = 5
+# 16-bit PCM, as recorded with sd.default.dtype = "int16"
+SAMPLE_WIDTH = 2
+
+
+def build_wav_header(data_bytes: int, sample_rate: int, channels: int) -> bytes:
+    """
+    Builds the 44-byte header of a 16-bit PCM WAV file
+    :param data_bytes: The number of bytes of audio after the header
+    :param sample_rate: The sample rate of the audio
+    :param channels: The number of channels of the audio
+    :return: The header
+    """
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_bytes, b"WAVE", b"fmt ", 16, 1, channels, sample_rate,
+                       sample_rate * channels * SAMPLE_WIDTH, channels * SAMPLE_WIDTH, SAMPLE_WIDTH * 8, b"data",
+                       data_bytes)
+
+
+class WavRecorder:
+    """
+    Writes a recording to disk while it is being recorded, so memory use stays the same however long the meeting is.
+    The recording thread copies every block into a ring buffer (see write), and a writer thread appends the ring buffer
+    to the WAV file. The sizes in the WAV header are patched every HEADER_PATCH_SECONDS and when the file is closed.
+
+    With segment_seconds, the recording is split into files of that length (name-001.wav, name-002.wav, ...), such that
+    a long meeting can be uploaded in pieces. on_segment is called from the writer thread with the path of every file
+    once it is complete.
+    """
+
+    def __init__(self, filename: str, sample_rate=16000, channels=1, segment_seconds: Optional[int] = None,
+                 on_segment: Optional[Callable[[str], None]] = None, buffer_seconds=RING_BUFFER_SECONDS):
+        self.filename = filename
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.on_segment = on_segment
+        # Samples (of all channels) per file, None for a single file
+        self.segment_samples = segment_seconds * sample_rate * channels if segment_seconds else None
+        self.patch_samples = HEADER_PATCH_SECONDS * sample_rate * channels
+
+        self.ring = np.zeros(buffer_seconds * sample_rate * channels, dtype=np.int16)
+        # Total number of samples put into the ring buffer, and taken out of it by the writer thread. Their difference
+        # is the number of samples in the ring buffer.
+        self.write_position = 0
+        self.read_position = 0
+        self.condition = threading.Condition()
+        self.closed = False
+        # An error of the writer thread, raised in the recording thread
+        self.error: Optional[Exception] = None
+
+        # The completed files, in order
+        self.files: list[str] = []
+        self.file = None
+        self.file_path: Optional[str] = None
+        self.file_samples = 0
+        self.unpatched_samples = 0
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, block: np.ndarray):
+        """
+        Adds a block of audio to the recording, waits if the writer thread is too far behind
+        :param block: The int16 samples, with shape (frames, channels) as recorded by sounddevice
+        :return:
+        """
+        samples = np.ascontiguousarray(block, dtype=np.int16).reshape(-1)
+        offset = 0
+        while offset < len(samples):
+            with self.condition:
+                while self.write_position - self.read_position == len(self.ring) and self.error is None:
+                    self.condition.wait()
+                if self.error is not None:
+                    raise self.error
+
+                # Up to the free space, and up to the end of the ring buffer, the rest goes to the start next time
+                start = self.write_position % len(self.ring)
+                free = len(self.ring) - (self.write_position - self.read_position)
+                count = min(free, len(samples) - offset, len(self.ring) - start)
+                self.ring[start:start + count] = samples[offset:offset + count]
+                self.write_position += count
+                offset += count
+                self.condition.notify_all()
+
+    def close(self) -> list[str]:
+        """
+        Writes the rest of the ring buffer, patches the WAV header and stops the writer thread
+        :return: The recorded files, in order
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.files
+
+    def run(self):
+        try:
+            while True:
+                with self.condition:
+                    while self.write_position == self.read_position and not self.closed:
+                        self.condition.wait()
+                    if self.write_position == self.read_position:
+                        # Closed, and everything is written
+                        break
+                    start = self.read_position % len(self.ring)
+                    count = min(self.write_position - self.read_position, len(self.ring) - start)
+
+                # The recording thread doesn't touch these samples until read_position moves past them
+                self.write_samples(self.ring[start:start + count])
+                with self.condition:
+                    self.read_position += count
+                    self.condition.notify_all()
+            self.close_file()
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+
+    def write_samples(self, samples: np.ndarray):
+        while len(samples):
+            if self.file is None:
+                self.open_file()
+
+            count = len(samples)
+            if self.segment_samples:
+                count = min(count, self.segment_samples - self.file_samples)
+            self.file.write(samples[:count].tobytes())
+            self.file_samples += count
+            self.unpatched_samples += count
+            samples = samples[count:]
+
+            if self.segment_samples and self.file_samples >= self.segment_samples:
+                self.close_file()
+            elif self.unpatched_samples >= self.patch_samples:
+                self.patch_header()
+
+    def open_file(self):
+        if self.segment_samples:
+            name, extension = os.path.splitext(self.filename)
+            self.file_path = f"{name}-{len(self.files) + 1:03d}{extension}"
+        else:
+            self.file_path = self.filename
+        self.file = open(self.file_path, "wb")
+        self.file.write(build_wav_header(0, self.sample_rate, self.channels))
+        self.file_samples = 0
+        self.unpatched_samples = 0
+
+    def patch_header(self):
+        self.file.seek(0)
+        self.file.write(build_wav_header(self.file_samples * SAMPLE_WIDTH, self.sample_rate, self.channels))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+        self.unpatched_samples = 0
+
+    def close_file(self):
+        if self.file is None:
+            return
+        self.patch_header()
+        self.file.close()
+        self.file = None
+        self.files.append(self.file_path)
+        if self.on_segment:
+            self.on_segment(self.file_path)
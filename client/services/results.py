@@ -0,0 +1,65 @@
+import json
+import time
+from typing import Optional
+import zmq
+import zmq.asyncio
+from .send_message_queue import MessageSender, get_sender
+
+# The server publishes every job that is done here, with the job id as topic
+SERVER_RESULT_PORT = "5558"
+# Seconds to wait for a job to finish
+RESULT_TIMEOUT = 60 * 60
+
+
+async def wait_for_result(job_id: str, timeout=RESULT_TIMEOUT, message_sender: Optional[MessageSender] = None) \
+        -> Optional[dict]:
+    """
+    Waits until the server is done with a job, without polling: we subscribe to the job, and fetch it once in case it
+    was done before the subscription
+    :param job_id: The id of the job, as returned by send_audio_clip_to_server
+    :param timeout: Seconds to wait
+    :param message_sender: The sender to fetch the job with
+    :return: The job with its status (done or failed), text and speaker runs, or None if it didn't finish in time
+    """
+    message_sender = message_sender or get_sender()
+    socket = message_sender.context.socket(zmq.SUB)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.SUBSCRIBE, job_id.encode("utf-8"))
+    socket.connect(f"tcp://{message_sender.server_ip}:{SERVER_RESULT_PORT}")
+
+    try:
+        job = await message_sender.fetch_result(job_id)
+        if job is not None and job["status"] in ("done", "failed"):
+            return job
+        if job is None:
+            print(f"The server doesn't know job {job_id} yet, waiting for it anyway...")
+        else:
+            print(f"Job {job_id} is {job['status']}, waiting for it to finish...")
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await socket.poll(remaining * 1000):
+                print(f"Job {job_id} did not finish within {timeout} seconds")
+                return None
+            topic, result = await socket.recv_multipart()
+            # Subscriptions match on prefix, so make sure it's our job
+            if topic.decode("utf-8") == job_id:
+                return json.loads(result)
+    finally:
+        socket.close()
+
+
+def format_result(job: dict) -> str:
+    """
+    Formats a job for printing
+    :param job: The job, see wait_for_result
+    :return: The status of the job, and its transcript
+    """
+    if job["status"] == "failed":
+        return f"Job {job['job_id']} failed: {job['error']}"
+    if job["type"] == "enroll":
+        return f"Enrolled speaker {job['speaker']}"
+    lines = [f"[{time.strftime('%H:%M:%S', time.gmtime(run['start']))}] [{run['speaker'] or 'Unknown Speaker'}] "
+             f"{run['text']}" for run in job["runs"]]
+    return "\n".join(lines) if lines else "(no speech)"
@@ -1,31 +1,302 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from typing import Optional
 import zmq
 import zmq.asyncio
+from . import protocol
 
 SERVER_IP = "dtu-server.duckdns.org"
-SERVER_PORT = "5555"
+# The port where the server acknowledges every message (the server still accepts unacknowledged pushes on 5555)
+SERVER_PORT = "5556"
 
+# Seconds to wait for the server to acknowledge a message
+ACK_TIMEOUT = 30
+# Seconds to wait for the server to acknowledge a chunk of a live meeting
+STREAM_ACK_TIMEOUT = 5
+# Number of times to send a message before giving up and spooling it
+MAX_RETRIES = 4
+# Seconds to wait before the first retry, doubled after every retry up to MAX_RETRY_BACKOFF
+RETRY_BACKOFF = 1
+MAX_RETRY_BACKOFF = 30
+# Messages that could not be delivered are kept here, and sent again when the server is reachable
+SPOOL_DIRECTORY = "spool"
+# Seconds between attempts to send the spooled messages
+SPOOL_DRAIN_INTERVAL = 60
+# Seconds to wait for the server to reply to a fetch of a result
+FETCH_TIMEOUT = 10
 
-async def send_audio_clip_to_server(audio_clip, processing_type="meeting", speaker=None):
+
+class MessageSender:
+    """
+    A long-lived connection to the server, which reuses one context and socket for all messages. Every message is
+    acknowledged by the server, and messages that are not acknowledged are retried with backoff and finally spooled to
+    disk, see drain_spool.
+
+    The sender belongs to the event loop (and thread) that uses it, make a new one for every thread.
+    """
+
+    def __init__(self, server_ip=SERVER_IP, server_port=SERVER_PORT, spool_directory=SPOOL_DIRECTORY):
+        self.server_ip = server_ip
+        self.address = f"tcp://{server_ip}:{server_port}"
+        self.spool_directory = spool_directory
+        self.context = zmq.asyncio.Context()
+        self.socket: Optional[zmq.asyncio.Socket] = None
+
+    def connect(self) -> zmq.asyncio.Socket:
+        if self.socket is None:
+            print(f"Connecting to server at {self.address}")
+            self.socket = self.context.socket(zmq.DEALER)
+            # Don't keep unsent messages around when the socket is closed, we resend or spool them ourselves
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.connect(self.address)
+        return self.socket
+
+    def reset(self):
+        """
+        Closes the socket, such that the next attempt starts on a fresh connection instead of one that may be stuck
+        :return:
+        """
+        if self.socket is not None:
+            self.socket.close(linger=0)
+            self.socket = None
+
+    def close(self):
+        self.reset()
+        self.context.term()
+
+    async def send(self, frames: list, timeout=ACK_TIMEOUT) -> Optional[dict]:
+        """
+        Sends a message once and waits for the server to acknowledge it
+        :param frames: The frames of the message, see protocol.build_message
+        :param timeout: Seconds to wait for the acknowledgement
+        :return: The acknowledgement, or None if there was none in time
+        """
+        header = json.loads(frames[0])
+        socket = self.connect()
+        await socket.send_multipart(frames, copy=False)
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not await socket.poll(remaining * 1000):
+                self.reset()
+                return None
+
+            acknowledgement = json.loads(await socket.recv())
+            if acknowledgement.get("job_id") == header["job_id"] and \
+                    acknowledgement.get("sequence") == header.get("sequence"):
+                return acknowledgement
+            # Otherwise it's a late acknowledgement of a message we already gave up on, keep waiting
+
+    async def deliver(self, frames: list, retries=MAX_RETRIES, timeout=ACK_TIMEOUT) -> Optional[dict]:
+        """
+        Sends a message until the server acknowledges it, waiting longer between every attempt
+        :param frames: The frames of the message
+        :param retries: The max number of attempts
+        :param timeout: Seconds to wait for the acknowledgement of each attempt
+        :return: The acknowledgement, or None if the server didn't acknowledge any attempt
+        """
+        backoff = RETRY_BACKOFF
+        for attempt in range(retries):
+            try:
+                acknowledgement = await self.send(frames, timeout)
+                if acknowledgement is not None:
+                    return acknowledgement
+                print(f"No acknowledgement from the server after {timeout} seconds")
+            except zmq.ZMQError as e:
+                print(f"An error occurred while sending the message: {e}")
+                self.reset()
+
+            if attempt < retries - 1:
+                print(f"Retrying in {backoff} seconds... (attempt {attempt + 2}/{retries})")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MAX_RETRY_BACKOFF)
+        return None
+
+    async def send_reliably(self, frames: list) -> Optional[str]:
+        """
+        Delivers a message, and spools it to disk if it could not be delivered
+        :param frames: The frames of the message
+        :return: The job id if the server acknowledged the message, which the result can be fetched with (see
+            fetch_result), otherwise None
+        """
+        acknowledgement = await self.deliver(frames)
+        if acknowledgement is None:
+            self.spool(frames)
+            return None
+        if acknowledgement.get("error"):
+            print(f"The server rejected the message: {acknowledgement['error']}")
+            return None
+        return acknowledgement["job_id"]
+
+    async def fetch_result(self, job_id: str) -> Optional[dict]:
+        """
+        Asks the server for the result of a job
+        :param job_id: The id of the job, as returned by send_reliably
+        :return: The job with its status (queued, running, done or failed), text and speaker runs, or None if the
+            server doesn't know the job or could not be reached
+        """
+        acknowledgement = await self.deliver(protocol.build_message("fetch", b'', job_id=job_id), retries=2,
+                                             timeout=FETCH_TIMEOUT)
+        if acknowledgement is None:
+            print(f"Could not reach the server to fetch job {job_id}")
+            return None
+        if acknowledgement.get("error"):
+            print(f"The server rejected the fetch of job {job_id}: {acknowledgement['error']}")
+            return None
+        return acknowledgement.get("result")
+
+    def spool(self, frames: list):
+        """
+        Saves a message to the spool directory, such that it can be sent when the server is reachable again
+        :param frames: The frames of the message
+        :return:
+        """
+        os.makedirs(self.spool_directory, exist_ok=True)
+        job_id = json.loads(frames[0])["job_id"]
+        audio_file = os.path.join(self.spool_directory, f"{job_id}.audio")
+        header_file = os.path.join(self.spool_directory, f"{job_id}.json")
+
+        with open(audio_file, "wb") as f:
+            f.write(frames[1])
+        # Write the header last and rename it into place, so a message is only in the spool once it is complete
+        with open(f"{header_file}.tmp", "wb") as f:
+            f.write(frames[0])
+        os.replace(f"{header_file}.tmp", header_file)
+        print(f"Could not reach the server, saved job {job_id} to {self.spool_directory} to send it later")
+
+    async def drain_spool(self) -> int:
+        """
+        Sends the spooled messages, oldest first, and stops at the first one the server doesn't acknowledge
+        :return: The number of messages that were sent
+        """
+        if not os.path.exists(self.spool_directory):
+            return 0
+
+        header_files = [os.path.join(self.spool_directory, name) for name in os.listdir(self.spool_directory)
+                        if name.endswith(".json")]
+        header_files.sort(key=os.path.getmtime)
+
+        sent = 0
+        for header_file in header_files:
+            audio_file = header_file[:-len(".json")] + ".audio"
+            with open(header_file, "rb") as f:
+                header = f.read()
+            with open(audio_file, "rb") as f:
+                audio = f.read()
+
+            acknowledgement = await self.deliver([header, audio], retries=1)
+            if acknowledgement is None:
+                # Still offline, try again later
+                break
+            if acknowledgement.get("error"):
+                print(f"The server rejected spooled job {json.loads(header)['job_id']}: {acknowledgement['error']}")
+            else:
+                sent += 1
+
+            os.remove(header_file)
+            os.remove(audio_file)
+
+        if sent:
+            print(f"Sent {sent} spooled messages")
+        return sent
+
+
+def start_spool_drainer(interval=SPOOL_DRAIN_INTERVAL) -> threading.Thread:
+    """
+    Starts a background thread that sends the spooled messages every interval seconds
+    :param interval: Seconds between attempts
+    :return: The thread
+    """
+
+    async def drain_forever():
+        sender = MessageSender()
+        while True:
+            try:
+                await sender.drain_spool()
+            except Exception as e:
+                print(f"An error occurred while sending the spooled messages: {e}")
+            await asyncio.sleep(interval)
+
+    thread = threading.Thread(target=asyncio.run, args=(drain_forever(),), daemon=True)
+    thread.start()
+    return thread
+
+
+# The sender of the main thread, see get_sender
+sender: Optional[MessageSender] = None
+
+
+def get_sender() -> MessageSender:
+    global sender
+    if sender is None:
+        sender = MessageSender()
+    return sender
+
+
+async def send_audio_clip_to_server(audio_clip, processing_type="meeting", speaker=None, compress=True,
+                                    message_sender=None) -> Optional[str]:
+    """
+    Sends a recording to the server
+    :return: The job id, which the transcript can be fetched with (see services.results), or None if the server did not
+        acknowledge the recording
+    """
     if processing_type != "meeting" and processing_type != "enroll":
         print(f"Invalid type {processing_type}")
-        return False
+        return None
 
     if processing_type == "enroll" and not speaker:
         print(f"No speaker provided for enrollment!")
-        return False
+        return None
 
     try:
-        context = zmq.asyncio.Context()
-        socket = context.socket(zmq.PUSH)
-        print(f"Connecting to server at {SERVER_IP}:{SERVER_PORT}")
-        with socket.connect(f"tcp://{SERVER_IP}:{SERVER_PORT}") as conn:
-            print(f"Connected to server at {SERVER_IP}:{SERVER_PORT}")
-            print(f"Preparing payload for audio clip of length {len(audio_clip)}")
-            payload = processing_type.encode("utf-8") + b':' + (
-                speaker.encode("utf-8") if speaker else b'') + b':' + audio_clip
-            print(f"Sending payload of length {len(payload)}... please wait!")
-            await conn.send(payload)
-            return True
+        print(f"Preparing payload for audio clip of length {len(audio_clip)}")
+        if compress:
+            audio, codec, sample_rate = protocol.compress_wav(audio_clip)
+        else:
+            audio, codec, sample_rate = audio_clip, "wav", protocol.read_wav_sample_rate(audio_clip)
+        frames = protocol.build_message(processing_type, audio, speaker=speaker, sample_rate=sample_rate,
+                                        codec=codec)
+        print(f"Sending payload of length {len(audio)} ({codec})... please wait!")
+        return await (message_sender or get_sender()).send_reliably(frames)
     except Exception as e:
         print(f"An error occurred while sending the audio clip: {e}")
+    return None
+
+
+async def send_audio_stream_to_server(chunks, session_id, sample_rate=16000, message_sender=None):
+    """
+    Streams a live meeting to the server, one chunk of raw 16-bit PCM audio (mono) at a time. The server transcribes
+    the meeting while it is being streamed. Chunks are not spooled, since the meeting would be transcribed out of order.
+    :param chunks: Async iterator of PCM chunks
+    :param session_id: The id of the session, which is also the name of the transcript on the server
+    :param sample_rate: The sample rate of the audio
+    :param message_sender: The sender to use, since the stream usually runs in its own thread
+    :return: True if the server acknowledged all chunks
+    """
+    message_sender = message_sender or get_sender()
+    success = True
+    try:
+        print(f"Streaming session {session_id}")
+        sequence = 0
+        async for chunk in chunks:
+            frames = protocol.build_message("stream", chunk, sample_rate=sample_rate, codec="pcm", job_id=session_id,
+                                            sequence=sequence)
+            if await message_sender.deliver(frames, retries=1, timeout=STREAM_ACK_TIMEOUT) is None:
+                print(f"Chunk {sequence} of session {session_id} was not acknowledged")
+                success = False
+            sequence += 1
+
+        # Tell the server how many chunks there were, so it knows when it has received all of them
+        frames = protocol.build_message("stream-end", b'', sample_rate=sample_rate, codec="pcm", job_id=session_id,
+                                        sequence=sequence)
+        if await message_sender.deliver(frames, timeout=STREAM_ACK_TIMEOUT) is None:
+            success = False
+        print(f"Streamed {sequence} chunks for session {session_id}")
+        return success
+    except Exception as e:
+        print(f"An error occurred while streaming the audio: {e}")
     return False
@@ -0,0 +1,18 @@
+import torch
+
+
+def pad_waveforms(waveforms: list) -> tuple:
+    """
+    Pads a list of 1D waveforms with zeros into a single batch tensor, as expected by the SpeechBrain models. Tensors
+    with more dimensions (e.g. frame features of shape [channels, frames]) are padded along their last dimension.
+    :param waveforms: List of 1D waveform tensors, possibly of different lengths
+    :return: Tuple of the padded batch with shape [batch, ..., max_length] and the relative length of each waveform
+    """
+    lengths = torch.tensor([waveform.shape[-1] for waveform in waveforms], dtype=torch.float)
+    max_length = int(lengths.max().item())
+
+    batch = torch.zeros(len(waveforms), *waveforms[0].shape[:-1], max_length, dtype=waveforms[0].dtype)
+    for i, waveform in enumerate(waveforms):
+        batch[i, ..., :waveform.shape[-1]] = waveform
+
+    return batch, lengths / max_length
@@ -0,0 +1,204 @@
+import os
+import struct
+import wave
+from typing import Iterator, Optional
+import numpy as np
+import torch
+import torchaudio
+from .Preprocessing import preprocessor, MODEL_SAMPLE_RATE, NORMALIZED_PEAK
+
+try:
+    import soundfile
+except ImportError:
+    # Optional, without it audio is converted to 16-bit PCM in one piece, see write_pcm_wav
+    soundfile = None
+
+# Seconds of audio before and after every window that are decoded and preprocessed along with it and then dropped, such
+# that the filters and the resampler have settled at the edges of the window
+WINDOW_CONTEXT_SECONDS = 0.5
+# Frames that are decoded at a time when audio is converted to 16-bit PCM WAV, see write_pcm_wav
+CONVERT_BLOCK_FRAMES = 1024 * 1024
+
+
+def load_waveform(audio_file: str) -> tuple[torch.Tensor, int]:
+    """
+    Decodes an audio file once into a single mono waveform at the sample rate of the models, and preprocesses the
+    whole waveform in memory, see AudioPreprocessor
+    :param audio_file: The path to the audio file
+    :return: Tuple of the 1D waveform tensor and its sample rate
+    """
+    waveform, sample_rate = torchaudio.load(audio_file)
+    return preprocessor(waveform, sample_rate), MODEL_SAMPLE_RATE
+
+
+def read_windows(audio_file: str, window_seconds: int) -> Iterator[tuple[torch.Tensor, int]]:
+    """
+    Decodes and preprocesses an audio file one window at a time, so only one window is in memory however long the
+    recording is. 16-bit PCM WAV files (which is what the server saves, see convert_to_pcm_wav) are memory-mapped, see
+    open_pcm_wav, other files are decoded whole with load_waveform, so their memory use grows with their length.
+
+    The whole recording is normalized with the same gain, like the output of load_waveform. The gain comes from the
+    peak of the raw samples, which is found in a cheap pass over the memory map, so the recording is only filtered
+    once. The filters barely change the peak of speech, so this is close to the peak of the preprocessed audio.
+    :param audio_file: The path to the audio file
+    :param window_seconds: The length of each window, the last window may be shorter
+    :return: Iterator of the 1D waveform of each window at MODEL_SAMPLE_RATE, and the offset of its first sample in the
+        whole recording
+    """
+    wav = open_pcm_wav(audio_file)
+    if wav is None:
+        waveform, sample_rate = load_waveform(audio_file)
+        window_length = window_seconds * sample_rate
+        for start in range(0, waveform.shape[-1], window_length):
+            yield waveform[start:start + window_length], start
+        return
+
+    samples, sample_rate = wav
+    # The preprocessing is linear, so one gain for every window normalizes the whole recording
+    peak = get_peak(samples, window_seconds * sample_rate) / 32768
+    # Don't blow up silence
+    gain = NORMALIZED_PEAK / peak if peak >= 1e-4 else 1
+    for waveform, offset in preprocess_windows(samples, sample_rate, window_seconds):
+        yield waveform * gain, offset
+
+
+def get_peak(samples: np.ndarray, block_length: int) -> int:
+    """
+    Gets the peak of int16 samples, one block at a time so a memory map is never read into memory at once
+    :param samples: The samples, see open_pcm_wav
+    :param block_length: The number of frames per block
+    :return: The largest absolute sample value
+    """
+    peak = 0
+    for start in range(0, samples.shape[0], block_length):
+        block = samples[start:start + block_length]
+        # As ints, since the absolute value of -32768 doesn't fit in an int16
+        peak = max(peak, int(block.max()), -int(block.min()))
+    return peak
+
+
+def preprocess_windows(samples: np.ndarray, sample_rate: int, window_seconds: int) \
+        -> Iterator[tuple[torch.Tensor, int]]:
+    """
+    Preprocesses int16 samples one window at a time, without peak normalizing them
+    :param samples: The samples with shape [frames, channels], see open_pcm_wav
+    :param sample_rate: The sample rate of the samples
+    :param window_seconds: The length of each window
+    :return: Iterator of the 1D waveform of each window at MODEL_SAMPLE_RATE, and its offset
+    """
+    num_frames = samples.shape[0]
+    window_length = window_seconds * sample_rate
+    context = int(WINDOW_CONTEXT_SECONDS * sample_rate)
+    for start in range(0, num_frames, window_length):
+        end = min(start + window_length, num_frames)
+        read_start = max(0, start - context)
+        read_end = min(num_frames, end + context)
+
+        # Only this window (and its context) is copied out of the memory map
+        waveform = torch.from_numpy(samples[read_start:read_end].astype(np.float32).T) / 32768
+        waveform = preprocessor(waveform, sample_rate, normalize=False)
+
+        # Drop the context, the offsets are rounded the same way for every window so the windows line up exactly
+        output_start = start * MODEL_SAMPLE_RATE // sample_rate
+        output_end = end * MODEL_SAMPLE_RATE // sample_rate
+        trim = output_start - read_start * MODEL_SAMPLE_RATE // sample_rate
+        yield waveform[trim:trim + output_end - output_start], output_start
+
+
+def open_pcm_wav(audio_file: str) -> Optional[tuple[np.ndarray, int]]:
+    """
+    Memory-maps the samples of a 16-bit PCM WAV file
+    :param audio_file: The path to the file
+    :return: Tuple of the int16 samples with shape [frames, channels] and the sample rate, or None if the file is not
+        a 16-bit PCM WAV file
+    """
+    with open(audio_file, "rb") as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+            return None
+
+        fmt = None
+        while True:
+            chunk_header = f.read(8)
+            if len(chunk_header) < 8:
+                return None
+            chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+            if chunk_id == b"data":
+                data_offset = f.tell()
+                break
+            chunk = f.read(chunk_size + (chunk_size & 1))
+            if chunk_id == b"fmt " and len(chunk) >= 16:
+                fmt = struct.unpack("<HHIIHH", chunk[:16])
+
+    if fmt is None:
+        return None
+    # PCM, or WAVE_FORMAT_EXTENSIBLE which some recorders use for plain PCM as well
+    format_tag, channels, sample_rate, _, _, bits_per_sample = fmt
+    if format_tag not in (1, 0xFFFE) or bits_per_sample != 16 or channels == 0:
+        return None
+
+    # A recording that was cut off may have a data size of 0 or more than what is in the file, use what is there
+    available_bytes = os.path.getsize(audio_file) - data_offset
+    data_bytes = chunk_size if 0 < chunk_size <= available_bytes else available_bytes
+    num_frames = data_bytes // (2 * channels)
+    if num_frames == 0:
+        return np.zeros((0, channels), dtype=np.int16), sample_rate
+    return np.memmap(audio_file, dtype="<i2", mode="r", offset=data_offset, shape=(num_frames, channels)), sample_rate
+
+
+def pcm_to_waveform(pcm: bytes) -> torch.Tensor:
+    """
+    Converts raw 16-bit PCM audio (as recorded by the clients) to a waveform
+    :param pcm: The raw little-endian int16 samples, mono
+    :return: The 1D float waveform tensor in [-1, 1]
+    """
+    return torch.frombuffer(bytearray(pcm), dtype=torch.int16).float() / 32768
+
+
+def write_pcm_wav(source: str, wav_file: str) -> int:
+    """
+    Converts audio to a 16-bit PCM WAV file, such that read_windows can memory-map it. The audio is decoded one block
+    of CONVERT_BLOCK_FRAMES at a time, so the memory use doesn't grow with the length of the recording. Without
+    soundfile the audio is decoded in one piece with torchaudio.
+    :param source: The path to the audio, e.g. a FLAC file as sent by the clients to save bandwidth
+    :param wav_file: The path to write the WAV file to, must not be source
+    :return: The sample rate of the audio
+    """
+    if soundfile is None:
+        waveform, sample_rate = torchaudio.load(source)
+        torchaudio.save(wav_file, waveform, sample_rate, format="wav", encoding="PCM_S", bits_per_sample=16)
+        return sample_rate
+
+    with soundfile.SoundFile(source) as audio, wave.open(wav_file, "wb") as wav:
+        wav.setnchannels(audio.channels)
+        wav.setsampwidth(2)
+        wav.setframerate(audio.samplerate)
+        for block in audio.blocks(CONVERT_BLOCK_FRAMES, dtype="int16"):
+            wav.writeframes(block.astype("<i2", copy=False).tobytes())
+        return audio.samplerate
+
+
+def convert_to_pcm_wav(audio_file: str, wav_file: Optional[str] = None) -> str:
+    """
+    Converts an audio file to a 16-bit PCM WAV file, unless it is one already, see write_pcm_wav
+    :param audio_file: The path to the audio file
+    :param wav_file: The path to write the WAV file to, the audio file is replaced if not given
+    :return: The path to the 16-bit PCM WAV file
+    """
+    if open_pcm_wav(audio_file) is not None:
+        if wav_file is not None and wav_file != audio_file:
+            os.replace(audio_file, wav_file)
+            return wav_file
+        return audio_file
+
+    wav_file = wav_file or audio_file
+    temporary_file = f"{wav_file}.{os.getpid()}.tmp"
+    try:
+        write_pcm_wav(audio_file, temporary_file)
+        os.replace(temporary_file, wav_file)
+    finally:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+    if audio_file != wav_file:
+        os.remove(audio_file)
+    return wav_file
@@ -0,0 +1,110 @@
+import math
+import torch
+import torchaudio
+import torchaudio.transforms as T
+
+# The sample rate that the SpeechBrain models are trained on
+MODEL_SAMPLE_RATE = 16000
+# The band that speech is in, anything outside of it is noise (hum, rumble, hiss). The high cutoff has to stay below
+# half the sample rate of the models.
+LOW_CUTOFF_FREQUENCY = 100
+HIGH_CUTOFF_FREQUENCY = 7000
+# The peak amplitude that the audio is normalized to
+NORMALIZED_PEAK = 0.9
+
+
+class AudioPreprocessor:
+    """
+    Preprocessing stage that works on waveforms in memory: mix down to mono, resample to the sample rate of the models,
+    bandpass filter and peak normalize. The resampling kernels and filter coefficients are computed once per sample
+    rate and reused.
+    """
+
+    def __init__(self, target_sample_rate=MODEL_SAMPLE_RATE, low_cutoff_frequency=LOW_CUTOFF_FREQUENCY,
+                 high_cutoff_frequency=HIGH_CUTOFF_FREQUENCY, bandpass=True, normalize=True):
+        self.target_sample_rate = target_sample_rate
+        self.low_cutoff_frequency = low_cutoff_frequency
+        self.high_cutoff_frequency = high_cutoff_frequency
+        self.bandpass = bandpass
+        self.normalize = normalize
+
+        # Resamplers by source sample rate
+        self.resamplers: dict[int, T.Resample] = {}
+        # Filter coefficients (a, b) by sample rate, for the highpass and the lowpass filter
+        self.filters: dict[int, list[tuple[torch.Tensor, torch.Tensor]]] = {}
+
+    def __call__(self, waveform: torch.Tensor, sample_rate: int, normalize=None) -> torch.Tensor:
+        """
+        Preprocesses a waveform
+        :param waveform: The waveform with shape [channels, samples] or [samples]
+        :param sample_rate: The sample rate of the waveform
+        :param normalize: Whether to peak normalize, overrides the default of the preprocessor
+        :return: The 1D waveform at target_sample_rate
+        """
+        waveform = self.to_mono(waveform)
+        waveform = self.resample(waveform, sample_rate)
+        if self.bandpass:
+            waveform = self.filter(waveform)
+        if self.normalize if normalize is None else normalize:
+            waveform = self.peak_normalize(waveform)
+        return waveform
+
+    @staticmethod
+    def to_mono(waveform: torch.Tensor) -> torch.Tensor:
+        return waveform.mean(dim=0) if waveform.dim() == 2 else waveform
+
+    def resample(self, waveform: torch.Tensor, sample_rate: int) -> torch.Tensor:
+        if sample_rate == self.target_sample_rate:
+            return waveform
+
+        if sample_rate not in self.resamplers:
+            self.resamplers[sample_rate] = T.Resample(sample_rate, self.target_sample_rate)
+        return self.resamplers[sample_rate](waveform)
+
+    def filter(self, waveform: torch.Tensor) -> torch.Tensor:
+        if self.target_sample_rate not in self.filters:
+            self.filters[self.target_sample_rate] = [
+                biquad_coefficients("highpass", self.low_cutoff_frequency, self.target_sample_rate),
+                biquad_coefficients("lowpass", self.high_cutoff_frequency, self.target_sample_rate)
+            ]
+
+        for a_coefficients, b_coefficients in self.filters[self.target_sample_rate]:
+            waveform = torchaudio.functional.lfilter(waveform, a_coefficients, b_coefficients, clamp=False)
+        return waveform
+
+    @staticmethod
+    def peak_normalize(waveform: torch.Tensor) -> torch.Tensor:
+        peak = waveform.abs().max() if waveform.numel() else 0
+        # Don't blow up silence
+        if peak < 1e-4:
+            return waveform
+        return waveform * (NORMALIZED_PEAK / peak)
+
+
+def biquad_coefficients(filter_type: str, cutoff_frequency: float, sample_rate: int, q=0.707) -> tuple:
+    """
+    Computes the coefficients of a second order highpass or lowpass filter
+    https://www.w3.org/TR/audio-eq-cookbook/
+    :param filter_type: highpass or lowpass
+    :param cutoff_frequency: The cutoff frequency in Hz
+    :param sample_rate: The sample rate of the audio that will be filtered
+    :param q: The Q factor of the filter
+    :return: Tuple of the a and b coefficients, as expected by torchaudio.functional.lfilter
+    """
+    w0 = 2 * math.pi * cutoff_frequency / sample_rate
+    alpha = math.sin(w0) / (2 * q)
+    cos_w0 = math.cos(w0)
+
+    if filter_type == "highpass":
+        b = [(1 + cos_w0) / 2, -(1 + cos_w0), (1 + cos_w0) / 2]
+    elif filter_type == "lowpass":
+        b = [(1 - cos_w0) / 2, 1 - cos_w0, (1 - cos_w0) / 2]
+    else:
+        raise ValueError(f"Invalid filter type {filter_type}")
+    a = [1 + alpha, -2 * cos_w0, 1 - alpha]
+
+    return torch.tensor(a), torch.tensor(b)
+
+
+# The preprocessor for the models, reused for every clip so its resamplers and filters are reused too
+preprocessor = AudioPreprocessor()
@@ -0,0 +1,143 @@
+import torch
+from typing import Optional
+
+# Length of the sliding windows that speaker changes are detected with, see find_change_points
+CHANGE_WINDOW_SECONDS = 1.5
+# Distance between the sliding windows, the precision of the speaker changes
+CHANGE_HOP_SECONDS = 0.25
+# The remainder of a region that is shorter than this goes to the segment before it, see split_segments
+MIN_SEGMENT_SECONDS = 0.5
+
+
+def split_segments(waveform: torch.Tensor, sample_rate: int, seconds_per_segment: float,
+                   regions: Optional[list[tuple[int, int]]] = None, min_seconds=MIN_SEGMENT_SECONDS) -> list[dict]:
+    """
+    Splits a waveform into fixed-length segments without copying any audio
+    :param waveform: The 1D waveform of the whole audio clip
+    :param sample_rate: The sample rate of the waveform
+    :param seconds_per_segment: The length of each segment in seconds, the last segment of a region may be shorter
+    :param regions: Only split these (start, end) sample offsets of the waveform, e.g. the speech found by
+        detect_speech. The whole waveform if not given.
+    :param min_seconds: The last segment of a region is added to the segment before it if it's shorter than this,
+        since a speaker can't be recognized from a sliver of audio. A region that is shorter still is one segment.
+    :return: List of segments, with start and end as sample offsets into the waveform and audio as a view of the
+        waveform between them
+    """
+    segment_length = int(seconds_per_segment * sample_rate)
+    min_length = int(min_seconds * sample_rate)
+    if regions is None:
+        regions = [(0, waveform.shape[-1])]
+
+    segments = []
+    for region_start, region_end in regions:
+        for start in range(region_start, region_end, segment_length):
+            end = min(start + segment_length, region_end)
+            if end - start < min_length and start > region_start:
+                segments[-1]["end"] = end
+                segments[-1]["audio"] = waveform[segments[-1]["start"]:end]
+                continue
+            segments.append({
+                "start": start,
+                "end": end,
+                "audio": waveform[start:end]
+            })
+    return segments
+
+
+def merge_speaker_runs(segments: list[dict], max_gap=0, unknown_similarity: Optional[float] = None) -> list[dict]:
+    """
+    Collapses consecutive segments with the same speaker into runs, in a single pass. The runs don't hold any audio,
+    slice the original waveform with start and end when the audio of a run is needed.
+    :param segments: The segments with start, end (sample offsets) and speaker, in order
+    :param max_gap: The max number of samples between two segments of the same run, so a run never spans long parts
+        of the audio we skipped (e.g. silence)
+    :param unknown_similarity: Keep apart the segments of unknown speakers, such that they can be told apart later
+        (see SpeakerRecognition.Guests). Two consecutive segments without speaker are only merged if the cosine
+        similarity of their embeddings is above this, and their runs get the embeddings of all their segments.
+    :return: List of runs with start, end and speaker (and embeddings)
+    """
+    runs = []
+    for segment in segments:
+        previous = runs[-1] if runs else None
+        if previous and previous["speaker"] == segment["speaker"] and segment["start"] - previous["end"] <= max_gap \
+                and (unknown_similarity is None or segment["speaker"] is not None or
+                     torch.cosine_similarity(previous["embeddings"][-1].reshape(-1),
+                                             segment["embeddings"].reshape(-1), dim=0) > unknown_similarity):
+            previous["end"] = segment["end"]
+            if "embeddings" in previous:
+                previous["embeddings"].append(segment["embeddings"])
+        else:
+            runs.append({
+                "start": segment["start"],
+                "end": segment["end"],
+                "speaker": segment["speaker"]
+            })
+            if unknown_similarity is not None and segment["speaker"] is None:
+                runs[-1]["embeddings"] = [segment["embeddings"]]
+    return runs
+
+
+def sliding_windows(length: int, window_length: int, hop_length: int) -> list[int]:
+    """
+    Gets the offsets of the sliding windows over a piece of audio
+    :param length: The length of the audio in samples
+    :param window_length: The length of each window in samples
+    :param hop_length: The distance between two windows in samples
+    :return: The offset of every window, only whole windows are included
+    """
+    return list(range(0, length - window_length + 1, hop_length))
+
+
+def find_change_points(embeddings: torch.Tensor, window_length: int, hop_length: int, threshold: float) -> list[int]:
+    """
+    Finds where the speaker changes, from the embeddings of sliding windows. The embedding of every window is compared to
+    the one of the window right after it (which doesn't overlap it), in a single vectorized pass. The speaker changes
+    between the two windows where that similarity has a local minimum below threshold.
+    :param embeddings: The embeddings of the windows at the offsets of sliding_windows, with shape [num_windows, ...,
+        embedding_size]
+    :param window_length: The length of each window in samples
+    :param hop_length: The distance between two windows in samples
+    :param threshold: Cosine similarity below which two windows are of different speakers
+    :return: The sample offsets of the speaker changes, in order
+    """
+    step = max(1, round(window_length / hop_length))
+    if embeddings.shape[0] <= step:
+        return []
+
+    embeddings = torch.nn.functional.normalize(embeddings.reshape(embeddings.shape[0], -1).float(), dim=-1, eps=1e-6)
+    # similarity[i] compares window i with window i + step, they meet at offset (i + step) * hop_length
+    similarity = (embeddings[:-step] * embeddings[step:]).sum(dim=-1)
+
+    padding = torch.tensor([float("inf")])
+    previous = torch.cat([padding, similarity[:-1]])
+    following = torch.cat([similarity[1:], padding])
+    is_change = (similarity < threshold) & (similarity <= previous) & (similarity < following)
+    return [(i + step) * hop_length for i in torch.nonzero(is_change).flatten().tolist()]
+
+
+def split_at_changes(start: int, end: int, change_points: list[int], min_length: int, max_length: int) \
+        -> list[tuple[int, int]]:
+    """
+    Splits a speech region at the speaker changes, such that every segment is one speaker turn
+    :param start: The start of the region, in samples
+    :param end: The end of the region, in samples
+    :param change_points: The speaker changes in the region, as sample offsets from its start (see find_change_points)
+    :param min_length: Changes closer than this to the previous change or the end of the region are skipped, so no
+        segment is too short to recognize its speaker
+    :param max_length: Longer turns are split into equal parts, so a monologue doesn't become one huge segment
+    :return: The (start, end) sample offsets of the segments, in order
+    """
+    boundaries = [start]
+    for change_point in change_points:
+        change_point += start
+        if change_point - boundaries[-1] >= min_length and end - change_point >= min_length:
+            boundaries.append(change_point)
+    boundaries.append(end)
+
+    segments = []
+    for turn_start, turn_end in zip(boundaries, boundaries[1:]):
+        parts = max(1, -(-(turn_end - turn_start) // max_length))
+        for part in range(parts):
+            segments.append((turn_start + (turn_end - turn_start) * part // parts,
+                             turn_start + (turn_end - turn_start) * (part + 1) // parts))
+    return segments
@@ -0,0 +1,64 @@
+import torch
+
+# Length of the frames that the energy is computed over
+FRAME_SECONDS = 0.03
+# Frames this much louder than the noise floor are speech
+SPEECH_MARGIN_DB = 12
+# Frames quieter than this are never speech, so digital silence doesn't make the noise floor meaningless
+MIN_SPEECH_DB = -50
+# Pauses shorter than this don't end a speech region
+MIN_SILENCE_SECONDS = 0.3
+# Speech regions shorter than this are dropped as noise (clicks, bumps into the microphone...)
+MIN_SPEECH_SECONDS = 0.2
+# Added around every speech region, so the start and end of words are not cut off
+PADDING_SECONDS = 0.1
+
+
+def detect_speech(waveform: torch.Tensor, sample_rate: int, margin_db=SPEECH_MARGIN_DB) -> list[tuple[int, int]]:
+    """
+    Energy based voice activity detection. A frame is speech if its energy is well above the noise floor of the
+    recording, which is estimated as a low percentile of the frame energies.
+    :param waveform: The 1D waveform
+    :param sample_rate: The sample rate of the waveform
+    :param margin_db: How much louder than the noise floor speech is
+    :return: List of (start, end) sample offsets of the speech regions, in order and not overlapping
+    """
+    frame_length = int(FRAME_SECONDS * sample_rate)
+    num_frames = waveform.shape[-1] // frame_length
+    if num_frames == 0:
+        return []
+
+    frames = waveform[:num_frames * frame_length].reshape(num_frames, frame_length)
+    energy_db = 10 * torch.log10(frames.pow(2).mean(dim=1) + 1e-10)
+
+    # Even continuous speech has quiet frames between words, so the low percentile is close to the background noise
+    noise_floor_db = torch.quantile(energy_db, 0.1).item()
+    is_speech = energy_db > max(MIN_SPEECH_DB, noise_floor_db + margin_db)
+
+    # Find where speech starts and ends, as frame indices
+    changes = torch.diff(is_speech.int(), prepend=torch.tensor([0]), append=torch.tensor([0]))
+    starts = torch.nonzero(changes == 1).flatten().tolist()
+    ends = torch.nonzero(changes == -1).flatten().tolist()
+
+    # Close short pauses
+    regions = []
+    for start, end in zip(starts, ends):
+        if regions and (start - regions[-1][1]) * FRAME_SECONDS < MIN_SILENCE_SECONDS:
+            regions[-1][1] = end
+        else:
+            regions.append([start, end])
+
+    # Drop short noises, pad the rest and convert to sample offsets
+    padding = int(PADDING_SECONDS * sample_rate)
+    speech = []
+    for start, end in regions:
+        if (end - start) * FRAME_SECONDS < MIN_SPEECH_SECONDS:
+            continue
+        start = max(0, start * frame_length - padding)
+        end = min(waveform.shape[-1], end * frame_length + padding)
+        # The padding may make regions overlap
+        if speech and start <= speech[-1][1]:
+            speech[-1] = (speech[-1][0], end)
+        else:
+            speech.append((start, end))
+    return speech
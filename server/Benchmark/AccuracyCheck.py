@@ -0,0 +1,150 @@
+import argparse
+import os
+import time
+import torch
+from AudioProcessing.Decoding import load_waveform
+from Models.ModelRegistry import get_model
+from SpeakerRecognition.SpeakerIndex import SpeakerIndex
+from SpeechRecognition.SpeechBrain import ASR_MODELS
+
+# The score above which two clips are from the same speaker, as in SpeakerRecognition.SpeechBrain
+SPEAKER_THRESHOLD = 0.25
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """
+    Computes the word error rate: the minimum number of substituted, deleted and inserted words to turn the reference
+    into the hypothesis, divided by the number of words in the reference
+    :param reference: The correct transcription
+    :param hypothesis: The transcription to check
+    :return: The word error rate, 0 is a perfect transcription
+    """
+    reference_words = reference.upper().split()
+    hypothesis_words = hypothesis.upper().split()
+
+    # Edit distance, one row of the table at a time
+    distances = list(range(len(hypothesis_words) + 1))
+    for i, reference_word in enumerate(reference_words, start=1):
+        previous_diagonal, distances[0] = distances[0], i
+        for j, hypothesis_word in enumerate(hypothesis_words, start=1):
+            substitution = previous_diagonal + (reference_word != hypothesis_word)
+            previous_diagonal = distances[j]
+            distances[j] = min(substitution, distances[j] + 1, distances[j - 1] + 1)
+    return distances[-1] / max(1, len(reference_words))
+
+
+def load_reference_set(directory: str) -> list[dict]:
+    """
+    Loads the reference set: every WAV file in the directory, and its transcription from the TXT file with the same
+    name if there is one
+    :param directory: The directory of the reference set, e.g. the speakers directory of the server
+    :return: List of clips, with their name, waveform and transcription (or None)
+    """
+    clips = []
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(".wav"):
+            continue
+        transcription_file = os.path.join(directory, name[:-len(".wav")] + ".txt")
+        transcription = None
+        if os.path.exists(transcription_file):
+            with open(transcription_file, "r") as f:
+                transcription = f.read().strip()
+        clips.append({"name": name, "waveform": load_waveform(os.path.join(directory, name))[0],
+                      "transcription": transcription})
+    return clips
+
+
+def run_model(model, waveforms: list, transcribe: bool) -> tuple[list, float]:
+    """
+    Runs a model on every clip, one at a time
+    :return: Tuple of the results and the total seconds it took
+    """
+    results = []
+    with torch.inference_mode():
+        # Once before timing, so lazy initialization doesn't count
+        if waveforms:
+            run_batch(model, waveforms[0].unsqueeze(0), transcribe)
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        for waveform in waveforms:
+            results.append(run_batch(model, waveform.unsqueeze(0), transcribe))
+    return results, time.perf_counter() - start
+
+
+def run_batch(model, batch: torch.Tensor, transcribe: bool):
+    lengths = torch.ones(batch.shape[0])
+    if transcribe:
+        return model.transcribe_batch(batch, lengths)[0][0]
+    return model.encode_batch(batch, lengths)[0]
+
+
+def check_speaker_model(clips: list[dict]):
+    waveforms = [clip["waveform"] for clip in clips]
+    reference, reference_seconds = run_model(get_model("spkrec-ecapa-voxceleb"), waveforms, transcribe=False)
+    quantized, quantized_seconds = run_model(get_model("spkrec-ecapa-voxceleb", quantized=True), waveforms,
+                                             transcribe=False)
+
+    reference = SpeakerIndex.normalize(torch.cat(reference))
+    quantized = SpeakerIndex.normalize(torch.cat(quantized))
+    # How close the int8 embedding of every clip is to its fp32 embedding
+    self_similarity = (reference * quantized).sum(dim=-1)
+    # The scores between every pair of clips, these decide who is recognized
+    reference_scores = reference @ reference.T
+    quantized_scores = quantized @ quantized.T
+    score_errors = (reference_scores - quantized_scores).abs()
+    same_decisions = ((reference_scores > SPEAKER_THRESHOLD) == (quantized_scores > SPEAKER_THRESHOLD)).float()
+
+    print(f"Speaker recognition (spkrec-ecapa-voxceleb), {len(clips)} clips:\n"
+          f"- Similarity of int8 to fp32 embeddings: mean {self_similarity.mean():.4f}, "
+          f"min {self_similarity.min():.4f}\n"
+          f"- Error of the pairwise scores: mean {score_errors.mean():.4f}, max {score_errors.max():.4f}\n"
+          f"- Same decision at threshold {SPEAKER_THRESHOLD}: {same_decisions.mean():.2%} of pairs\n"
+          f"- Time: fp32 {reference_seconds:.2f}s, int8 {quantized_seconds:.2f}s "
+          f"({reference_seconds / quantized_seconds:.1f}x)\n")
+
+
+def check_speech_model(clips: list[dict], model: str):
+    name = ASR_MODELS[model]
+    waveforms = [clip["waveform"] for clip in clips]
+    reference, reference_seconds = run_model(get_model(name), waveforms, transcribe=True)
+    quantized, quantized_seconds = run_model(get_model(name, quantized=True), waveforms, transcribe=True)
+
+    # Without transcriptions, the fp32 model is the reference
+    agreement = [word_error_rate(fp32, int8) for fp32, int8 in zip(reference, quantized)]
+    print(f"Speech recognition ({name}), {len(clips)} clips:\n"
+          f"- WER of int8 against fp32: {sum(agreement) / len(agreement):.2%}")
+
+    transcribed = [i for i, clip in enumerate(clips) if clip["transcription"] is not None]
+    if transcribed:
+        reference_wer = [word_error_rate(clips[i]["transcription"], reference[i]) for i in transcribed]
+        quantized_wer = [word_error_rate(clips[i]["transcription"], quantized[i]) for i in transcribed]
+        print(f"- WER against the {len(transcribed)} transcriptions: fp32 "
+              f"{sum(reference_wer) / len(reference_wer):.2%}, int8 {sum(quantized_wer) / len(quantized_wer):.2%}")
+
+    print(f"- Time: fp32 {reference_seconds:.2f}s, int8 {quantized_seconds:.2f}s "
+          f"({reference_seconds / quantized_seconds:.1f}x)\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the accuracy and speed of the int8 models against fp32")
+    parser.add_argument("directory", nargs="?", default="speakers",
+                        help="Directory with WAV files, and optionally a TXT transcription of each of them")
+    parser.add_argument("--asr-model", default="wav2vec2", choices=list(ASR_MODELS), help="The ASR model to check")
+    parser.add_argument("--threads", type=int, default=None, help="Threads that torch uses, as in a worker")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    clips = load_reference_set(args.directory)
+    if not clips:
+        print(f"No WAV files found in {args.directory}")
+        return
+
+    check_speaker_model(clips)
+    check_speech_model(clips, args.asr_model)
+
+
+if __name__ == '__main__':
+    main()
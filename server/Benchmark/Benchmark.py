@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import contextlib
+import inspect
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import torch
+
+try:
+    import resource
+except ImportError:
+    # Windows, peak memory is not reported there
+    resource = None
+
+import main
+from AudioProcessing.Decoding import MODEL_SAMPLE_RATE
+from Benchmark.Synthetic import generate_voices, generate_meeting, synthesize_voice
+from Benchmark.StubModels import StubSpeakerRecognition, StubSpeechRecognition
+from Models.ModelRegistry import preload_models
+from SpeechRecognition.SpeechBrain import ASR_MODELS
+
+# The stages of process_audio that are timed, in pipeline order
+STAGES = ["decode", "segment", "embed", "merge", "asr", "write"]
+# The functions in main that belong to each stage
+MAIN_STAGES = {
+    "read_windows": "decode",
+    "detect_speech": "segment",
+    "split_segments": "segment",
+    "merge_speaker_runs": "merge",
+    "label_guests": "merge",
+    "write_results": "write",
+}
+# Seconds of audio to enroll each speaker with
+ENROLLMENT_SECONDS = 10
+
+
+class StageTimer:
+    """
+    Times the stages of the pipeline, by replacing the functions of each stage with timed wrappers while a benchmark
+    runs
+    """
+
+    def __init__(self):
+        # Seconds of each call, by stage
+        self.timings: dict[str, list[float]] = {stage: [] for stage in STAGES}
+
+    def wrap(self, stage: str, function):
+        if inspect.isgeneratorfunction(function):
+            # Time every item, not just creating the generator
+            def timed(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                while True:
+                    start = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    finally:
+                        self.timings[stage].append(time.perf_counter() - start)
+                    yield item
+        elif asyncio.iscoroutinefunction(function):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    self.timings[stage].append(time.perf_counter() - start)
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.timings[stage].append(time.perf_counter() - start)
+        return timed
+
+    @contextlib.contextmanager
+    def patch(self, speaker, speech):
+        """
+        Times the pipeline functions in main, and the embed and ASR stages of the given models
+        :param speaker: The speaker recognition model that process_audio uses
+        :param speech: The speech recognition model that process_audio uses
+        :return:
+        """
+        originals = {name: getattr(main, name) for name in MAIN_STAGES}
+        for name, stage in MAIN_STAGES.items():
+            setattr(main, name, self.wrap(stage, originals[name]))
+        # Shadow the methods on the instances, so the classes are left alone
+        speaker.recognize_segments = self.wrap("embed", speaker.recognize_segments)
+        speaker.recognize_turns = self.wrap("embed", speaker.recognize_turns)
+        speech.get_text_batch = self.wrap("asr", speech.get_text_batch)
+        try:
+            yield self
+        finally:
+            for name, function in originals.items():
+                setattr(main, name, function)
+            del speaker.recognize_segments
+            del speaker.recognize_turns
+            del speech.get_text_batch
+
+
+def get_speaker_accuracy(turns: list[dict], runs: list[dict]) -> float:
+    """
+    Gets the share of the speech that is attributed to the right speaker
+    :param turns: The turns of the synthetic meeting, see generate_meeting
+    :param runs: The speaker runs of the transcript, see process_audio
+    :return: The seconds of the turns that overlap a run of their speaker, divided by the seconds of all turns
+    """
+    correct = 0
+    for turn in turns:
+        start, end = turn["start"] / MODEL_SAMPLE_RATE, turn["end"] / MODEL_SAMPLE_RATE
+        correct += sum(max(0.0, min(end, run["end"]) - max(start, run["start"])) for run in runs
+                       if run["speaker"] == f"Speaker {turn['speaker']}")
+    return correct / max(1e-9, sum(turn["end"] - turn["start"] for turn in turns) / MODEL_SAMPLE_RATE)
+
+
+def get_peak_rss_mb() -> float:
+    """
+    Gets the peak resident memory of this process
+    :return: The peak RSS in MB, or 0 if it can't be measured on this platform
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes everywhere else
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+async def run_benchmark(seconds=300, num_speakers=4, runs=1, stub=True, seed=0, verbose=False,
+                        fast_inference=False, adaptive_segmentation=False) -> dict:
+    """
+    Runs enroll_speaker and process_audio on a synthetic meeting, in a temporary directory so the speakers, caches and
+    results of the benchmark don't mix with the ones of the server
+    :param seconds: The length of the meeting
+    :param num_speakers: The number of speakers in the meeting, all of them are enrolled
+    :param runs: The number of times to process the meeting, every run starts with fresh models and caches
+    :param stub: Whether to use the stub models instead of the real ones
+    :param seed: The seed of the synthetic audio
+    :param verbose: Whether to show the output of the pipeline
+    :param fast_inference: Use the int8 versions of the real models
+    :param adaptive_segmentation: Split the meeting at the speaker changes, see main.ADAPTIVE_SEGMENTATION
+    :return: The results, see print_results
+    """
+    voices = generate_voices(num_speakers, seed)
+    meeting, turns = generate_meeting(seconds, voices, seed=seed)
+
+    if not stub:
+        # Load the models before leaving the working directory, that's where the pretrained models are saved
+        preload_models(["spkrec-ecapa-voxceleb", ASR_MODELS[main.ASR_MODEL]], quantized=fast_inference)
+
+    timer = StageTimer()
+    speaker_accuracy = []
+    enroll_seconds = []
+    process_seconds = []
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        adaptive, main.ADAPTIVE_SEGMENTATION = main.ADAPTIVE_SEGMENTATION, adaptive_segmentation
+        try:
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                meeting_file = await main.save_audio(meeting, audio_id="meeting", sample_rate=MODEL_SAMPLE_RATE)
+                # Seeded like the meeting, so the speaker accuracy is the same every time
+                generator = torch.Generator().manual_seed(seed)
+                enrollment_files = [await main.save_audio(synthesize_voice(voice, ENROLLMENT_SECONDS,
+                                                                           generator=generator),
+                                                          audio_id=f"speaker-{i}", sample_rate=MODEL_SAMPLE_RATE)
+                                    for i, voice in enumerate(voices)]
+
+                for run in range(runs):
+                    # Forget the speakers and cached results of the previous run
+                    for run_directory in ["speakers", "cache"]:
+                        shutil.rmtree(run_directory, ignore_errors=True)
+                    if stub:
+                        main.speaker = StubSpeakerRecognition()
+                        main.speech = StubSpeechRecognition()
+                    else:
+                        main.speaker = main.Speaker(fast_inference=fast_inference)
+                        main.speech = main.Speech(main.ASR_MODEL, fast_inference=fast_inference)
+
+                    for i, enrollment_file in enumerate(enrollment_files):
+                        start = time.perf_counter()
+                        await main.enroll_speaker(enrollment_file, f"Speaker {i}")
+                        enroll_seconds.append(time.perf_counter() - start)
+
+                    with timer.patch(main.speaker, main.speech):
+                        start = time.perf_counter()
+                        main.results.add_job(f"benchmark-{run}", "meeting")
+                        result = await main.process_audio(meeting_file)
+                        await main.write_results(f"benchmark-{run}", result)
+                        process_seconds.append(time.perf_counter() - start)
+                    speaker_accuracy.append(get_speaker_accuracy(turns, result["runs"]))
+        finally:
+            # The result store was opened in the temporary directory
+            main.results.close()
+            main.ADAPTIVE_SEGMENTATION = adaptive
+            os.chdir(working_directory)
+            main.speaker = None
+            main.speech = None
+
+    audio_seconds = meeting.shape[-1] / MODEL_SAMPLE_RATE
+    return {
+        "models": "stub" if stub else "speechbrain int8" if fast_inference else "speechbrain",
+        "segmentation": "adaptive" if adaptive_segmentation else "fixed",
+        "audio_seconds": audio_seconds,
+        "speakers": num_speakers,
+        "turns": len(turns),
+        "runs": runs,
+        "wall_seconds": sum(process_seconds),
+        "throughput": audio_seconds * runs / sum(process_seconds),
+        "enroll_seconds": sum(enroll_seconds) / len(enroll_seconds),
+        "speaker_accuracy": sum(speaker_accuracy) / len(speaker_accuracy),
+        "stages": {stage: {"calls": len(timings), "seconds": sum(timings) / runs}
+                   for stage, timings in timer.timings.items()},
+        "peak_rss_mb": get_peak_rss_mb(),
+    }
+
+
+def print_results(results: dict):
+    print(f"Processed {results['audio_seconds']:.0f} seconds of audio with {results['speakers']} speakers "
+          f"({results['turns']} turns) using {results['models']} models and {results['segmentation']} segmentation, "
+          f"{results['runs']} runs\n"
+          f"- Throughput: {results['throughput']:.1f} audio seconds per wall second\n"
+          f"- Processing: {results['wall_seconds'] / results['runs']:.3f} seconds per run\n"
+          f"- Enrollment: {results['enroll_seconds']:.3f} seconds per speaker\n"
+          f"- Speaker accuracy: {results['speaker_accuracy']:.1%} of the speech\n"
+          f"- Peak RSS: {results['peak_rss_mb']:.0f} MB\n")
+
+    total = sum(stage["seconds"] for stage in results["stages"].values()) or 1
+    print(f"{'Stage':<10}{'Calls':>8}{'Seconds':>12}{'Share':>8}")
+    for name, stage in results["stages"].items():
+        print(f"{name:<10}{stage['calls']:>8}{stage['seconds']:>12.3f}{stage['seconds'] / total:>8.0%}")
+
+
+async def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmarks the server pipeline on synthetic meetings")
+    parser.add_argument("--seconds", type=float, default=300, help="Length of the meeting in seconds")
+    parser.add_argument("--speakers", type=int, default=4, help="Number of speakers in the meeting")
+    parser.add_argument("--runs", type=int, default=1, help="Number of times to process the meeting")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic audio")
+    parser.add_argument("--real", action="store_true", help="Use the SpeechBrain models instead of the stubs")
+    parser.add_argument("--fast", action="store_true", help="Use the int8 versions of the SpeechBrain models")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="Split the meeting at the speaker changes instead of into fixed segments")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the pipeline")
+    args = parser.parse_args()
+
+    results = await run_benchmark(args.seconds, args.speakers, args.runs, stub=not args.real, seed=args.seed,
+                                  verbose=args.verbose, fast_inference=args.fast,
+                                  adaptive_segmentation=args.adaptive)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == '__main__':
+    asyncio.run(main_benchmark())
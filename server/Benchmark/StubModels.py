@@ -0,0 +1,129 @@
+from typing import Optional
+import torch
+from SpeakerRecognition.SpeakerClass import SpeakerClass, Speaker
+from SpeakerRecognition.SpeakerIndex import SpeakerIndex
+from SpeechRecognition.SpeechClass import SpeechClass
+from AudioProcessing.Decoding import load_waveform, MODEL_SAMPLE_RATE
+from AudioProcessing.Segmentation import sliding_windows, find_change_points, split_at_changes, \
+    CHANGE_WINDOW_SECONDS, CHANGE_HOP_SECONDS
+
+# Number of frequency bands in a stub embedding
+STUB_EMBEDDING_SIZE = 64
+# Seconds of audio per word in a stub transcription
+STUB_SECONDS_PER_WORD = 0.4
+# Windows of the same synthetic voice are well above this cosine similarity, while the stub embeddings of two voices
+# are still fairly similar, see recognize_turns
+STUB_CHANGE_THRESHOLD = 0.95
+
+
+class StubSpeaker(Speaker):
+    def __init__(self, name: str, speaker_id: str, embeddings: torch.Tensor):
+        super().__init__(name)
+        self.speaker_id = speaker_id
+        self.embeddings = embeddings
+
+
+class StubSpeakerRecognition(SpeakerClass):
+    """
+    Deterministic speaker recognition that runs offline and without any model. The embedding of a clip is its
+    log spectrum in STUB_EMBEDDING_SIZE bands, which is enough to tell the synthetic voices of Benchmark.Synthetic
+    apart. Speakers are only kept in memory.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.index = SpeakerIndex()
+
+    @staticmethod
+    def get_embeddings_batch(waveforms: list) -> torch.Tensor:
+        embeddings = []
+        for waveform in waveforms:
+            spectrum = torch.fft.rfft(waveform).abs()
+            bands = torch.tensor_split(spectrum, STUB_EMBEDDING_SIZE)
+            energies = torch.stack([band.pow(2).mean() if band.numel() else torch.tensor(0.0) for band in bands])
+            embedding = torch.log10(energies + 1e-10)
+            # Cosine similarity needs the embedding to be centered, like the embeddings of a real model
+            embeddings.append((embedding - embedding.mean()).reshape(1, -1))
+        return torch.stack(embeddings)
+
+    async def enroll(self, audio: str, name: str) -> Speaker:
+        waveform, _ = load_waveform(audio)
+        embeddings = self.get_embeddings_batch([waveform])
+        speaker = StubSpeaker(name, speaker_id=f"stub-{len(self.speakers)}", embeddings=embeddings)
+        self.speakers.append(speaker)
+        self.index.add(speaker, embeddings)
+        return speaker
+
+    async def recognize(self, audio: str, threshold=0.5) -> Optional[Speaker]:
+        waveform, _ = load_waveform(audio)
+        return (await self.recognize_batch([waveform], threshold))[0]
+
+    async def recognize_batch(self, waveforms: list, threshold=0.5) -> list[Optional[Speaker]]:
+        if not waveforms:
+            return []
+
+        return self.get_best_matches(self.get_embeddings_batch(waveforms), threshold)
+
+    async def recognize_segments(self, segments: list[dict], threshold=0.5) -> list[dict]:
+        if segments:
+            embeddings = self.get_embeddings_batch([segment["audio"] for segment in segments])
+            for segment, segment_embeddings, segment_speaker in zip(segments, embeddings,
+                                                                    self.get_best_matches(embeddings, threshold)):
+                segment["embeddings"] = segment_embeddings
+                segment["speaker"] = segment_speaker
+        return segments
+
+    def get_best_matches(self, embeddings: torch.Tensor, threshold=0.5) -> list[Optional[Speaker]]:
+        scores, matches = self.index.search(embeddings, k=1)
+        return [embedding_matches[0] if embedding_matches and score[0] > threshold else None
+                for score, embedding_matches in zip(scores.tolist(), matches)]
+
+    async def recognize_turns(self, waveform, regions: list[tuple[int, int]], min_seconds: float, max_seconds: float,
+                              threshold=0.5) -> list[dict]:
+        """
+        Splits speech into speaker turns like SpeechBrain.recognize_turns, with the stub embeddings of the sliding
+        windows and of every turn
+        """
+        window_length = int(CHANGE_WINDOW_SECONDS * MODEL_SAMPLE_RATE)
+        hop_length = int(CHANGE_HOP_SECONDS * MODEL_SAMPLE_RATE)
+        segments = []
+        for start, end in regions:
+            offsets = sliding_windows(end - start, window_length, hop_length)
+            change_points = find_change_points(self.get_embeddings_batch(
+                [waveform[start + offset:start + offset + window_length] for offset in offsets]), window_length,
+                hop_length, STUB_CHANGE_THRESHOLD) if offsets else []
+            for segment_start, segment_end in split_at_changes(start, end, change_points,
+                                                               int(min_seconds * MODEL_SAMPLE_RATE),
+                                                               int(max_seconds * MODEL_SAMPLE_RATE)):
+                segments.append({"start": segment_start, "end": segment_end,
+                                 "audio": waveform[segment_start:segment_end]})
+
+        if segments:
+            embeddings = self.get_embeddings_batch([segment["audio"] for segment in segments])
+            for segment, segment_embeddings, segment_speaker in zip(segments, embeddings,
+                                                                    self.get_best_matches(embeddings, threshold)):
+                segment["embeddings"] = segment_embeddings
+                segment["speaker"] = segment_speaker
+        return segments
+
+    async def load(self):
+        return bool(self.speakers)
+
+    async def save(self):
+        pass
+
+
+class StubSpeechRecognition(SpeechClass):
+    """
+    Deterministic speech recognition that runs offline and without any model, the transcription of a clip is one
+    word per STUB_SECONDS_PER_WORD of audio
+    """
+
+    async def get_text(self, audio):
+        if isinstance(audio, str):
+            audio, _ = load_waveform(audio)
+        return (await self.get_text_batch([audio]))[0]
+
+    async def get_text_batch(self, waveforms: list, sample_rate=MODEL_SAMPLE_RATE) -> list[str]:
+        return [" ".join(["WORD"] * int(waveform.shape[-1] / sample_rate / STUB_SECONDS_PER_WORD))
+                for waveform in waveforms]
@@ -0,0 +1,97 @@
+import math
+import torch
+from AudioProcessing.Decoding import MODEL_SAMPLE_RATE
+
+# Seconds of each speaker turn, the length is drawn uniformly from this range
+TURN_SECONDS = (2, 8)
+# Seconds of silence between turns
+PAUSE_SECONDS = (0.2, 1.0)
+# Number of harmonics in a synthetic voice
+NUM_HARMONICS = 12
+# Syllables per second, the voice is amplitude modulated at this rate so it has pauses like speech
+SYLLABLE_RATE = 4
+# Amplitude of the background noise
+NOISE_LEVEL = 0.002
+
+
+def generate_voices(num_speakers: int, seed=0) -> list[dict]:
+    """
+    Generates the parameters of distinct synthetic voices
+    :param num_speakers: The number of voices
+    :param seed: The seed, the same seed gives the same voices
+    :return: List of voices, each with a fundamental frequency and the weights of its harmonics
+    """
+    generator = torch.Generator().manual_seed(seed)
+    voices = []
+    for i in range(num_speakers):
+        # Spread the fundamentals over the range of human voices (85-255 Hz), so every voice is distinct
+        fundamental = 85 + 170 * (i + 0.5) / num_speakers
+        # A formant: the harmonics close to it are louder, which gives each voice its own timbre
+        formant = 300 + 2500 * torch.rand(1, generator=generator).item()
+        harmonics = torch.arange(1, NUM_HARMONICS + 1) * fundamental
+        weights = torch.exp(-((harmonics - formant) / 600) ** 2) + 0.1 / torch.arange(1, NUM_HARMONICS + 1)
+        voices.append({"fundamental": fundamental, "weights": weights / weights.sum()})
+    return voices
+
+
+def synthesize_voice(voice: dict, seconds: float, sample_rate=MODEL_SAMPLE_RATE, generator=None) -> torch.Tensor:
+    """
+    Synthesizes speech-like audio of a voice: its harmonics with a bit of vibrato, amplitude modulated into syllables
+    :param voice: The voice, see generate_voices
+    :param seconds: The length of the audio
+    :param sample_rate: The sample rate of the audio
+    :param generator: The random generator, for reproducible audio
+    :return: The 1D waveform
+    """
+    # Rounded, such that a turn of (end - start) / sample_rate seconds gets end - start samples
+    num_samples = round(seconds * sample_rate)
+    t = torch.arange(num_samples) / sample_rate
+
+    vibrato = 1 + 0.02 * torch.sin(2 * math.pi * 5 * t)
+    phase = 2 * math.pi * voice["fundamental"] * torch.cumsum(vibrato, dim=0) / sample_rate
+    waveform = torch.zeros(num_samples)
+    for harmonic, weight in enumerate(voice["weights"].tolist(), start=1):
+        waveform += weight * torch.sin(harmonic * phase)
+
+    # Syllables with a random offset, squared so there are short pauses between them
+    offset = torch.rand(1, generator=generator).item()
+    envelope = torch.sin(math.pi * (SYLLABLE_RATE * t + offset)).abs() ** 2
+    return 0.5 * waveform * envelope
+
+
+def generate_meeting(seconds: float, voices: list[dict], sample_rate=MODEL_SAMPLE_RATE, seed=0) -> tuple:
+    """
+    Generates a synthetic meeting, where the speakers take turns with pauses in between
+    :param seconds: The length of the meeting
+    :param voices: The voices of the speakers, see generate_voices
+    :param sample_rate: The sample rate of the audio
+    :param seed: The seed, the same seed gives the same meeting
+    :return: Tuple of the 1D waveform and the turns, as dicts with the speaker (index into voices) and the start and
+        end sample
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_samples = int(seconds * sample_rate)
+    waveform = NOISE_LEVEL * torch.randn(num_samples, generator=generator)
+
+    turns = []
+    position = 0
+    speaker = -1
+    while True:
+        pause = PAUSE_SECONDS[0] + (PAUSE_SECONDS[1] - PAUSE_SECONDS[0]) * torch.rand(1, generator=generator).item()
+        start = position + int(pause * sample_rate)
+        turn = TURN_SECONDS[0] + (TURN_SECONDS[1] - TURN_SECONDS[0]) * torch.rand(1, generator=generator).item()
+        end = min(num_samples, start + int(turn * sample_rate))
+        if end - start < sample_rate:
+            break
+
+        # Never the same speaker twice in a row, unless there is only one
+        if len(voices) > 1:
+            speaker = (speaker + 1 + torch.randint(len(voices) - 1, (1,), generator=generator).item()) % len(voices)
+        else:
+            speaker = 0
+        waveform[start:end] += synthesize_voice(voices[speaker], (end - start) / sample_rate, sample_rate,
+                                                generator)[:end - start]
+        turns.append({"speaker": speaker, "start": start, "end": end})
+        position = end
+
+    return waveform, turns
@@ -0,0 +1,167 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+from Monitoring.Metrics import metrics
+
+# Where the uploaded audio is kept
+AUDIO_CACHE_DIRECTORY = "audio_cache"
+# Where segment files are kept, they only live as long as their job so this can be on a tmpfs such as /dev/shm
+AUDIO_SEGMENT_DIRECTORY = os.path.join(AUDIO_CACHE_DIRECTORY, "segments")
+# Max size of the uploaded audio on disk, the least recently used files are deleted first
+AUDIO_CACHE_BYTES = 10 * 1024 * 1024 * 1024
+# Uploaded audio older than this is deleted, set to None to keep it until the cache is full
+AUDIO_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+# No job runs this long, so segment files that are older were left behind by a job that didn't finish. Younger ones may
+# belong to a job that another process (a pool process or a worker of the broker) is still running.
+AUDIO_SEGMENT_MAX_AGE = 6 * 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class AudioCache:
+    """
+    Keeps the uploaded audio on disk within a size and age budget. Files of jobs that are queued or running are pinned
+    and never deleted, the others are deleted least recently used first once the cache is over budget or they are too
+    old. Uploads are spread over subdirectories, so no directory ends up with a huge number of files.
+
+    Only the server process manages the uploads, the worker processes only use the cache for their segment files,
+    which are deleted when their job is done (see remove).
+    """
+
+    def __init__(self, directory=AUDIO_CACHE_DIRECTORY, segment_directory=AUDIO_SEGMENT_DIRECTORY,
+                 max_bytes=AUDIO_CACHE_BYTES, max_age=AUDIO_CACHE_MAX_AGE, max_segment_age=AUDIO_SEGMENT_MAX_AGE):
+        self.directory = directory
+        self.segment_directory = segment_directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.max_segment_age = max_segment_age
+
+        # Sizes and last use of the uploaded files by path, least recently used first
+        self.files: OrderedDict[str, tuple[int, float]] = OrderedDict()
+        self.total_bytes = 0
+        # Files of jobs that are not done yet
+        self.pinned: set[str] = set()
+
+    def get_path(self, audio_id: str, is_segment=False, extension="wav") -> str:
+        """
+        Gets the path to save some audio to, and creates its directory
+        :param audio_id: The id of the audio, e.g. the job id
+        :param is_segment: Whether the audio is a segment of a job
+        :param extension: The extension of the file, e.g. flac for audio that is converted to WAV after it's received
+        :return: The path
+        """
+        if is_segment:
+            directory = self.segment_directory
+        else:
+            directory = os.path.join(self.directory, audio_id[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"{audio_id}.{extension}")
+
+    def load(self):
+        """
+        Indexes the uploads that are already on disk, oldest first, deletes the segments that were left behind by jobs
+        that didn't finish (see AUDIO_SEGMENT_MAX_AGE), and enforces the budget
+        :return:
+        """
+        self.files.clear()
+        self.total_bytes = 0
+
+        entries = []
+        if os.path.exists(self.directory):
+            for shard in os.scandir(self.directory):
+                if not shard.is_dir() or shard.path == os.path.normpath(self.segment_directory):
+                    continue
+                entries += [entry for entry in os.scandir(shard.path) if entry.is_file()]
+
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            stat = entry.stat()
+            self.files[entry.path] = (stat.st_size, stat.st_mtime)
+            self.total_bytes += stat.st_size
+
+        if os.path.exists(self.segment_directory):
+            now = time.time()
+            for entry in os.scandir(self.segment_directory):
+                try:
+                    too_old = entry.is_file() and now - entry.stat().st_mtime > self.max_segment_age
+                except FileNotFoundError:
+                    # Its job just finished
+                    continue
+                if too_old:
+                    remove_file(entry.path)
+
+        logger.info(f"Audio cache has {len(self.files)} files ({self.total_bytes / 1024 ** 2:.0f} MB)")
+        self.enforce()
+
+    def add(self, path: str, pinned=True):
+        """
+        Adds an uploaded file to the cache
+        :param path: The path of the file, see get_path
+        :param pinned: Whether the file is used by a job that isn't done yet, see release
+        :return:
+        """
+        size = os.path.getsize(path)
+        if path in self.files:
+            self.total_bytes -= self.files.pop(path)[0]
+        self.files[path] = (size, time.time())
+        self.total_bytes += size
+        if pinned:
+            self.pinned.add(path)
+        self.enforce()
+
+    def release(self, path: str):
+        """
+        Unpins a file once its job is done, such that it can be deleted when the cache is over budget
+        :param path: The path of the file
+        :return:
+        """
+        self.pinned.discard(path)
+        if path in self.files:
+            self.files[path] = (self.files[path][0], time.time())
+            self.files.move_to_end(path)
+        self.enforce()
+
+    def enforce(self):
+        """
+        Deletes the least recently used files that are not pinned, until the cache is within its budget
+        :return:
+        """
+        now = time.time()
+        for path, (size, last_used) in list(self.files.items()):
+            too_old = self.max_age is not None and now - last_used > self.max_age
+            if self.total_bytes <= self.max_bytes and not too_old:
+                # The other files were used more recently, so they are within budget as well
+                break
+            if path in self.pinned:
+                continue
+
+            del self.files[path]
+            self.total_bytes -= size
+            remove_file(path)
+            metrics.increment("audio_cache_evictions_total")
+
+        metrics.set("audio_cache_bytes", self.total_bytes)
+
+    @staticmethod
+    def remove(paths: list[str]):
+        """
+        Deletes files that are not needed anymore, such as the segment files of a job that is done
+        :param paths: The paths of the files
+        :return:
+        """
+        for path in paths:
+            remove_file(path)
+
+
+def remove_file(path: Optional[str]):
+    if not path:
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+# The audio cache of this process
+audio_cache = AudioCache()
@@ -0,0 +1,205 @@
+import hashlib
+import os
+from collections import OrderedDict
+from typing import Optional
+import torch
+from Monitoring.Metrics import metrics
+
+# Max size of the results kept in memory by each cache
+CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+# Max size of the results kept on disk by each cache
+CACHE_DISK_BYTES = 1024 * 1024 * 1024
+# Where the on-disk tier is kept, set to None to only cache in memory
+CACHE_DIRECTORY: Optional[str] = "cache"
+# When a shard of the on-disk tier is over its share of the budget, it is cut down to this share of it, so the shard only
+# has to be scanned now and then
+CACHE_DISK_LOW_WATER = 0.9
+# The on-disk tier is split into shard directories by the first hex digits of the key (like the uploads in the audio
+# cache), so no directory ends up with a huge number of files and only one shard is scanned at a time
+CACHE_SHARD_PREFIX_LENGTH = 2
+
+
+class ResultCache:
+    """
+    Content-addressed cache of model results (embeddings, transcriptions), keyed by a hash of the audio samples and the
+    id of the model. Results are kept in an in-memory LRU tier, and optionally in an on-disk tier that survives
+    restarts and is shared between worker processes. Both tiers evict the least recently used results when they are
+    over their size budget.
+
+    On disk, results are found by their file, so the results that other processes wrote are found as well. The keys
+    are hashes, so every shard directory gets an equal share of the budget. Every process keeps an estimate of the size
+    of each shard: the size at its last scan plus what the process wrote since. Once the estimate is over the share of
+    the shard, the shard is scanned (with the modification time as last use, which a hit updates) and cut down, so the
+    budget holds for the files of all processes together, give or take what the others wrote since the last scan.
+    """
+
+    def __init__(self, model_id: str, max_memory_bytes=CACHE_MEMORY_BYTES, disk_directory: Optional[str] = None,
+                 max_disk_bytes=CACHE_DISK_BYTES):
+        self.model_id = model_id
+        self.max_memory_bytes = max_memory_bytes
+        self.disk_directory = disk_directory
+        self.max_disk_bytes = max_disk_bytes
+
+        # Results in memory by key, least recently used first, with their size
+        self.memory: OrderedDict[str, tuple] = OrderedDict()
+        self.memory_bytes = 0
+        # Estimated size of the shards on disk that we have written to, see evict_shard
+        self.shard_bytes: dict[str, int] = {}
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_directory:
+            os.makedirs(self.disk_directory, exist_ok=True)
+            self.remove_unsharded()
+
+    def key(self, waveform: torch.Tensor) -> str:
+        """
+        Gets the key of the result for some audio
+        :param waveform: The waveform that the model is run on
+        :return: Hash of the model id and the samples
+        """
+        samples = waveform.detach().cpu().contiguous().numpy()
+        digest = hashlib.blake2b(self.model_id.encode("utf-8"), digest_size=20)
+        digest.update(str(samples.dtype).encode("utf-8"))
+        digest.update(samples.tobytes())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        """
+        Gets a result from the cache
+        :param key: The key, see key
+        :return: The result, or None if it's not cached
+        """
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            metrics.increment("cache_requests_total", model=self.model_id, result="hit")
+            return self.memory[key][0]
+
+        if self.disk_directory:
+            try:
+                value = torch.load(self.disk_file(key))
+                os.utime(self.disk_file(key))
+            except (FileNotFoundError, EOFError, RuntimeError):
+                # Not cached, evicted or being written by another worker
+                pass
+            else:
+                self.put_memory(key, value)
+                self.hits += 1
+                self.disk_hits += 1
+                metrics.increment("cache_requests_total", model=self.model_id, result="disk_hit")
+                return value
+
+        self.misses += 1
+        metrics.increment("cache_requests_total", model=self.model_id, result="miss")
+        return None
+
+    def put(self, key: str, value):
+        """
+        Adds a result to the cache
+        :param key: The key, see key
+        :param value: The result, a tensor or a string
+        :return:
+        """
+        self.put_memory(key, value)
+
+        # Another worker may have written the same result already
+        if not self.disk_directory or os.path.exists(self.disk_file(key)):
+            return
+        os.makedirs(os.path.dirname(self.disk_file(key)), exist_ok=True)
+        # Write to a temporary file first, so other workers never load a partial result
+        temporary_file = f"{self.disk_file(key)}.{os.getpid()}.tmp"
+        torch.save(value, temporary_file)
+        os.replace(temporary_file, self.disk_file(key))
+
+        shard = key[:CACHE_SHARD_PREFIX_LENGTH]
+        if shard in self.shard_bytes:
+            self.shard_bytes[shard] += os.path.getsize(self.disk_file(key))
+        if shard not in self.shard_bytes or self.shard_bytes[shard] > self.max_shard_bytes():
+            self.evict_shard(shard)
+
+    def max_shard_bytes(self) -> float:
+        return self.max_disk_bytes / 16 ** CACHE_SHARD_PREFIX_LENGTH
+
+    def evict_shard(self, shard: str):
+        """
+        Scans a shard of the on-disk tier, including the results of the other worker processes, and deletes the least
+        recently used results if it is over its share of the budget, until it is below CACHE_DISK_LOW_WATER of it
+        :param shard: The shard, the first CACHE_SHARD_PREFIX_LENGTH digits of the keys in it
+        :return:
+        """
+        entries = []
+        for entry in os.scandir(os.path.join(self.disk_directory, shard)):
+            if not entry.name.endswith(".pt"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.path, stat.st_size))
+
+        shard_bytes = sum(size for _, _, size in entries)
+        if shard_bytes > self.max_shard_bytes():
+            entries.sort()
+            for _, path, size in entries[:-1]:
+                if shard_bytes <= self.max_shard_bytes() * CACHE_DISK_LOW_WATER:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                shard_bytes -= size
+        self.shard_bytes[shard] = shard_bytes
+
+    def remove_unsharded(self):
+        """
+        Deletes the results that an older version wrote to the top of the directory, before it was split into shards
+        :return:
+        """
+        for entry in os.scandir(self.disk_directory):
+            if entry.name.endswith(".pt") and entry.is_file():
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def put_memory(self, key: str, value):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+
+        if isinstance(value, torch.Tensor):
+            # Don't keep a view of a bigger tensor alive
+            value = value.detach().clone()
+            size = value.numel() * value.element_size()
+        else:
+            size = len(value)
+
+        self.memory[key] = (value, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+            evicted_key, (evicted_value, evicted_size) = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted_size
+
+    def disk_file(self, key: str) -> str:
+        return os.path.join(self.disk_directory, key[:CACHE_SHARD_PREFIX_LENGTH], f"{key}.pt")
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_entries": len(self.memory),
+            "memory_bytes": self.memory_bytes,
+            "disk_shards": len(self.shard_bytes),
+            "disk_bytes": sum(self.shard_bytes.values())
+        }
+
+
+def create_cache(name: str, model_id: str) -> ResultCache:
+    """
+    Creates a cache for a model, with its on-disk tier in CACHE_DIRECTORY/name
+    """
+    return ResultCache(model_id, disk_directory=os.path.join(CACHE_DIRECTORY, name) if CACHE_DIRECTORY else None)
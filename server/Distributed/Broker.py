@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Optional
+import zmq
+import zmq.asyncio
+from Messaging.WorkerProtocol import build_worker_message, parse_worker_message, HEARTBEAT_INTERVAL, \
+    HEARTBEAT_LIVENESS
+from Monitoring.Metrics import metrics
+from SpeakerRecognition.SpeakerStore import SpeakerStore, add_to_centroid
+
+# Number of workers a job may be sent to, a job that keeps killing workers is failed after this
+MAX_JOB_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class BrokerJob:
+    def __init__(self, job_type: str, payload: bytes, data: dict):
+        self.job_id = uuid.uuid4().hex
+        self.job_type = job_type
+        self.payload = payload
+        self.data = data
+        self.attempts = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class WorkerState:
+    def __init__(self, identity: bytes, worker_id: str, capacity: int):
+        self.identity = identity
+        self.worker_id = worker_id
+        self.capacity = capacity
+        # Jobs that were sent to the worker and are not done yet, by job id
+        self.jobs: dict[str, BrokerJob] = {}
+        # How far the worker is in the log of speaker changes, see Broker.speaker_log
+        self.speaker_version = 0
+        self.expiry = 0.0
+        self.refresh()
+
+    def refresh(self):
+        self.expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+
+
+class Broker:
+    """
+    Distributes jobs to worker processes on this host or on other hosts, see Distributed.Worker. Workers connect to the
+    ROUTER socket of the broker, register themselves with the number of jobs they can run at once, and heartbeat. Jobs
+    go to the worker that has been waiting the longest for a job (load balancing). If a worker stops heartbeating, its
+    jobs are queued again for the other workers.
+
+    The broker is the only writer of the speaker store: workers compute the embeddings of enrollments, and the broker
+    appends them to its store. Every job carries the changes to the store that its worker hasn't seen yet, so all
+    workers recognize the same speakers.
+    """
+
+    def __init__(self, address: str, speakers_directory="speakers"):
+        self.address = address
+        self.context = zmq.asyncio.Context()
+        self.socket: Optional[zmq.asyncio.Socket] = None
+
+        # Registered workers by identity, the one that has been waiting the longest for a job first
+        self.workers: OrderedDict[bytes, WorkerState] = OrderedDict()
+        # Jobs waiting for a worker
+        self.queue: deque[BrokerJob] = deque()
+
+        self.store = SpeakerStore(speakers_directory)
+        # The rows of the speaker store in the order they changed, workers are sent the changes after their version
+        self.speaker_log: list[int] = []
+
+    async def start(self):
+        self.socket = self.context.socket(zmq.ROUTER)
+        # A worker that reconnects keeps its identity, the new connection replaces the old one
+        self.socket.setsockopt(zmq.ROUTER_HANDOVER, 1)
+        self.socket.bind(self.address)
+        self.refresh_speakers()
+        asyncio.create_task(self.receive())
+        asyncio.create_task(self.heartbeat())
+        logger.info(f"Broker listening for workers on {self.address}")
+
+    async def submit(self, job_type: str, payload: bytes, data: dict) -> dict:
+        """
+        Runs a job on a worker
+        :param job_type: meeting, enroll or window
+        :param payload: The audio of the job
+        :param data: The parameters of the job, e.g. the speaker to enroll
+        :return: The result of the job
+        """
+        job = BrokerJob(job_type, payload, data)
+        self.queue.append(job)
+        metrics.set("job_queue_depth", len(self.queue))
+        self.dispatch()
+        return await job.future
+
+    def dispatch(self):
+        """
+        Sends the queued jobs to the workers that have room for them
+        :return:
+        """
+        if self.queue:
+            self.refresh_speakers()
+
+        while self.queue:
+            worker = next((worker for worker in self.workers.values() if len(worker.jobs) < worker.capacity), None)
+            if worker is None:
+                break
+
+            job = self.queue.popleft()
+            job.attempts += 1
+            worker.jobs[job.job_id] = job
+            # The worker goes to the back of the line
+            self.workers.move_to_end(worker.identity)
+
+            self.socket.send_multipart([worker.identity] + build_worker_message(
+                "job", job.payload, job_id=job.job_id, job_type=job.job_type, data=job.data,
+                speaker_updates=self.get_speaker_updates(worker.speaker_version)))
+            worker.speaker_version = len(self.speaker_log)
+            logger.debug("Sent %s job %s to worker %s", job.job_type, job.job_id, worker.worker_id)
+        metrics.set("job_queue_depth", len(self.queue))
+
+    async def receive(self):
+        while True:
+            identity, *frames = await self.socket.recv_multipart(copy=False)
+            identity = identity.bytes
+            try:
+                header, payload = parse_worker_message(frames)
+            except ValueError as e:
+                logger.warning(f"Invalid message from worker: {e}")
+                continue
+
+            worker = self.workers.get(identity)
+            if header["type"] == "ready":
+                if worker:
+                    # The worker restarted or reconnected, whatever it was doing is lost
+                    self.requeue(worker)
+                # The worker gets every speaker with its first job, it skips the ones it already has
+                worker = WorkerState(identity, header.get("worker_id", identity.hex()), header.get("capacity", 1))
+                self.workers[identity] = worker
+                logger.info(f"Worker {worker.worker_id} registered with capacity {worker.capacity}")
+            elif worker is None:
+                # We forgot about the worker (it was too slow to heartbeat), it has to register again
+                self.socket.send_multipart([identity] + build_worker_message("heartbeat", reregister=True))
+                continue
+            elif header["type"] == "result":
+                self.complete(worker, header)
+
+            worker.refresh()
+            self.dispatch()
+
+    def complete(self, worker: WorkerState, header: dict):
+        job = worker.jobs.pop(header["job_id"], None)
+        if job is None:
+            # A late result of a job that was already given to another worker
+            return
+        if header.get("metrics"):
+            metrics.merge(header["metrics"])
+        if job.future.done():
+            return
+        if header.get("error"):
+            job.future.set_exception(RuntimeError(f"Worker {worker.worker_id} failed: {header['error']}"))
+        else:
+            job.future.set_result(header.get("result") or {})
+
+    def requeue(self, worker: WorkerState):
+        """
+        Queues the jobs of a worker again, in front of the other jobs since they have waited the longest
+        :param worker: The worker, which is dead or restarted
+        :return:
+        """
+        for job in reversed(list(worker.jobs.values())):
+            if job.attempts >= MAX_JOB_ATTEMPTS:
+                logger.error(f"Job {job.job_id} failed on {job.attempts} workers, giving up")
+                if not job.future.done():
+                    job.future.set_exception(RuntimeError(f"Job failed on {job.attempts} workers"))
+                continue
+            logger.warning(f"Requeueing job {job.job_id} of worker {worker.worker_id}")
+            metrics.increment("jobs_requeued_total")
+            self.queue.appendleft(job)
+        worker.jobs.clear()
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            for identity, worker in list(self.workers.items()):
+                if worker.expiry < now:
+                    logger.warning(f"Worker {worker.worker_id} stopped responding")
+                    del self.workers[identity]
+                    self.requeue(worker)
+                else:
+                    self.socket.send_multipart([identity] + build_worker_message("heartbeat"))
+            metrics.set("workers", len(self.workers))
+            self.dispatch()
+
+    def refresh_speakers(self):
+        # Rows that were written by someone else, e.g. by migrating an old speakers file
+        self.speaker_log += self.store.pop_changed_rows()
+
+    def get_speaker_updates(self, version: int) -> list[dict]:
+        """
+        Gets the changes to the speaker store after a version
+        :param version: The number of changes that were seen already
+        :return: The latest record and embedding of every row that changed, in the order of the changes
+        """
+        rows = list(dict.fromkeys(self.speaker_log[version:]))
+        return [{"record": self.store.records[row], "embedding": self.store.get_embedding(row).tolist()}
+                for row in rows]
+
+    async def enroll(self, name: str, audio_file: str, embedding: list) -> int:
+        """
+        Adds a speaker to the speaker store, the workers pick it up with their next job. A speaker that is already
+        enrolled gets the embedding added to its mean embedding, see SpeakerStore.add_to_centroid.
+        :param name: The name of the speaker
+        :param audio_file: The enrollment audio, which is kept with a new speaker
+        :param embedding: The embedding of the clip, as computed by a worker
+        :return: The row of the speaker in the store
+        """
+        self.refresh_speakers()
+        speaker_id = str(uuid.uuid4())
+        speaker_audio_file = None
+        if self.store.find(name) is None:
+            os.makedirs(self.store.directory, exist_ok=True)
+            speaker_audio_file = os.path.join(self.store.directory, f"{speaker_id}.wav")
+            await asyncio.to_thread(shutil.copyfile, audio_file, speaker_audio_file)
+
+        # The speaker is looked up again while the store is locked, someone else may have enrolled it in the meantime
+        centroid, samples = add_to_centroid(None, 0, embedding)
+        row = self.store.merge_many([({"name": name, "speaker_id": speaker_id, "audio_file": speaker_audio_file},
+                                      centroid, samples)])[0]
+        record = self.store.records[row]
+        if speaker_audio_file is not None and record["audio_file"] != speaker_audio_file:
+            os.remove(speaker_audio_file)
+        self.speaker_log.append(row)
+        logger.info(f"Enrolled a clip of speaker {name} in row {row}, {record['samples']} clips in total")
+        return row
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close(linger=0)
+        self.context.term()
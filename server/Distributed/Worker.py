@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+import zmq
+import zmq.asyncio
+from Messaging.WorkerProtocol import build_worker_message, parse_worker_message, HEARTBEAT_INTERVAL, \
+    HEARTBEAT_LIVENESS
+from Monitoring.Metrics import metrics
+from SpeakerRecognition.SpeakerStore import SpeakerStore
+
+logger = logging.getLogger(__name__)
+
+
+class Worker:
+    """
+    Runs the jobs of a broker, see Distributed.Broker. The worker connects to the broker, registers itself, heartbeats,
+    and reconnects if it doesn't hear from the broker for a while. Jobs run in threads, so the worker keeps
+    heartbeating while the models are busy. The jobs share the models, the speaker index and the result caches of the
+    process, which are not thread safe, so only one job runs at a time. With a capacity above 1 the next jobs are
+    received while one is running, and wait for it.
+
+    Before a job runs, the speakers that were enrolled since the previous job are written to the local speaker store,
+    where the models pick them up like any other speaker.
+    """
+
+    def __init__(self, broker_address: str, handle_job: Callable[[str, memoryview, dict], Awaitable[dict]],
+                 capacity=1, speakers_directory="speakers"):
+        """
+        :param broker_address: The address of the broker, e.g. tcp://localhost:5557
+        :param handle_job: Runs a job given its type, audio and parameters, and returns its result
+        :param capacity: The number of jobs that the broker sends at the same time, they run one after the other
+        :param speakers_directory: The directory of the local speaker store
+        """
+        self.broker_address = broker_address
+        self.handle_job = handle_job
+        self.capacity = capacity
+        # The same identity after a reconnect, so the broker knows the jobs it sent before are lost
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+        self.context = zmq.asyncio.Context()
+        self.socket: Optional[zmq.asyncio.Socket] = None
+        self.executor = ThreadPoolExecutor(max_workers=capacity)
+        # Held by the job that is running, see run_job_thread
+        self.job_lock = threading.Lock()
+        # Running jobs, so they are not garbage collected
+        self.tasks: set[asyncio.Task] = set()
+        self.store = SpeakerStore(speakers_directory)
+        self.broker_expiry = 0.0
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.close(linger=0)
+        self.socket = self.context.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.IDENTITY, self.worker_id.encode("utf-8"))
+        self.socket.connect(self.broker_address)
+        self.broker_expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+        self.send_ready()
+        logger.info(f"Worker {self.worker_id} connected to broker {self.broker_address}")
+
+    def send_ready(self):
+        self.socket.send_multipart(build_worker_message("ready", worker_id=self.worker_id, capacity=self.capacity))
+
+    async def run(self):
+        self.connect()
+        next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+        while True:
+            if await self.socket.poll(HEARTBEAT_INTERVAL * 1000):
+                frames = await self.socket.recv_multipart(copy=False)
+                try:
+                    header, payload = parse_worker_message(frames)
+                except ValueError as e:
+                    logger.warning(f"Invalid message from broker: {e}")
+                    continue
+
+                self.broker_expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+                if header["type"] == "job":
+                    task = asyncio.create_task(self.run_job(header, payload))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                elif header["type"] == "heartbeat" and header.get("reregister"):
+                    self.send_ready()
+
+            if time.monotonic() > self.broker_expiry:
+                logger.warning(f"Broker {self.broker_address} stopped responding, reconnecting...")
+                self.connect()
+
+            if time.monotonic() >= next_heartbeat:
+                self.socket.send_multipart(build_worker_message("heartbeat"))
+                next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+    async def run_job(self, header: dict, payload: memoryview):
+        job_id, job_type = header["job_id"], header["job_type"]
+        logger.info(f"Running {job_type} job {job_id}")
+        result = None
+        error = None
+        try:
+            self.apply_speaker_updates(header.get("speaker_updates", []))
+            loop = asyncio.get_running_loop()
+            result = await loop.run_in_executor(self.executor, self.run_job_thread, job_type, payload,
+                                                header.get("data", {}))
+        except Exception as e:
+            logger.exception(f"An error occurred while running job {job_id}: {e}")
+            error = str(e)
+
+        self.socket.send_multipart(build_worker_message("result", job_id=job_id, result=result, error=error,
+                                                        metrics=metrics.drain()))
+
+    def run_job_thread(self, job_type: str, payload: memoryview, data: dict) -> dict:
+        # Every thread gets its own event loop, the one of the worker keeps heartbeating
+        with self.job_lock:
+            return asyncio.run(self.handle_job(job_type, payload, data))
+
+    def apply_speaker_updates(self, updates: list[dict]):
+        """
+        Writes the speakers that were enrolled or updated on the broker to the local speaker store. If the worker shares
+        the speaker store with the broker (same host), the records are already there and nothing is written.
+        :param updates: The record and embedding of every changed row, see Broker.get_speaker_updates
+        :return:
+        """
+        self.store.refresh()
+        for update in updates:
+            record = update["record"]
+            if self.store.records.get(record["row"]) == record:
+                continue
+            self.store.update(record["row"], {key: value for key, value in record.items()
+                                              if key not in ("row", "embedding_size")}, update["embedding"])
+            logger.info(f"Updated speaker {record['name']} from the broker")
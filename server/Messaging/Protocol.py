@@ -0,0 +1,136 @@
+import json
+import re
+import uuid
+
+# Version 1: multipart messages of a JSON header frame and an audio frame, see parse_message
+PROTOCOL_VERSION = 1
+# fetch asks for the result of a job, its audio frame is empty
+MESSAGE_TYPES = ("meeting", "enroll", "stream", "stream-end", "fetch")
+CODECS = ("wav", "flac", "pcm")
+# Job ids are used in file names, so they can't contain anything but these
+JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def parse_message(frames: list) -> tuple[dict, memoryview]:
+    """
+    Parses a received message. A message has two frames:
+    - A JSON header with version, type, speaker, sample_rate, codec, job_id and, for streams, sequence
+    - The audio, whose format is given by codec (a WAV or FLAC file, or raw 16-bit PCM for streams)
+
+    Messages with a single frame are parsed as the old type:speaker:audio format, for clients that aren't updated yet.
+    :param frames: The frames of the message, received with copy=False
+    :return: Tuple of the header and the audio. The audio is a view of the received frame, it is not copied.
+    """
+    if len(frames) == 1:
+        return parse_legacy_message(frames[0].bytes)
+    if len(frames) != 2:
+        raise ValueError(f"Invalid message with {len(frames)} frames")
+
+    try:
+        header = json.loads(frames[0].bytes)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError(f"Invalid message header {frames[0].bytes[:64]}")
+    if not isinstance(header, dict):
+        raise ValueError(f"Invalid message header {header}")
+
+    if header.get("version") != PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported protocol version {header.get('version')}, expected {PROTOCOL_VERSION}")
+    if header.get("type") not in MESSAGE_TYPES:
+        raise ValueError(f"Invalid message type {header.get('type')}")
+    is_stream = header["type"] in ("stream", "stream-end")
+    # Raw PCM has no header with its format, only streams agree on it up front (16-bit mono at sample_rate), and the
+    # chunks of a stream are always raw PCM
+    header.setdefault("codec", "pcm" if is_stream else "wav")
+    if header["codec"] not in CODECS:
+        raise ValueError(f"Unsupported codec {header['codec']}")
+    if is_stream and header["codec"] != "pcm":
+        raise ValueError(f"Stream messages need codec pcm, not {header['codec']}")
+    if header["codec"] == "pcm" and not is_stream:
+        raise ValueError(f"Codec pcm is only supported for streams, not for {header['type']} messages")
+    sample_rate = header.get("sample_rate", 16000)
+    # bool is an int as well
+    if not isinstance(sample_rate, int) or isinstance(sample_rate, bool) or sample_rate <= 0:
+        raise ValueError(f"Invalid sample rate {sample_rate}")
+    if not isinstance(header.get("speaker"), (str, type(None))):
+        raise ValueError(f"Invalid speaker {header.get('speaker')}")
+    if header["type"] == "enroll" and not header.get("speaker"):
+        raise ValueError("No speaker provided for enrollment")
+    sequence = header.get("sequence")
+    if is_stream and (not header.get("job_id") or not isinstance(sequence, int) or isinstance(sequence, bool) or
+                      sequence < 0):
+        raise ValueError("Stream messages need a job_id and a sequence number that is not negative")
+    if header["type"] == "fetch" and not header.get("job_id"):
+        raise ValueError("No job id provided to fetch")
+
+    header.setdefault("sample_rate", 16000)
+    header.setdefault("speaker", None)
+    if not header.get("job_id"):
+        header["job_id"] = str(uuid.uuid4())
+    if not JOB_ID_PATTERN.match(str(header["job_id"])):
+        raise ValueError(f"Invalid job id {header['job_id']}")
+
+    return header, frames[1].buffer
+
+
+def parse_legacy_message(message: bytes) -> tuple[dict, memoryview]:
+    """
+    Parses a message in the old format, type:speaker:audio, or stream:session_id:sequence:pcm for streams
+    """
+    message_type = message.split(b':', 1)[0].decode("utf-8", errors="replace")
+    if message_type not in MESSAGE_TYPES or message_type == "fetch":
+        raise ValueError(f"Invalid message {message[:64]}")
+
+    # Only split off the header fields, the audio may contain colons
+    if message_type in ("stream", "stream-end"):
+        fields = message.split(b':', 3)
+        if len(fields) != 4 or not fields[2].isdigit() or not JOB_ID_PATTERN.match(fields[1].decode("utf-8")):
+            raise ValueError(f"Invalid stream message {message[:64]}")
+        header = {"type": message_type, "speaker": None, "job_id": fields[1].decode("utf-8"),
+                  "sequence": int(fields[2]), "codec": "pcm"}
+        audio = fields[3]
+    else:
+        fields = message.split(b':', 2)
+        if len(fields) != 3:
+            raise ValueError(f"Invalid message {message[:64]}")
+        header = {"type": message_type, "speaker": fields[1].decode("utf-8") or None, "job_id": str(uuid.uuid4()),
+                  "codec": "wav"}
+        audio = fields[2]
+        if message_type == "enroll" and not header["speaker"]:
+            raise ValueError("No speaker provided for enrollment")
+
+    header["version"] = 0
+    header["sample_rate"] = 16000
+    return header, memoryview(audio)
+
+
+def peek_header(frames: list) -> dict:
+    """
+    Reads the job id and sequence number of a message that could not be parsed, so the rejection can still be matched
+    to it by the client
+    """
+    try:
+        header = json.loads(frames[0].bytes)
+    except (json.JSONDecodeError, UnicodeDecodeError, IndexError):
+        return {}
+    if not isinstance(header, dict):
+        return {}
+    return {"job_id": header.get("job_id"), "sequence": header.get("sequence")}
+
+
+def build_acknowledgement(header: dict, error=None, result=None) -> bytes:
+    """
+    Builds the reply to a message, which tells the client that the message was received and handled. The job id in the
+    reply is the id the client can fetch the result of its job with.
+    :param header: The header of the message, may be empty if the message could not be parsed
+    :param error: The reason the message was rejected, if it was
+    :param result: The job that was fetched, see Storage.ResultStore.get
+    :return: The JSON reply frame
+    """
+    return json.dumps({
+        "version": PROTOCOL_VERSION,
+        "type": "ack",
+        "job_id": header.get("job_id"),
+        "sequence": header.get("sequence"),
+        "error": error,
+        "result": result
+    }).encode("utf-8")
@@ -0,0 +1,44 @@
+import json
+
+# Messages between the broker and its workers, see Distributed.Broker and Distributed.Worker. Every message has a JSON
+# header frame and a payload frame (the audio of a job, empty for the other types).
+WORKER_PROTOCOL_VERSION = 1
+# Worker to broker: ready registers the worker, result answers a job. Both directions: heartbeat.
+WORKER_MESSAGE_TYPES = ("ready", "heartbeat", "job", "result")
+# Seconds between heartbeats, in both directions
+HEARTBEAT_INTERVAL = 1.0
+# Number of heartbeats that may be missed before the other side is considered dead
+HEARTBEAT_LIVENESS = 5
+
+
+def build_worker_message(message_type: str, payload=b"", **fields) -> list:
+    """
+    Builds a message between the broker and a worker
+    :param message_type: The type of the message, see WORKER_MESSAGE_TYPES
+    :param payload: The payload frame
+    :param fields: The other fields of the header, must be JSON serializable
+    :return: The frames of the message
+    """
+    header = {"version": WORKER_PROTOCOL_VERSION, "type": message_type, **fields}
+    return [json.dumps(header).encode("utf-8"), payload]
+
+
+def parse_worker_message(frames: list) -> tuple[dict, memoryview]:
+    """
+    Parses a message between the broker and a worker
+    :param frames: The frames of the message (without the identity frame of the ROUTER), received with copy=False
+    :return: Tuple of the header and the payload
+    """
+    if len(frames) != 2:
+        raise ValueError(f"Invalid worker message with {len(frames)} frames")
+    try:
+        header = json.loads(frames[0].bytes)
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise ValueError(f"Invalid worker message header {frames[0].bytes[:64]}")
+    if not isinstance(header, dict):
+        raise ValueError(f"Invalid worker message header {header}")
+    if header.get("version") != WORKER_PROTOCOL_VERSION:
+        raise ValueError(f"Unsupported worker protocol version {header.get('version')}")
+    if header.get("type") not in WORKER_MESSAGE_TYPES:
+        raise ValueError(f"Invalid worker message type {header.get('type')}")
+    return header, frames[1].buffer
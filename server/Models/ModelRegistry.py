@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from speechbrain.pretrained import EncoderDecoderASR, SpeakerRecognition
+
+# The pretrained models we use, by name. SpeakerRecognition is an EncoderClassifier as well, so one ECAPA model serves
+# both for embeddings and for verification.
+MODELS = {
+    "spkrec-ecapa-voxceleb": (SpeakerRecognition, "speechbrain/spkrec-ecapa-voxceleb"),
+    "asr-wav2vec2-commonvoice-en": (EncoderDecoderASR, "speechbrain/asr-wav2vec2-commonvoice-en"),
+    "asr-transformer-transformerlm-librispeech": (EncoderDecoderASR,
+                                                  "speechbrain/asr-transformer-transformerlm-librispeech"),
+}
+
+# The layers that are converted to int8 by quantize_model
+QUANTIZED_LAYERS = {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}
+
+# The loaded models by (name, quantized), every model is only loaded once per process
+models = {}
+model_locks = {name: threading.Lock() for name in MODELS}
+
+logger = logging.getLogger(__name__)
+
+
+def get_model(name: str, quantized=False):
+    """
+    Gets a pretrained model, loading it the first time
+    :param name: The name of the model, see MODELS
+    :param quantized: Get the int8 version of the model, see quantize_model
+    :return: The model
+    """
+    if name not in MODELS:
+        raise ValueError(f"Model {name} not supported")
+
+    with model_locks[name]:
+        if (name, quantized) not in models:
+            model_class, source = MODELS[name]
+            start = time.perf_counter()
+            model = model_class.from_hparams(source=source, savedir=f"pretrained_models/{name}")
+            if quantized:
+                quantize_model(model)
+            models[(name, quantized)] = model
+            logger.info(f"Loaded model {name}{' (int8)' if quantized else ''} in "
+                        f"{time.perf_counter() - start:.1f} seconds")
+    return models[(name, quantized)]
+
+
+def quantize_model(model):
+    """
+    Applies dynamic int8 quantization to the linear and recurrent layers of a model: their weights are stored as int8,
+    and the activations are quantized on the fly. This only speeds up inference on the CPU.
+    :param model: The pretrained model, its modules are replaced in place
+    :return:
+    """
+    torch.quantization.quantize_dynamic(model.mods, QUANTIZED_LAYERS, dtype=torch.qint8, inplace=True)
+
+
+def preload_models(names: list[str], parallel=True, quantized=False):
+    """
+    Loads the models up front, so the first request doesn't have to wait for them
+    :param names: The names of the models to load
+    :param parallel: Load the models at the same time, in threads
+    :param quantized: Load the int8 versions of the models
+    :return:
+    """
+    if parallel and len(names) > 1:
+        with ThreadPoolExecutor(max_workers=len(names)) as executor:
+            # list() to raise any exception that happened while loading
+            list(executor.map(lambda name: get_model(name, quantized), names))
+    else:
+        for name in names:
+            get_model(name, quantized)
+
+
+def warm_up_models(names: list[str], sample_rate=16000, quantized=False):
+    """
+    Runs every model once on a second of silence, so lazy initialization (allocations, kernel selection...) happens
+    now instead of in the first request
+    :param names: The names of the models to warm up
+    :param sample_rate: The sample rate the models expect
+    :param quantized: Warm up the int8 versions of the models
+    :return:
+    """
+    batch = torch.zeros(1, sample_rate)
+    lengths = torch.tensor([1.0])
+    for name in names:
+        start = time.perf_counter()
+        model = get_model(name, quantized)
+        with torch.inference_mode():
+            if isinstance(model, EncoderDecoderASR):
+                model.transcribe_batch(batch, lengths)
+            else:
+                model.encode_batch(batch, lengths)
+        logger.info(f"Warmed up model {name} in {time.perf_counter() - start:.1f} seconds")
@@ -0,0 +1,200 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+# Prefix of the name of every metric
+METRICS_PREFIX = "meeting_server_"
+# Upper bounds of the histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+# The metrics of the server, with their type and description
+METRICS = {
+    "messages_received_total": ("counter", "Messages received from clients, by type"),
+    "bytes_received_total": ("counter", "Bytes of audio received from clients, by type"),
+    "messages_rejected_total": ("counter", "Messages that could not be parsed or handled"),
+    "job_queue_depth": ("gauge", "Jobs waiting for a worker"),
+    "stream_sessions": ("gauge", "Live meetings that are being streamed"),
+    "jobs_total": ("counter", "Jobs run by the workers, by type and status"),
+    "job_seconds": ("histogram", "Seconds from a worker picking up a job until it is done, by type"),
+    "stage_seconds": ("histogram", "Seconds spent in each stage of processing a meeting"),
+    "audio_seconds_total": ("counter", "Seconds of audio processed, by type"),
+    "inference_seconds": ("histogram", "Seconds per forward pass of a model"),
+    "inference_clips_total": ("counter", "Audio clips that went through a model"),
+    "cache_requests_total": ("counter", "Result cache lookups, by model and result (hit, disk_hit or miss)"),
+    "audio_cache_bytes": ("gauge", "Bytes of uploaded audio on disk"),
+    "audio_cache_evictions_total": ("counter", "Uploaded audio files deleted to stay within the audio cache budget"),
+    "workers": ("gauge", "Workers registered with the broker"),
+    "jobs_requeued_total": ("counter", "Jobs sent to another worker because their worker stopped responding"),
+}
+
+
+class Metrics:
+    """
+    Registry of counters, gauges and histograms, which can be rendered in the Prometheus text format.
+
+    The worker processes have a registry of their own. They send what changed with the result of every job (see drain),
+    and the server adds that to its registry (see merge), so the server can expose the metrics of all processes.
+    """
+
+    def __init__(self, prefix=METRICS_PREFIX, buckets=DEFAULT_BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        # The registry may be used from several threads, e.g. while the models are loaded in parallel
+        self.lock = threading.Lock()
+        # Values of the counters and gauges, by (name, labels)
+        self.values: dict[tuple, float] = {}
+        # Histograms by (name, labels), as the count in each bucket and in +Inf, followed by the sum and the count
+        self.histograms: dict[tuple, list] = {}
+
+    @staticmethod
+    def get_key(name: str, labels: dict) -> tuple:
+        if name not in METRICS:
+            raise ValueError(f"Unknown metric {name}")
+        return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+    def increment(self, name: str, value=1.0, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            self.values[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self.get_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 3)
+            histogram[bisect.bisect_left(self.buckets, value)] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """
+        Observes the seconds that the block takes
+        :param name: The name of the histogram
+        :param labels: The labels of the histogram
+        :return:
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self) -> dict:
+        """
+        Takes the counters and histograms that changed since the last drain, and resets them
+        :return: The changes, which can be sent to another process and added to its registry with merge
+        """
+        with self.lock:
+            # As lists of [name, labels, value], so the changes can be sent as JSON to a broker on another host
+            changes = {
+                "counters": [[name, labels, value] for (name, labels), value in self.values.items()
+                             if METRICS[name][0] == "counter"],
+                "histograms": [[name, labels, histogram] for (name, labels), histogram in self.histograms.items()]
+            }
+            self.values = {key: value for key, value in self.values.items() if METRICS[key[0]][0] != "counter"}
+            self.histograms = {}
+        return changes
+
+    def merge(self, changes: dict):
+        """
+        Adds the changes of another registry, see drain
+        :param changes: The changes
+        :return:
+        """
+        with self.lock:
+            for name, labels, value in changes["counters"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                self.values[key] = self.values.get(key, 0) + value
+            for name, labels, histogram in changes["histograms"]:
+                key = (name, tuple(tuple(label) for label in labels))
+                if key in self.histograms:
+                    self.histograms[key] = [a + b for a, b in zip(self.histograms[key], histogram)]
+                else:
+                    self.histograms[key] = list(histogram)
+
+    def render(self) -> str:
+        """
+        Renders the metrics in the Prometheus text format
+        https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+        :return: The metrics
+        """
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: list(histogram) for key, histogram in self.histograms.items()}
+
+        lines = []
+        for name, (metric_type, description) in METRICS.items():
+            full_name = self.prefix + name
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+
+            if metric_type != "histogram":
+                for (key_name, labels), value in sorted(values.items()):
+                    if key_name == name:
+                        lines.append(f"{full_name}{format_labels(labels)} {format_value(value)}")
+                continue
+
+            for (key_name, labels), histogram in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bucket, count in zip(list(self.buckets) + ["+Inf"], histogram[:-2]):
+                    cumulative += count
+                    lines.append(f"{full_name}_bucket{format_labels(labels + (('le', str(bucket)),))} {cumulative}")
+                lines.append(f"{full_name}_sum{format_labels(labels)} {format_value(histogram[-2])}")
+                lines.append(f"{full_name}_count{format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value: float) -> str:
+    # Counts and byte sizes stay exact, instead of being rounded to a few digits
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    escaped = [(label, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for label, value in labels]
+    return "{" + ",".join(f'{label}="{value}"' for label, value in escaped) + "}"
+
+
+async def serve_metrics(host: str, port: int, registry=None) -> asyncio.AbstractServer:
+    """
+    Serves the metrics over HTTP, such that Prometheus can scrape them from any path
+    :param host: The address to listen on, keep it local unless the metrics should be public
+    :param port: The port to listen on
+    :param registry: The registry to serve, the metrics of this process by default
+    :return: The server, which keeps serving in the background
+    """
+    registry = registry or metrics
+
+    async def handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # We answer every request the same way, so only read the request until the end of the headers
+            await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+            body = registry.render().encode("utf-8")
+            writer.write(b"HTTP/1.1 200 OK\r\n"
+                         b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         b"Content-Length: " + str(len(body)).encode("ascii") + b"\r\n"
+                         b"Connection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle_request, host, port)
+
+
+# The metrics of this process
+metrics = Metrics()
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+import logging
+import os
+from .SpeechBrain import SpeechBrain
+
+# Clips per call of enroll_batch, the waveforms of all clips of a batch are in memory at the same time
+BULK_ENROLLMENT_BATCH_SIZE = 64
+# The files that are enrolled, anything else in the directory is skipped
+AUDIO_EXTENSIONS = (".wav", ".flac")
+
+logger = logging.getLogger(__name__)
+
+
+def find_clips(directory: str) -> list[tuple[str, str]]:
+    """
+    Finds the enrollment clips in a directory. Every subdirectory is a speaker, with any number of clips of that speaker
+    in it. A clip directly in the directory is a speaker of its own, named after the file.
+    :param directory: The directory with the clips
+    :return: (speaker name, audio file) of every clip, sorted by name
+    """
+    clips = []
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.is_dir():
+            clips += [(entry.name, os.path.join(entry.path, name)) for name in sorted(os.listdir(entry.path))
+                      if name.lower().endswith(AUDIO_EXTENSIONS)]
+        elif entry.name.lower().endswith(AUDIO_EXTENSIONS):
+            clips.append((os.path.splitext(entry.name)[0], entry.path))
+    return clips
+
+
+async def enroll_clips(clips: list[tuple[str, str]], batch_size=BULK_ENROLLMENT_BATCH_SIZE,
+                       fast_inference=False) -> int:
+    """
+    Enrolls clips in batches, every batch is embedded in batched forward passes and written to the speaker store at
+    once. Speakers that are already enrolled get the new clips added to their embeddings.
+    :param clips: (speaker name, audio file) of every clip
+    :param batch_size: The number of clips per batch
+    :param fast_inference: Use the int8 version of the model, see SpeechBrain
+    :return: The number of speakers that were enrolled or updated
+    """
+    speaker = SpeechBrain(fast_inference=fast_inference)
+    await speaker.load()
+
+    names = set()
+    for i in range(0, len(clips), batch_size):
+        batch = clips[i:i + batch_size]
+        names.update(enrolled.name for enrolled in await speaker.enroll_batch(batch))
+        await speaker.save()
+        logger.info(f"Enrolled {min(i + batch_size, len(clips))} of {len(clips)} clips")
+    return len(names)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Enrolls many speakers at once, run from the server directory such "
+                                                 "that the speakers are added to its speaker store")
+    parser.add_argument("directory", help="Directory with a subdirectory of clips for every speaker, or a clip per "
+                                          "speaker named after the speaker")
+    parser.add_argument("--batch-size", type=int, default=BULK_ENROLLMENT_BATCH_SIZE,
+                        help="Number of clips that are embedded and saved at once")
+    parser.add_argument("--fast", action="store_true", help="Use the int8 version of the model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    clips = find_clips(args.directory)
+    if not clips:
+        print(f"No clips found in {args.directory}")
+        return
+    speakers = asyncio.run(enroll_clips(clips, args.batch_size, args.fast))
+    print(f"Enrolled {len(clips)} clips of {speakers} speakers")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import argparse
+import logging
+import uuid
+from collections import Counter
+from typing import Optional
+import torch
+from Storage.ResultStore import ResultStore, results
+from .SpeakerStore import SpeakerStore
+
+# Segments of the same unknown speaker are above this mean cosine similarity, see cluster_embeddings
+GUEST_SIMILARITY_THRESHOLD = 0.3
+# The name of the n-th guest of a meeting
+GUEST_NAME = "Guest {}"
+
+logger = logging.getLogger(__name__)
+
+
+def cluster_embeddings(embeddings: torch.Tensor, threshold=GUEST_SIMILARITY_THRESHOLD) -> list[int]:
+    """
+    Clusters embeddings agglomeratively with average linkage: starting with a cluster per embedding, the two clusters
+    with the highest mean pairwise cosine similarity are merged until no two clusters are above threshold. The pairwise
+    similarities are computed in a single matrix product. A merge updates the row of the merged cluster in one
+    vectorized step (Lance-Williams), and the best match of every row is kept up to date, so finding the next merge
+    doesn't search the whole matrix and nothing loops over pairs.
+    :param embeddings: The embeddings, with shape [num_embeddings, ..., embedding_size]
+    :param threshold: The mean cosine similarity above which two clusters are merged
+    :return: The cluster of every embedding, numbered in the order in which the clusters first appear
+    """
+    num_embeddings = embeddings.shape[0]
+    if num_embeddings == 0:
+        return []
+
+    embeddings = torch.nn.functional.normalize(embeddings.reshape(num_embeddings, -1).float(), dim=-1)
+    similarity = embeddings @ embeddings.T
+    similarity.fill_diagonal_(-torch.inf)
+    sizes = torch.ones(num_embeddings)
+    # The cluster in every row of the similarity matrix, the rows of merged clusters are dropped now and then
+    row_clusters = torch.arange(num_embeddings)
+    clusters = torch.arange(num_embeddings)
+    best_similarity, best_match = similarity.max(dim=1)
+    num_clusters = num_embeddings
+
+    while True:
+        a = int(torch.argmax(best_similarity))
+        if best_similarity[a] <= threshold:
+            break
+        b = int(best_match[a])
+
+        # Merge b into a, the similarity of the merged cluster to any other is the mean of the pairs between them
+        merged = (sizes[a] * similarity[a] + sizes[b] * similarity[b]) / (sizes[a] + sizes[b])
+        similarity[a], similarity[:, a] = merged, merged
+        similarity[a, a] = -torch.inf
+        similarity[b], similarity[:, b] = -torch.inf, -torch.inf
+        sizes[a], sizes[b] = sizes[a] + sizes[b], 0
+        clusters[clusters == row_clusters[b]] = row_clusters[a]
+        num_clusters -= 1
+
+        if num_clusters <= similarity.shape[0] // 2:
+            # Drop the rows of the merged clusters, so the work per merge shrinks with the number of clusters
+            keep = torch.nonzero(sizes).reshape(-1)
+            similarity = similarity[keep][:, keep]
+            sizes, row_clusters = sizes[keep], row_clusters[keep]
+            best_similarity, best_match = similarity.max(dim=1)
+            continue
+
+        # The rows whose best match was a or b need their max again, the others can only have a better match in a
+        stale = torch.nonzero((best_match == a) | (best_match == b)).reshape(-1)
+        best_similarity[stale], best_match[stale] = similarity[stale].max(dim=1)
+        better = similarity[:, a] > best_similarity
+        best_similarity[better] = similarity[better, a]
+        best_match[better] = a
+
+    numbers = {}
+    return [numbers.setdefault(cluster, len(numbers)) for cluster in clusters.tolist()]
+
+
+def label_guests(runs: list[dict], threshold=GUEST_SIMILARITY_THRESHOLD, max_gap=0.0) -> tuple[list[dict], list[dict]]:
+    """
+    Tells the unknown speakers of a meeting apart, by clustering the embeddings of all their segments at once (see
+    cluster_embeddings). Every run of an unknown speaker goes to the guest that most of its segments belong to. The
+    guests are numbered in the order in which they first speak, so a meeting gets the same labels every time.
+    :param runs: The speaker runs of the transcript in order, with speaker name (or None), start and end in seconds
+        and text. The runs of unknown speakers have the embeddings of their segments, see merge_speaker_runs.
+    :param threshold: The mean cosine similarity above which segments are the same guest
+    :param max_gap: Consecutive runs of the same guest up to this many seconds apart are joined
+    :return: Tuple of the runs without embeddings, and the guests with their name, number of segments and mean
+        embedding (see SpeakerStore.add_to_centroid), such that they can be enrolled later (see promote_guest)
+    """
+    unknown_runs = [run for run in runs if run["speaker"] is None and run.get("embeddings")]
+    embeddings = torch.stack([embedding.reshape(-1) for run in unknown_runs for embedding in run["embeddings"]]) \
+        if unknown_runs else torch.zeros(0, 0)
+    clusters = torch.tensor(cluster_embeddings(embeddings, threshold), dtype=torch.long)
+
+    # The guest of every run, numbered in order of the runs since a cluster may lose every run it is in
+    run_guests = {}
+    numbers = {}
+    position = 0
+    for run in unknown_runs:
+        run_clusters = clusters[position:position + len(run["embeddings"])].tolist()
+        position += len(run["embeddings"])
+        cluster = Counter(run_clusters).most_common(1)[0][0]
+        run_guests[id(run)] = GUEST_NAME.format(numbers.setdefault(cluster, len(numbers) + 1))
+
+    guests = []
+    if numbers:
+        # The mean of the normalized embeddings of every cluster, in a single pass over the segments
+        normalized = torch.nn.functional.normalize(embeddings.float(), dim=-1)
+        sums = torch.zeros(int(clusters.max()) + 1, normalized.shape[-1]).index_add_(0, clusters, normalized)
+        counts = torch.bincount(clusters)
+        guests = [{"name": GUEST_NAME.format(number), "samples": int(counts[cluster]),
+                   "embedding": (sums[cluster] / counts[cluster]).tolist()} for cluster, number in numbers.items()]
+        logger.info(f"Found {len(guests)} guests in {len(embeddings)} segments of unknown speakers")
+
+    labeled_runs = []
+    for run in runs:
+        speaker_name = run_guests.get(id(run), run["speaker"])
+        run = {**{key: value for key, value in run.items() if key != "embeddings"}, "speaker": speaker_name}
+        previous = labeled_runs[-1] if labeled_runs else None
+        if previous and previous["speaker"] == run["speaker"] and run["start"] - previous["end"] <= max_gap:
+            previous["end"] = run["end"]
+            previous["text"] += " " + run["text"]
+        else:
+            labeled_runs.append(run)
+    return labeled_runs, guests
+
+
+def promote_guest(job_id: str, guest: str, name: str, result_store: ResultStore = results,
+                  store: Optional[SpeakerStore] = None) -> int:
+    """
+    Enrolls a guest of a meeting as a speaker, with the mean embedding of the guest's segments. A speaker that is
+    already enrolled gets the segments added to its embeddings, like the clips of enroll_batch. The guest is renamed in
+    the transcript of the meeting, and the workers pick up the speaker with their next job.
+    :param job_id: The id of the meeting
+    :param guest: The name of the guest, e.g. Guest 1
+    :param name: The name of the speaker
+    :param result_store: The result store with the meeting
+    :param store: The speaker store to enroll the speaker in, the one of the server if not given
+    :return: The row of the speaker in the speaker store
+    """
+    found = [found for found in result_store.get_guests(job_id) if found["name"] == guest]
+    if not found:
+        raise ValueError(f"Job {job_id} has no guest {guest}")
+    embedding, samples = found[0]["embedding"], found[0]["samples"]
+
+    if store is None:
+        store = SpeakerStore()
+    # There is no enrollment clip, a new speaker is only recognized by its embeddings
+    row = store.merge_many([({"name": name, "speaker_id": str(uuid.uuid4()), "audio_file": None}, embedding,
+                             samples)])[0]
+    samples = store.records[row]["samples"]
+
+    result_store.rename_speaker(job_id, guest, name)
+    logger.info(f"Enrolled {guest} of job {job_id} as speaker {name} in row {row}, {samples} segments in total")
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lists the guests of a meeting, or enrolls one of them as a speaker. "
+                                                 "Run from the server directory, such that the speaker and result "
+                                                 "stores of the server are used.")
+    parser.add_argument("job_id", help="The id of the meeting")
+    parser.add_argument("--promote", nargs=2, metavar=("GUEST", "NAME"),
+                        help="Enroll a guest of the meeting as the speaker NAME, e.g. --promote \"Guest 1\" Alice")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.promote:
+        guest, name = args.promote
+        try:
+            promote_guest(args.job_id, guest, name)
+        except ValueError as e:
+            print(e)
+            return
+        print(f"Enrolled {guest} as {name}")
+        return
+
+    guests = results.get_guests(args.job_id)
+    if not guests:
+        print(f"No guests in job {args.job_id}")
+    for guest in guests:
+        print(f"{guest['name']}: {guest['samples']} segments")
+
+
+if __name__ == '__main__':
+    main()
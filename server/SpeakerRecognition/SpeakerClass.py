@@ -16,5 +16,11 @@ class SpeakerClass:
     async def enroll(self, audio: str, name: str) -> Speaker:
         pass
 
+    async def enroll_batch(self, clips: list[tuple[str, str]]) -> list[Speaker]:
+        return [await self.enroll(audio, name) for name, audio in clips]
+
     async def recognize(self, audio: str) -> Optional[Speaker]:
         pass
+
+    async def recognize_batch(self, audio: list) -> list[Optional[Speaker]]:
+        pass
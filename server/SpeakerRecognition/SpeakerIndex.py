@@ -0,0 +1,82 @@
+from typing import Optional
+import torch
+
+
+class SpeakerIndex:
+    """
+    Keeps the embeddings of all enrolled speakers in one contiguous, L2-normalized matrix, such that scoring one or
+    more query embeddings against every speaker is a single matrix multiplication (cosine similarity)
+    """
+
+    def __init__(self, initial_capacity=64):
+        self.speakers: list = []
+        # Position of each speaker in the matrix, by speaker id
+        self.positions: dict[str, int] = {}
+        self.initial_capacity = initial_capacity
+        # Preallocated matrix of [capacity, embedding_size], only the first len(self.speakers) rows are in use
+        self.matrix: Optional[torch.Tensor] = None
+
+    def __len__(self):
+        return len(self.speakers)
+
+    @staticmethod
+    def normalize(embeddings) -> torch.Tensor:
+        """
+        Flattens embeddings to shape [num_embeddings, embedding_size] and L2-normalizes each of them
+        :param embeddings: Embeddings of shape [embedding_size], [num_embeddings, embedding_size] or
+            [num_embeddings, 1, embedding_size] as returned by the classifier
+        :return:
+        """
+        embeddings = torch.as_tensor(embeddings, dtype=torch.float)
+        embeddings = embeddings.reshape(-1, embeddings.shape[-1])
+        return torch.nn.functional.normalize(embeddings, dim=-1, eps=1e-6)
+
+    def add(self, speaker, embeddings) -> int:
+        """
+        Adds a speaker to the index
+        :param speaker: The speaker that the embeddings belong to
+        :param embeddings: The embeddings of the speaker
+        :return: The position of the speaker in the index
+        """
+        embedding = self.normalize(embeddings)[0]
+
+        if self.matrix is None:
+            self.matrix = torch.zeros(self.initial_capacity, embedding.shape[-1])
+        elif len(self.speakers) == self.matrix.shape[0]:
+            # Grow geometrically, so adding n speakers copies the matrix O(log n) times
+            grown = torch.zeros(self.matrix.shape[0] * 2, self.matrix.shape[1])
+            grown[:len(self.speakers)] = self.matrix
+            self.matrix = grown
+
+        position = len(self.speakers)
+        self.matrix[position] = embedding
+        self.speakers.append(speaker)
+        self.positions[speaker.speaker_id] = position
+        return position
+
+    def update(self, speaker, embeddings):
+        """
+        Replaces the embeddings of a speaker in the index
+        :param speaker: The speaker, which must have been added before
+        :param embeddings: The new embeddings of the speaker
+        :return:
+        """
+        self.matrix[self.positions[speaker.speaker_id]] = self.normalize(embeddings)[0]
+
+    def search(self, embeddings, k=1) -> tuple:
+        """
+        Scores the query embeddings against every speaker in the index
+        :param embeddings: One or more query embeddings, see normalize
+        :param k: The number of best matching speakers to return for each query
+        :return: Tuple of the scores with shape [num_queries, k] (highest first) and a list with the matching speakers
+            for each query. If fewer than k speakers are enrolled, only that many are returned.
+        """
+        queries = self.normalize(embeddings)
+        k = min(k, len(self.speakers))
+        if k == 0:
+            return torch.empty(queries.shape[0], 0), [[] for _ in range(queries.shape[0])]
+
+        scores = queries @ self.matrix[:len(self.speakers)].T
+        top_scores, top_positions = torch.topk(scores, k, dim=-1)
+        matches = [[self.speakers[position] for position in positions] for positions in top_positions.tolist()]
+        return top_scores, matches
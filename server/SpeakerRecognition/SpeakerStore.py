@@ -0,0 +1,295 @@
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Optional
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, we don't lock the store there (only a single server process is supported)
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def add_to_centroid(centroid: Optional[np.ndarray], samples: int, embeddings) -> tuple[np.ndarray, int]:
+    """
+    Adds embeddings to the running mean embedding of a speaker. Each embedding is L2-normalized first, so every clip
+    counts the same however loud it is. A centroid of a single clip is normalized as well, since speakers that were
+    enrolled before the mean was kept have the raw embedding of their clip. A new array is returned, the centroid that
+    is passed in is never changed (it may be a view into the store or an inference tensor).
+    :param centroid: The mean embedding so far, None if the speaker has no embeddings yet
+    :param samples: The number of embeddings in the mean so far
+    :param embeddings: The embeddings to add, any array-like with shape [..., embedding_size]
+    :return: Tuple of the new mean embedding and the new number of embeddings
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    embeddings = embeddings.reshape(-1, embeddings.shape[-1])
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=-1, keepdims=True), 1e-6)
+    return merge_centroids(centroid, samples, embeddings.mean(axis=0), embeddings.shape[0])
+
+
+def merge_centroids(centroid: Optional[np.ndarray], samples: int, other: np.ndarray,
+                    other_samples: int) -> tuple[np.ndarray, int]:
+    """
+    Merges two mean embeddings, as if the normalized embeddings that the other mean consists of were added with
+    add_to_centroid
+    :param centroid: The mean embedding so far, None if the speaker has no embeddings yet
+    :param samples: The number of embeddings in the mean so far
+    :param other: The mean of the normalized embeddings to add
+    :param other_samples: The number of embeddings in the other mean
+    :return: Tuple of the new mean embedding and the new number of embeddings
+    """
+    total = np.asarray(other, dtype=np.float32).reshape(-1) * other_samples
+    if centroid is None:
+        samples = 0
+    else:
+        centroid = np.asarray(centroid, dtype=np.float32).reshape(-1)
+        if samples == 1:
+            centroid = centroid / max(np.linalg.norm(centroid), 1e-6)
+        total = total + centroid * samples
+    samples += other_samples
+    return total / samples, samples
+
+
+class SpeakerStore:
+    """
+    Binary store for speaker embeddings, consisting of:
+    - embeddings.f32: A float32 matrix with one row per speaker, which is memory-mapped on load instead of parsed
+    - speakers.jsonl: An append-only log of metadata records, one JSON object per line. A record commits its row in
+      the embedding matrix, and a later record for the same row replaces the earlier one.
+
+    Enrolling a speaker appends one row and one record, instead of rewriting every speaker. A batch of speakers is
+    written with a single lock and sync, see write_many, and new clips are added to the speakers by name under the same
+    lock, see merge_many.
+    """
+
+    def __init__(self, directory="speakers"):
+        self.directory = directory
+        self.embeddings_file = os.path.join(directory, "embeddings.f32")
+        self.metadata_file = os.path.join(directory, "speakers.jsonl")
+
+        # Latest metadata record of each row
+        self.records: dict[int, dict] = {}
+        self.embedding_size: Optional[int] = None
+        # Rows that were added or updated by someone else since the last call to pop_changed_rows
+        self.changed_rows: set[int] = set()
+        # How far we have read in the metadata file
+        self.metadata_offset = 0
+        self.matrix: Optional[np.memmap] = None
+
+    def exists(self) -> bool:
+        return os.path.exists(self.metadata_file)
+
+    def __len__(self):
+        return len(self.records)
+
+    def refresh(self):
+        """
+        Reads the metadata records that were appended since the last refresh, and maps the embedding matrix again if
+        there are new rows
+        :return:
+        """
+        if not self.exists():
+            return
+
+        with open(self.metadata_file, "rb") as f:
+            f.seek(self.metadata_offset)
+            data = f.read()
+
+        # Only consume complete lines, a line without newline is still being written (or was cut off by a crash)
+        data = data[:data.rfind(b"\n") + 1]
+        if not data:
+            return
+        self.metadata_offset += len(data)
+
+        for line in data.splitlines():
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Skipping corrupt speaker record {line}")
+                continue
+            self.records[record["row"]] = record
+            self.changed_rows.add(record["row"])
+            self.embedding_size = record["embedding_size"]
+
+        self.map_embeddings()
+
+    def map_embeddings(self):
+        """
+        Memory-maps the committed rows of the embedding matrix. The map is copy-on-write, so changing the tensors built
+        on top of it never changes the file.
+        :return:
+        """
+        if not self.records:
+            return
+        self.matrix = np.memmap(self.embeddings_file, dtype=np.float32, mode="c",
+                                shape=(len(self.records), self.embedding_size))
+
+    def pop_changed_rows(self) -> list[int]:
+        """
+        Gets the rows that were added or updated since the last call, after refreshing the store
+        :return: The changed rows in ascending order
+        """
+        self.refresh()
+        changed_rows = sorted(self.changed_rows)
+        self.changed_rows.clear()
+        return changed_rows
+
+    def get_embedding(self, row: int) -> np.ndarray:
+        return self.matrix[row]
+
+    def find(self, name: str) -> Optional[int]:
+        """
+        Finds a speaker by name
+        :param name: The name of the speaker
+        :return: The row of the speaker, the latest one if an old store has the name more than once, or None
+        """
+        for row in sorted(self.records, reverse=True):
+            if self.records[row]["name"] == name:
+                return row
+        return None
+
+    def append(self, record: dict, embedding) -> int:
+        """
+        Appends a speaker to the store
+        :param record: The metadata of the speaker, must be JSON serializable
+        :param embedding: The embedding of the speaker, any array-like with embedding_size elements
+        :return: The row of the speaker in the store
+        """
+        return self.write(None, record, embedding)
+
+    def update(self, row: int, record: dict, embedding) -> int:
+        """
+        Replaces the metadata and embedding of a speaker already in the store
+        :param row: The row of the speaker, as returned by append
+        :param record: The new metadata of the speaker
+        :param embedding: The new embedding of the speaker
+        :return: The row of the speaker in the store
+        """
+        return self.write(row, record, embedding)
+
+    def write(self, row: Optional[int], record: dict, embedding) -> int:
+        return self.write_many([(row, record, embedding)])[0]
+
+    def write_many(self, entries: list[tuple[Optional[int], dict, object]]) -> list[int]:
+        """
+        Appends and updates many speakers at once, with a single lock and a single sync of each file
+        :param entries: (row, record, embedding) of every speaker, with row None to append the speaker, see append
+            and update
+        :return: The row of every speaker in the store
+        """
+        if not entries:
+            return []
+        with self.lock() as metadata:
+            return self.write_locked(metadata, entries)
+
+    def merge_many(self, entries: list[tuple[dict, object, int]]) -> list[int]:
+        """
+        Adds the embeddings of new clips to many speakers at once, by name, with a single lock (see merge_centroids).
+        The speakers are looked up while the store is locked, so processes that enroll the same name at the same time
+        add to the same row instead of appending the name twice, and none of their clips are lost. A name that isn't in
+        the store is appended with its record, a speaker that is keeps its speaker id and enrollment clip.
+        :param entries: (record, mean of the normalized embeddings, number of embeddings in the mean) of every speaker,
+            the record has the name of the speaker and is stored with the total number of embeddings as samples
+        :return: The row of every speaker in the store
+        """
+        if not entries:
+            return []
+        with self.lock() as metadata:
+            # Row (None if new), record, mean embedding and number of embeddings of every speaker by name
+            speakers: dict[str, tuple[Optional[int], dict, Optional[np.ndarray], int]] = {}
+            for record, embedding, samples in entries:
+                if record["name"] not in speakers:
+                    row = self.find(record["name"])
+                    if row is None:
+                        speakers[record["name"]] = (None, record, None, 0)
+                    else:
+                        existing = self.records[row]
+                        speakers[record["name"]] = (row, {
+                            **record,
+                            "speaker_id": existing["speaker_id"],
+                            "audio_file": existing.get("audio_file") or record.get("audio_file")
+                        }, self.get_embedding(row), existing.get("samples", 1))
+                row, merged_record, centroid, total = speakers[record["name"]]
+                centroid, total = merge_centroids(centroid, total, embedding, samples)
+                speakers[record["name"]] = (row, merged_record, centroid, total)
+
+            rows = self.write_locked(metadata, [(row, {**record, "samples": total}, centroid)
+                                                for row, record, centroid, total in speakers.values()])
+        rows = dict(zip(speakers, rows))
+        return [rows[record["name"]] for record, _, _ in entries]
+
+    @contextmanager
+    def lock(self):
+        """
+        Locks the store, so no other process writes to it in the meantime, and catches up with what other processes
+        wrote before. Their rows stay in changed_rows, such that the caller can pick them up with pop_changed_rows.
+        :return: Context manager of the metadata file, opened for appending
+        """
+        if not os.path.exists(self.directory):
+            os.mkdir(self.directory)
+
+        with open(self.metadata_file, "ab") as metadata:
+            # Lock the store, so two processes can't append the same row
+            if fcntl:
+                fcntl.flock(metadata.fileno(), fcntl.LOCK_EX)
+            try:
+                # Catch up with whatever other processes appended, so we know which row is next
+                self.refresh()
+                yield metadata
+            finally:
+                if fcntl:
+                    fcntl.flock(metadata.fileno(), fcntl.LOCK_UN)
+
+    def write_locked(self, metadata, entries: list[tuple[Optional[int], dict, object]]) -> list[int]:
+        """
+        Appends and updates speakers while the store is locked, see write_many
+        :param metadata: The metadata file, see lock
+        :param entries: (row, record, embedding) of every speaker, see write_many
+        :return: The row of every speaker in the store
+        """
+        embeddings = [np.asarray(embedding, dtype=np.float32).reshape(-1) for _, _, embedding in entries]
+        embedding_size = self.embedding_size or embeddings[0].shape[0]
+        for embedding in embeddings:
+            if embedding.shape[0] != embedding_size:
+                raise ValueError(f"Invalid embedding size {embedding.shape[0]}, expected {embedding_size}")
+
+        rows = []
+        next_row = len(self.records)
+        for row, _, _ in entries:
+            if row is None:
+                row = next_row
+                next_row += 1
+            rows.append(row)
+
+        # First write the embeddings, if we crash before the records below are written, the rows are not committed and
+        # will be overwritten by the next append
+        mode = "r+b" if os.path.exists(self.embeddings_file) else "wb"
+        with open(self.embeddings_file, mode) as embeddings_file:
+            for row, embedding in zip(rows, embeddings):
+                embeddings_file.seek(row * embedding.nbytes)
+                embeddings_file.write(embedding.tobytes())
+            embeddings_file.flush()
+            os.fsync(embeddings_file.fileno())
+
+        records = [{**record, "row": row, "embedding_size": embedding_size}
+                   for row, (_, record, _) in zip(rows, entries)]
+        lines = b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records)
+        # If a previous write was cut off, start on a new line so the records don't get glued together
+        if metadata.seek(0, os.SEEK_END) > self.metadata_offset:
+            lines = b"\n" + lines
+        metadata.write(lines)
+        metadata.flush()
+        os.fsync(metadata.fileno())
+
+        self.metadata_offset = metadata.tell()
+        for record in records:
+            self.records[record["row"]] = record
+        self.embedding_size = embedding_size
+        self.map_embeddings()
+        return rows
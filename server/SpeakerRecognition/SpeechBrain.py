@@ -3,21 +3,46 @@ import uuid
 from typing import Optional
 import aiofiles
 from .SpeakerClass import SpeakerClass, Speaker
+from .SpeakerIndex import SpeakerIndex
+from .SpeakerStore import SpeakerStore, add_to_centroid, merge_centroids
+import numpy as np
 import torch
-from speechbrain.pretrained import EncoderClassifier, SpeakerRecognition
+from Models.ModelRegistry import get_model
 import asyncio
 import json
+import logging
+from AudioProcessing.Batching import pad_waveforms
+from AudioProcessing.Decoding import load_waveform, MODEL_SAMPLE_RATE
+from AudioProcessing.Segmentation import sliding_windows, find_change_points, split_at_changes, \
+    CHANGE_WINDOW_SECONDS, CHANGE_HOP_SECONDS
+from Caching.ResultCache import create_cache
+from Monitoring.Metrics import metrics
+
+# Max number of waveforms to embed in a single forward pass
+EMBEDDING_BATCH_SIZE = 32
+# Max seconds of audio in a single forward pass of recognize_turns, counting the padding
+FRAME_FEATURES_MAX_BATCH_SECONDS = 60
+# The ECAPA features have a frame every 10ms
+SAMPLES_PER_FRAME = MODEL_SAMPLE_RATE // 100
+# Sliding windows of the same speaker are well above this cosine similarity, see recognize_turns
+CHANGE_THRESHOLD = 0.4
+
+logger = logging.getLogger(__name__)
 
 
 class SpeechBrainSpeaker(Speaker):
     def __init__(self, name: str, speaker_id=None, classifier=None, verification=None, audio_file=None,
-                 embeddings=None):
+                 embeddings=None, row=None, samples=1):
         super().__init__(name)
         self.speaker_id = speaker_id if speaker_id else str(uuid.uuid4())
         self.verification = verification
         self.classifier = classifier
         self.audio_file = audio_file
         self.embeddings = embeddings
+        # Row of the speaker in the speaker store, None if it hasn't been saved yet
+        self.row = row
+        # Number of enrollment clips that the embeddings are the mean of, see SpeakerStore.add_to_centroid
+        self.samples = samples
 
         self.similarity = torch.nn.CosineSimilarity(dim=-1, eps=1e-6)
 
@@ -37,31 +62,46 @@ class SpeechBrainSpeaker(Speaker):
         """
         # If we have embeddings, verify using embeddings manually
         if embeddings is not None and self.embeddings is not None:
-            print(f"Checking using embeddings for speaker {self.name}")
             score = await self.get_embedding_similarity_score(embeddings)
             prediction = score > threshold
-            print(f"Prediction for Speaker {self.name} is {prediction} ({score}) with embeddings.")
+            # The score is a tensor, so only format it if the message is shown
+            logger.debug("Prediction for Speaker %s is %s (%s) with embeddings.", self.name, prediction, score)
             return prediction == 1
         else:
-            print("No embeddings provided, verifying audio files automatically")
-
             score, prediction = self.verification.verify_files(self.audio_file, audio)
-            print(
-                f"Prediction for Speaker {self.name} is {prediction} ({score}) with files {self.audio_file} and {audio}")
+            logger.debug("Prediction for Speaker %s is %s (%s) with files %s and %s", self.name, prediction, score,
+                         self.audio_file, audio)
             return prediction == 1
 
 
 class SpeechBrain(SpeakerClass):
-    def __init__(self):
+    def __init__(self, fast_inference=False):
+        """
+        :param fast_inference: Use the int8 version of the model, which is faster on the CPU but slightly less
+            accurate, see Models.ModelRegistry.quantize_model and Benchmark.AccuracyCheck
+        """
         super().__init__()
-        # Classifier for embeddings
-        self.classifier = EncoderClassifier.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                         savedir="pretrained_models/spkrec-ecapa-voxceleb")
-        # Model for speaker recognition
-        self.verification = SpeakerRecognition.from_hparams(source="speechbrain/spkrec-ecapa-voxceleb",
-                                                            savedir="pretrained_models/spkrec-ecapa-voxceleb")
+        # The same ECAPA model is the classifier for embeddings and the model for speaker recognition, so it's only
+        # loaded once
+        self.classifier = get_model("spkrec-ecapa-voxceleb", quantized=fast_inference)
+        self.verification = self.classifier
 
         self.speakers: list[SpeechBrainSpeaker] = []
+        # Normalized embeddings of all speakers, used to score against every speaker at once
+        self.index = SpeakerIndex()
+        # Binary store of the speakers and their embeddings, see save and load
+        self.store = SpeakerStore("speakers")
+        # The speakers that are in the store, by their row in the store
+        self.speaker_rows: dict[int, SpeechBrainSpeaker] = {}
+        # The speakers by name, enrolling a name again adds to the embeddings of that speaker
+        self.speaker_names: dict[str, SpeechBrainSpeaker] = {}
+        # The mean of the normalized embeddings of the clips that were enrolled since the last save, and their number,
+        # by speaker name. Only these are added to the store, see save.
+        self.unsaved_clips: dict[str, tuple[np.ndarray, int]] = {}
+        # Embeddings of audio we have seen before
+        # The int8 model gives slightly different embeddings, so it has results of its own
+        self.cache = create_cache("spkrec-ecapa-voxceleb",
+                                  f"speechbrain/spkrec-ecapa-voxceleb{'-int8' if fast_inference else ''}")
 
     async def get_embeddings(self, audio: str):
         """
@@ -70,98 +110,431 @@ class SpeechBrain(SpeakerClass):
         :param audio:
         :return:
         """
-        waveform = self.classifier.load_audio(audio)
-        batch = waveform.unsqueeze(0)
-        # signal, fs = torchaudio.load(audio)
-        embeddings = self.classifier.encode_batch(batch)
-        return embeddings
+        # A batch of one, so the embeddings are cached like any other
+        return await self.get_embeddings_batch([audio])
+
+    async def get_embeddings_batch(self, waveforms: list, batch_size=EMBEDDING_BATCH_SIZE):
+        """
+        Get embeddings from many audio clips at once, by padding them into batches and running the classifier once
+        per batch instead of once per clip
+        :param waveforms: List of 1D waveform tensors (16kHz mono) or paths to audio files
+        :param batch_size: The max number of clips in each forward pass
+        :return: Tensor of embeddings with shape [len(waveforms), 1, embedding_size], in the same order as the input
+        """
+        # Files go through the same preprocessing as meetings, so enrolled and recognized embeddings are comparable
+        waveforms = [load_waveform(waveform)[0] if isinstance(waveform, str) else waveform for waveform in waveforms]
+
+        # Only run the classifier on the clips we haven't seen before
+        keys = [self.cache.key(waveform) for waveform in waveforms]
+        embeddings = [self.cache.get(key) for key in keys]
+        missing = [i for i in range(len(waveforms)) if embeddings[i] is None]
+
+        # Sort by length, so clips of similar length end up in the same batch and we pad as little as possible
+        order = sorted(missing, key=lambda i: waveforms[i].shape[-1])
+
+        for i in range(0, len(order), batch_size):
+            batch_indices = order[i:i + batch_size]
+            batch, lengths = pad_waveforms([waveforms[j] for j in batch_indices])
+            # Inference mode skips all autograd bookkeeping, which no_grad still does
+            with metrics.timer("inference_seconds", model="spkrec-ecapa-voxceleb"), torch.inference_mode():
+                batch_embeddings = self.classifier.encode_batch(batch, lengths)
+            metrics.increment("inference_clips_total", len(batch_indices), model="spkrec-ecapa-voxceleb")
+            for j, index in enumerate(batch_indices):
+                embeddings[index] = batch_embeddings[j:j + 1]
+                self.cache.put(keys[index], embeddings[index])
+
+        return torch.cat(embeddings)
 
     async def enroll(self, audio: str, name: str) -> Speaker:
-        # The verify already uses embeddings so we can just skip this step - if we want to do it manually in the future
-        # we can bring it back
-        embeddings = await self.get_embeddings(audio)
-        speaker = SpeechBrainSpeaker(name=name, verification=self.verification, embeddings=embeddings, audio_file=audio,
-                                     classifier=self.classifier)
-        self.speakers.append(speaker)
-        return speaker
+        return (await self.enroll_batch([(name, audio)]))[0]
+
+    async def enroll_batch(self, clips: list[tuple[str, str]]) -> list[Speaker]:
+        """
+        Enrolls many clips at once, their embeddings are computed in batched forward passes, see get_embeddings_batch.
+        The embeddings of a speaker are the mean of all of its clips, so a name that is already enrolled (in this
+        batch or before) gets its embeddings updated instead of a second entry. Call save once afterwards to add the
+        clips of the whole batch to the store.
+        :param clips: (name, audio file) of every clip
+        :return: The speaker of every clip, in the same order as the input
+        """
+        if not clips:
+            return []
+        embeddings = (await self.get_embeddings_batch([audio for _, audio in clips])).detach().cpu().numpy()
+
+        # The clips of each speaker, in the order the speakers first appear
+        clip_indices: dict[str, list[int]] = {}
+        for i, (name, _) in enumerate(clips):
+            clip_indices.setdefault(name, []).append(i)
+
+        enrolled = {}
+        for name, indices in clip_indices.items():
+            clips_centroid, clips_samples = add_to_centroid(None, 0, embeddings[indices])
+            speaker = self.speaker_names.get(name)
+            if speaker is None or speaker.embeddings is None:
+                speaker = SpeechBrainSpeaker(name=name, verification=self.verification,
+                                             embeddings=torch.from_numpy(clips_centroid).reshape(1, 1, -1),
+                                             audio_file=clips[indices[0]][1], classifier=self.classifier,
+                                             samples=clips_samples)
+                self.speakers.append(speaker)
+                self.speaker_names[name] = speaker
+                self.index.add(speaker, speaker.embeddings)
+            else:
+                # A new tensor, the old embeddings may be a view into the store
+                centroid, speaker.samples = merge_centroids(speaker.embeddings.numpy(), speaker.samples,
+                                                            clips_centroid, clips_samples)
+                speaker.embeddings = torch.from_numpy(centroid).reshape(1, 1, -1)
+                self.index.update(speaker, speaker.embeddings)
+
+            unsaved_centroid, unsaved_samples = self.unsaved_clips.get(name, (None, 0))
+            self.unsaved_clips[name] = merge_centroids(unsaved_centroid, unsaved_samples, clips_centroid, clips_samples)
+            logger.debug("Enrolled %d clips of speaker %s, %d in total", len(indices), name, speaker.samples)
+            enrolled[name] = speaker
+
+        return [enrolled[name] for name, _ in clips]
 
     async def recognize(self, audio: str, threshold=0.25) -> Optional[Speaker]:
         embeddings = await self.get_embeddings(audio)
+        return (await self.get_best_matches(embeddings, threshold))[0]
 
-        # We want to get the similarity score for each speaker, in case we have multiple speakers below the threshold
-        similarity_scores = []
-        for speaker in self.speakers:
-            score = await speaker.get_embedding_similarity_score(embeddings)
-            similarity_scores.append((score, speaker))
+    async def recognize_batch(self, waveforms: list, threshold=0.25) -> list[Optional[Speaker]]:
+        """
+        Recognizes the speaker of many audio clips at once, see get_embeddings_batch
+        :param waveforms: List of 1D waveform tensors (16kHz mono) or paths to audio files
+        :param threshold: The threshold for the similarity score
+        :return: The recognized speaker (or None) for each clip, in the same order as the input
+        """
+        if not waveforms:
+            return []
 
-        # Sort the similarity scores, such that the highest similarity score is first
-        similarity_scores.sort(key=lambda x: x[0], reverse=True)
-        # Get highest similarity score
-        highest_similarity_score = similarity_scores[0]
+        embeddings = await self.get_embeddings_batch(waveforms)
+        return await self.get_best_matches(embeddings, threshold)
+
+    async def recognize_segments(self, segments: list[dict], threshold=0.25) -> list[dict]:
+        """
+        Recognizes the speakers of many segments at once like recognize_batch, and keeps the embeddings of every
+        segment, so the segments of unknown speakers can be told apart afterwards (see Guests.label_guests)
+        :param segments: The segments with their audio, see Segmentation.split_segments
+        :param threshold: The threshold for the similarity score
+        :return: The same segments, with the recognized speaker (or None) and the embeddings
+        """
+        if not segments:
+            return segments
 
-        # Check if the highest similarity score is above the threshold
-        if highest_similarity_score[0] > threshold:
-            print(f"Speaker recognized as {highest_similarity_score[1].name} with score {highest_similarity_score[0]}")
-            return highest_similarity_score[1]
+        embeddings = await self.get_embeddings_batch([segment["audio"] for segment in segments])
+        speakers = await self.get_best_matches(embeddings, threshold)
+        for segment, segment_embeddings, segment_speaker in zip(segments, embeddings, speakers):
+            segment["embeddings"] = segment_embeddings
+            segment["speaker"] = segment_speaker
+        return segments
 
-        print(f"Speaker not recognized!")
-        return None
+    async def recognize_turns(self, waveform, regions: list[tuple[int, int]], min_seconds: float, max_seconds: float,
+                              threshold=0.25, change_threshold=CHANGE_THRESHOLD) -> list[dict]:
+        """
+        Splits speech into speaker turns, and recognizes the speaker of every turn. The model runs once over each
+        region, up to the frame features (see get_frame_features_batch). The embeddings of sliding windows are pooled
+        from those features to find the speaker changes (see get_window_embeddings and
+        Segmentation.find_change_points). The embedding of every turn is pooled from the same features, so the model
+        runs once over the audio however many windows and turns there are.
+        :param waveform: The 1D waveform (16kHz mono)
+        :param regions: The (start, end) sample offsets of the speech in the waveform, see detect_speech
+        :param min_seconds: The min length of a turn, see Segmentation.split_at_changes
+        :param max_seconds: The max length of a turn
+        :param threshold: The threshold for the similarity score of the speakers
+        :param change_threshold: The similarity of two windows below which the speaker changes between them
+        :return: List of segments, with start and end as sample offsets into the waveform, audio as a view of the
+            waveform between them, the recognized speaker (or None) and the embeddings
+        """
+        if not regions:
+            return []
+
+        features = await self.get_frame_features_batch([waveform[start:end] for start, end in regions])
+
+        window_length = int(CHANGE_WINDOW_SECONDS * MODEL_SAMPLE_RATE)
+        hop_length = int(CHANGE_HOP_SECONDS * MODEL_SAMPLE_RATE)
+        segments = []
+        for i, (start, end) in enumerate(regions):
+            window_embeddings = await self.get_window_embeddings(features[i], end - start, window_length, hop_length)
+            change_points = find_change_points(window_embeddings, window_length, hop_length, change_threshold)
+            for segment_start, segment_end in split_at_changes(start, end, change_points,
+                                                               int(min_seconds * MODEL_SAMPLE_RATE),
+                                                               int(max_seconds * MODEL_SAMPLE_RATE)):
+                segments.append({"region": i, "start": segment_start, "end": segment_end,
+                                 "audio": waveform[segment_start:segment_end]})
+
+        embeddings = await self.pool_frame_features(
+            features, [(segment["region"], segment["start"] - regions[segment["region"]][0],
+                        segment["end"] - regions[segment["region"]][0]) for segment in segments])
+        speakers = await self.get_best_matches(embeddings, threshold)
+        for segment, segment_embeddings, segment_speaker in zip(segments, embeddings, speakers):
+            del segment["region"]
+            segment["embeddings"] = segment_embeddings
+            segment["speaker"] = segment_speaker
+        logger.debug("Found %d speaker turns in %d regions", len(segments), len(regions))
+        return segments
+
+    def has_frame_features(self) -> bool:
+        # The layers of the ECAPA model that are called separately, see get_frame_features_batch
+        embedding_model = getattr(getattr(self.classifier, "mods", None), "embedding_model", None)
+        return all(hasattr(embedding_model, layer) for layer in ("blocks", "mfa", "asp", "asp_bn", "fc"))
+
+    async def get_frame_features_batch(self, waveforms: list,
+                                       max_batch_seconds=FRAME_FEATURES_MAX_BATCH_SECONDS) -> list[torch.Tensor]:
+        """
+        Runs the ECAPA model up to its attentive statistics pooling, which gives a feature vector for every frame.
+        Pooling the frames of a part of the audio gives the embedding of that part, see pool_frame_features.
+
+        This repeats the first half of ECAPA_TDNN.forward. Models that don't have those layers get the waveform as
+        their features, and pool_frame_features embeds the parts of it as separate clips.
+        :param waveforms: List of 1D waveform tensors (16kHz mono)
+        :param max_batch_seconds: The max seconds of audio in each forward pass, a longer clip gets a batch of its own
+        :return: The features of every waveform, with shape [channels, frames]
+        """
+        if not self.has_frame_features():
+            return [waveform.reshape(1, -1) for waveform in waveforms]
+
+        # Batched like the clips of the ASR model, the last clip of a batch decides how long the padded batch is
+        max_batch_samples = max_batch_seconds * MODEL_SAMPLE_RATE
+        batches = []
+        for index in sorted(range(len(waveforms)), key=lambda i: waveforms[i].shape[-1]):
+            if batches and (len(batches[-1]) + 1) * waveforms[index].shape[-1] <= max_batch_samples:
+                batches[-1].append(index)
+            else:
+                batches.append([index])
+
+        mods = self.classifier.mods
+        features = [None] * len(waveforms)
+        for batch_indices in batches:
+            batch, lengths = pad_waveforms([waveforms[i] for i in batch_indices])
+            with metrics.timer("inference_seconds", model="spkrec-ecapa-voxceleb"), torch.inference_mode():
+                x = mods.mean_var_norm(mods.compute_features(batch), lengths).transpose(1, 2)
+                layers = []
+                for i, layer in enumerate(mods.embedding_model.blocks):
+                    # The first block is a plain TDNN block, the others mask the padding with the lengths
+                    x = layer(x) if i == 0 else layer(x, lengths=lengths)
+                    layers.append(x)
+                x = mods.embedding_model.mfa(torch.cat(layers[1:], dim=1))
+            metrics.increment("inference_clips_total", len(batch_indices), model="spkrec-ecapa-voxceleb")
+            for j, index in enumerate(batch_indices):
+                features[index] = x[j, :, :max(1, round(lengths[j].item() * x.shape[-1]))]
+        return features
+
+    async def get_window_embeddings(self, features: torch.Tensor, length: int, window_length: int,
+                                    hop_length: int) -> torch.Tensor:
+        """
+        Gets the embeddings of the sliding windows over a waveform, see Segmentation.sliding_windows. With the ECAPA
+        model, the mean and standard deviation of the frame features of every window go through the last layers of the
+        model, so this is the embedding of the window with uniform instead of attentive pooling. The statistics of all
+        windows come from cumulative sums, so their cost doesn't depend on the number of windows.
+        :param features: The frame features of the waveform, see get_frame_features_batch
+        :param length: The length of the waveform in samples
+        :param window_length: The length of each window in samples
+        :param hop_length: The distance between two windows in samples
+        :return: Tensor of embeddings with shape [num_windows, 1, embedding_size]
+        """
+        offsets = sliding_windows(length, window_length, hop_length)
+        if not offsets:
+            return torch.empty(0, 1, 0)
+        if not self.has_frame_features():
+            return await self.get_embeddings_batch([features[0, offset:offset + window_length] for offset in offsets])
+
+        # Double precision, the sums of a long region are much larger than the statistics of a window
+        window_frames = window_length // SAMPLES_PER_FRAME
+        starts = torch.tensor(offsets) // SAMPLES_PER_FRAME
+        ends = torch.clamp(starts + window_frames, max=features.shape[-1])
+        sums = torch.nn.functional.pad(features.double().cumsum(dim=-1), (1, 0))
+        squares = torch.nn.functional.pad(features.double().pow(2).cumsum(dim=-1), (1, 0))
+        counts = (ends - starts).double()
+        mean = (sums[:, ends] - sums[:, starts]) / counts
+        std = ((squares[:, ends] - squares[:, starts]) / counts - mean.pow(2)).clamp(min=1e-12).sqrt()
+
+        embedding_model = self.classifier.mods.embedding_model
+        statistics = torch.cat([mean, std]).T.float().unsqueeze(-1)
+        with torch.inference_mode():
+            return embedding_model.fc(embedding_model.asp_bn(statistics)).transpose(1, 2)
+
+    async def pool_frame_features(self, features: list, spans: list[tuple[int, int, int]]) -> torch.Tensor:
+        """
+        Gets the embeddings of parts of the audio from their frame features, see get_frame_features_batch
+        :param features: The frame features of every waveform
+        :param spans: (index of the waveform, start, end) of every part, with start and end as sample offsets into
+            that waveform
+        :return: Tensor of embeddings with shape [len(spans), 1, embedding_size], in the same order as the spans
+        """
+        if not spans:
+            return torch.empty(0, 1, 0)
+        if not self.has_frame_features():
+            return await self.get_embeddings_batch([features[i][0, start:end] for i, start, end in spans])
+
+        # Every span has at least one frame
+        frame_spans = [(i, start // SAMPLES_PER_FRAME, max(start // SAMPLES_PER_FRAME + 1, end // SAMPLES_PER_FRAME))
+                       for i, start, end in spans]
+        order = sorted(range(len(spans)), key=lambda k: frame_spans[k][2] - frame_spans[k][1])
+
+        embedding_model = self.classifier.mods.embedding_model
+        embeddings = [None] * len(spans)
+        for k in range(0, len(order), EMBEDDING_BATCH_SIZE):
+            batch_indices = order[k:k + EMBEDDING_BATCH_SIZE]
+            batch, lengths = pad_waveforms([features[frame_spans[j][0]][:, frame_spans[j][1]:frame_spans[j][2]]
+                                            for j in batch_indices])
+            with torch.inference_mode():
+                x = embedding_model.fc(embedding_model.asp_bn(embedding_model.asp(batch, lengths=lengths)))
+            for j, index in enumerate(batch_indices):
+                embeddings[index] = x[j:j + 1].transpose(1, 2)
+        return torch.cat(embeddings)
+
+    async def get_top_matches(self, embeddings, k=5) -> list[list[tuple[float, SpeechBrainSpeaker]]]:
+        """
+        Gets the k most similar speakers for each of the given embeddings
+        :param embeddings: One or more embeddings, as returned by get_embeddings or get_embeddings_batch
+        :param k: The number of speakers to return for each embedding
+        :return: A list with (score, speaker) tuples for each embedding, with the highest score first
+        """
+        scores, matches = self.index.search(embeddings, k)
+        return [list(zip(embedding_scores, embedding_matches))
+                for embedding_scores, embedding_matches in zip(scores.tolist(), matches)]
+
+    async def get_best_matches(self, embeddings, threshold=0.25) -> list[Optional[SpeechBrainSpeaker]]:
+        """
+        Gets the most similar speaker for each of the given embeddings, if their similarity score is above threshold
+        :param embeddings: One or more embeddings, as returned by get_embeddings or get_embeddings_batch
+        :param threshold: The threshold for the similarity score
+        :return: The recognized speaker (or None) for each embedding
+        """
+        best_matches = []
+        for top_matches in await self.get_top_matches(embeddings, k=1):
+            # No speakers are enrolled, so we can't recognize anyone
+            if not top_matches:
+                best_matches.append(None)
+                continue
+
+            score, speaker = top_matches[0]
+            if score > threshold:
+                logger.debug("Speaker recognized as %s with score %.3f", speaker.name, score)
+                best_matches.append(speaker)
+            else:
+                logger.debug("Speaker not recognized! (best match %s with score %.3f)", speaker.name, score)
+                best_matches.append(None)
+        return best_matches
 
     async def save(self):
         """
-        Saves the current speakers and their embeddings to a file, so that we can load them later
+        Adds the clips that were enrolled since the last save to the speaker store, so that we can load them later. The
+        whole batch is written at once, see SpeakerStore.merge_many. The speakers are looked up by name while the store
+        is locked, so the clips that other processes enrolled for the same speaker in the meantime are kept, and the
+        speakers get the embeddings of all clips.
         :return:
         """
         # Make a speakers directory
         if not os.path.exists("speakers"):
             os.mkdir("speakers")
 
-        async with aiofiles.open("speakers/speakers.json", "w") as f:
-            speaker_objects = []
-            for speaker in self.speakers:
-                if speaker.embeddings is None or speaker.audio_file is None:
-                    print(f"Skipping speaker {speaker.name} because it has no embeddings or audio file")
-                    continue
-
-                # Check if current audio file is in speakers directory
-                if not os.path.exists(f"speakers/{speaker.speaker_id}.wav"):
-                    # Copy audio file to speakers directory
+        speakers = []
+        copied_files = set()
+        for name, (centroid, samples) in self.unsaved_clips.items():
+            speaker = self.speaker_names[name]
+            if speaker.row is None and speaker.audio_file is not None:
+                # Keep the first clip of a new speaker, the uploaded audio is deleted after a while
+                audio_file = f"speakers/{speaker.speaker_id}.wav"
+                if not os.path.exists(audio_file):
                     async with aiofiles.open(speaker.audio_file, "rb") as f2:
                         audio_clip = await f2.read()
-                        async with aiofiles.open(f"speakers/{speaker.speaker_id}.wav", "wb") as f3:
+                        async with aiofiles.open(audio_file, "wb") as f3:
                             await f3.write(audio_clip)
+                    copied_files.add(audio_file)
+                speaker.audio_file = audio_file
+            speakers.append((speaker, centroid, samples))
 
-                speaker_objects.append({
-                    "name": speaker.name,
-                    "speaker_id": speaker.speaker_id,
-                    "embeddings": speaker.embeddings.tolist(),
-                    "audio_file": f"speakers/{speaker.speaker_id}.wav"
-                })
+        rows = self.store.merge_many([({
+            "name": speaker.name,
+            "speaker_id": speaker.speaker_id,
+            "audio_file": speaker.audio_file
+        }, centroid, samples) for speaker, centroid, samples in speakers])
 
-            await f.write(json.dumps(speaker_objects))
+        new_speakers = 0
+        for (speaker, _, _), row in zip(speakers, rows):
+            new_speakers += speaker.row is None
+            record = self.store.records[row]
+            if speaker.audio_file in copied_files and speaker.audio_file != record["audio_file"]:
+                # Another process enrolled the speaker first, and its clip is kept
+                os.remove(speaker.audio_file)
+            speaker.row = row
+            if speaker.speaker_id != record["speaker_id"]:
+                # The speaker keeps its position in the index, which is by speaker id
+                self.index.positions[record["speaker_id"]] = self.index.positions.pop(speaker.speaker_id)
+                speaker.speaker_id = record["speaker_id"]
+            speaker.audio_file = record["audio_file"]
+            speaker.samples = record["samples"]
+            speaker.embeddings = torch.from_numpy(self.store.get_embedding(row)).reshape(1, 1, -1)
+            self.index.update(speaker, speaker.embeddings)
+            self.speaker_rows[row] = speaker
+        self.unsaved_clips.clear()
+        if speakers:
+            logger.info("Saved %d new and %d updated speakers", new_speakers, len(speakers) - new_speakers)
 
     async def load(self):
         """
-        Loads the speakers from a file
+        Loads the speakers from the speaker store. Can be called again to pick up speakers that were enrolled or
+        updated by other processes in the meantime.
         :return:
         """
+        if not self.store.exists() and os.path.exists("speakers/speakers.json"):
+            await self.migrate_json("speakers/speakers.json")
+
         # Check if speakers file exists
-        if os.path.exists("speakers/speakers.json"):
-            async with aiofiles.open("speakers/speakers.json", "r") as f:
-                try:
-                    speakers = json.loads(await f.read())
-                except json.JSONDecodeError:
-                    print("Error loading speakers file, skipping loading speakers")
-                    return False
-                for speaker in speakers:
-                    speaker_object = SpeechBrainSpeaker(name=speaker["name"], speaker_id=speaker["speaker_id"],
-                                                        embeddings=torch.tensor(speaker["embeddings"]),
-                                                        audio_file=speaker["audio_file"])
-                    self.speakers.append(speaker_object)
-            return True
-        else:
-            print("No speakers file found, skipping loading speakers")
-        return False
+        if not self.store.exists():
+            logger.debug("No speakers file found, skipping loading speakers")
+            return False
+
+        for row in self.store.pop_changed_rows():
+            record = self.store.records[row]
+            # The embeddings are a view into the memory-mapped matrix, so nothing is parsed or copied here
+            embeddings = torch.from_numpy(self.store.get_embedding(row)).reshape(1, 1, -1)
+
+            speaker_object = self.speaker_rows.get(row)
+            if speaker_object:
+                speaker_object.name = record["name"]
+                speaker_object.embeddings = embeddings
+                speaker_object.audio_file = record["audio_file"]
+                speaker_object.samples = record.get("samples", 1)
+                self.speaker_names[record["name"]] = speaker_object
+                self.index.update(speaker_object, embeddings)
+                continue
+
+            # Speakers enrolled before the embeddings were averaged have a single clip
+            speaker_object = SpeechBrainSpeaker(name=record["name"], speaker_id=record["speaker_id"],
+                                                embeddings=embeddings, audio_file=record["audio_file"], row=row,
+                                                samples=record.get("samples", 1))
+            self.speakers.append(speaker_object)
+            self.speaker_rows[row] = speaker_object
+            # Rows are loaded in ascending order, so a name that an old store has more than once gets its latest row
+            self.speaker_names[record["name"]] = speaker_object
+            self.index.add(speaker_object, embeddings)
+        return True
+
+    async def migrate_json(self, speakers_file: str):
+        """
+        Migrates the old JSON speakers file to the speaker store, and renames the JSON file so this is only done once
+        :param speakers_file: The path to the JSON speakers file
+        :return:
+        """
+        logger.info(f"Migrating speakers from {speakers_file} to the speaker store...")
+        async with aiofiles.open(speakers_file, "r") as f:
+            try:
+                speakers = json.loads(await f.read())
+            except json.JSONDecodeError:
+                logger.error("Error loading speakers file, skipping migration")
+                return
+
+        # Write through a separate store, so the migrated rows show up as changed when we load them afterwards
+        store = SpeakerStore(self.store.directory)
+        store.write_many([(None, {
+            "name": speaker["name"],
+            "speaker_id": speaker["speaker_id"],
+            "audio_file": speaker["audio_file"]
+        }, speaker["embeddings"]) for speaker in speakers])
+
+        os.replace(speakers_file, f"{speakers_file}.migrated")
+        logger.info(f"Migrated {len(speakers)} speakers")
 
 
 async def main():
@@ -1,50 +1,86 @@
 import asyncio
+import torch
 
-import torchaudio
-import torchaudio.transforms as T
 from .SpeechClass import SpeechClass
-from speechbrain.pretrained import EncoderDecoderASR
+from Models.ModelRegistry import get_model
+from AudioProcessing.Batching import pad_waveforms
+from AudioProcessing.Decoding import load_waveform, MODEL_SAMPLE_RATE
+from Caching.ResultCache import create_cache
+from Monitoring.Metrics import metrics
+
+# Max seconds of audio in a single ASR forward pass, counting the padding
+ASR_MAX_BATCH_SECONDS = 60
+# The supported models, with their name in the model registry
+ASR_MODELS = {
+    "wav2vec2": "asr-wav2vec2-commonvoice-en",
+    "librispeech": "asr-transformer-transformerlm-librispeech"
+}
 
 
 class SpeechBrain(SpeechClass):
-    def __init__(self, model: str):
+    def __init__(self, model: str, fast_inference=False):
+        """
+        :param model: The name of the model, see ASR_MODELS
+        :param fast_inference: Use the int8 version of the model, which is faster on the CPU but slightly less
+            accurate, see Models.ModelRegistry.quantize_model and Benchmark.AccuracyCheck
+        """
         super().__init__()
 
-        if model.lower() == "wav2vec2":
-            self.asr_model = EncoderDecoderASR.from_hparams(source="speechbrain/asr-wav2vec2-commonvoice-en",
-                                                            savedir="pretrained_models/asr-wav2vec2-commonvoice-en")
-        elif model.lower() == "librispeech":
-            self.asr_model = EncoderDecoderASR.from_hparams(
-                source="speechbrain/asr-transformer-transformerlm-librispeech",
-                savedir="pretrained_models/asr-transformer-transformerlm-librispeech")
-        else:
+        if model.lower() not in ASR_MODELS:
             raise ValueError(f"Model {model} not supported")
 
-    async def get_text(self, audio):
-        transcription = self.asr_model.transcribe_file(audio)
-        return transcription
+        self.model_name = ASR_MODELS[model.lower()]
+        self.asr_model = get_model(self.model_name, quantized=fast_inference)
+        # The int8 model may transcribe differently, so it has results of its own
+        self.cache = create_cache(self.model_name, f"speechbrain/{self.model_name}{'-int8' if fast_inference else ''}")
 
-    def preprocess_audio(self, audio_path: str) -> str:
+    async def get_text(self, audio):
         """
-        Applies preprocessing steps to the audio file such as noise reduction, 
-        normalization, etc., and saves the processed file to a temporary location.
+        Transcribes an audio clip
+        :param audio: The path to an audio file, or a 1D waveform tensor (16kHz mono)
+        :return: The transcription
         """
+        if isinstance(audio, str):
+            audio, _ = load_waveform(audio)
 
-        waveform, sample_rate = torchaudio.load(audio_path)
-
-        # Setting the low-frequency cutoff and high-frequency cutoff of a bandpass filter
-        low_cutoff_freq = 100  # low-frequency off 100Hz
-        high_cutoff_freq = 10000  # higt-frequency off 8000Hz
+        # A batch of one, so the transcription is cached like any other
+        return (await self.get_text_batch([audio]))[0]
 
-        bandpass_filter = T.BandpassBiquad(sample_rate, low_cutoff_freq, high_cutoff_freq)
-
-        waveform_filtered = bandpass_filter(waveform)
-
-        # Save the preprocessed audio to a temporary file
-        processed_audio_path = "temp_processed_audio.wav"
-        torchaudio.save(processed_audio_path, waveform_filtered, sample_rate)
-
-        return processed_audio_path
+    async def get_text_batch(self, waveforms: list, max_batch_seconds=ASR_MAX_BATCH_SECONDS) -> list[str]:
+        """
+        Transcribes many audio clips at once. Clips are sorted by length and grouped into padded batches, such that
+        each batch holds clips of similar length and at most max_batch_seconds of audio including padding.
+        :param waveforms: List of 1D waveform tensors (16kHz mono)
+        :param max_batch_seconds: The max seconds of audio in each forward pass, a longer clip gets a batch of its own
+        :return: The transcription of each clip, in the same order as the input
+        """
+        max_batch_samples = max_batch_seconds * MODEL_SAMPLE_RATE
+
+        # Only transcribe the clips we haven't seen before
+        keys = [self.cache.key(waveform) for waveform in waveforms]
+        transcriptions = [self.cache.get(key) for key in keys]
+        missing = [i for i in range(len(waveforms)) if transcriptions[i] is None]
+        order = sorted(missing, key=lambda i: waveforms[i].shape[-1])
+
+        # Since the clips are sorted by length, the last clip of a batch decides how long the padded batch is
+        batches = []
+        for index in order:
+            if batches and (len(batches[-1]) + 1) * waveforms[index].shape[-1] <= max_batch_samples:
+                batches[-1].append(index)
+            else:
+                batches.append([index])
+
+        for batch_indices in batches:
+            batch, lengths = pad_waveforms([waveforms[i] for i in batch_indices])
+            # Inference mode skips all autograd bookkeeping, which no_grad still does
+            with metrics.timer("inference_seconds", model=self.model_name), torch.inference_mode():
+                predicted_words, predicted_tokens = self.asr_model.transcribe_batch(batch, lengths)
+            metrics.increment("inference_clips_total", len(batch_indices), model=self.model_name)
+            for i, words in zip(batch_indices, predicted_words):
+                transcriptions[i] = words
+                self.cache.put(keys[i], words)
+
+        return transcriptions
 
 
 async def main():
@@ -4,3 +4,6 @@ class SpeechClass:
 
     async def get_text(self, audio):
         pass
+
+    async def get_text_batch(self, audio: list) -> list[str]:
+        pass
@@ -0,0 +1,240 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+import numpy as np
+
+# Where the transcripts are kept
+RESULTS_DATABASE = os.path.join("results", "results.db")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    status TEXT NOT NULL,
+    speaker TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    text TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at);
+CREATE TABLE IF NOT EXISTS runs (
+    job_id TEXT NOT NULL REFERENCES jobs (job_id),
+    position INTEGER NOT NULL,
+    speaker TEXT,
+    start_seconds REAL NOT NULL,
+    end_seconds REAL NOT NULL,
+    text TEXT NOT NULL,
+    PRIMARY KEY (job_id, position)
+);
+CREATE INDEX IF NOT EXISTS runs_speaker ON runs (speaker);
+CREATE TABLE IF NOT EXISTS guests (
+    job_id TEXT NOT NULL REFERENCES jobs (job_id),
+    name TEXT NOT NULL,
+    samples INTEGER NOT NULL,
+    embedding BLOB NOT NULL,
+    PRIMARY KEY (job_id, name)
+);
+"""
+
+
+def format_transcript(runs: list[dict]) -> str:
+    """
+    Formats the speaker runs of a meeting as a transcript, one line per run
+    :param runs: The runs, with the name of their speaker (or None) and their text
+    :return: The transcript
+    """
+    text = ""
+    for run in runs:
+        # If the text is empty, then we can skip the run
+        if not run["text"]:
+            continue
+
+        # [Speaker] Text dialogue goes here...!
+        text += f"[{run['speaker'] or 'Unknown Speaker'}] {run['text']}\n"
+    return text
+
+
+class ResultStore:
+    """
+    SQLite database of the jobs and their transcripts, indexed by job id. Every job is added when it is received and
+    updated when it starts and finishes, so a client can look up where its job is with the id it got in the
+    acknowledgement. The transcript of a meeting is stored as text and as the speaker runs it consists of, with their
+    offsets in seconds. The unknown speakers of a meeting are kept with their mean embedding, so they can be enrolled
+    later, see SpeakerRecognition.Guests.
+
+    Only the server process writes to the store. The database is in WAL mode without syncing every commit, so the
+    writes are fast enough to do on the event loop.
+    """
+
+    def __init__(self, database=RESULTS_DATABASE):
+        self.database = database
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+
+    def open(self):
+        if os.path.dirname(self.database):
+            os.makedirs(os.path.dirname(self.database), exist_ok=True)
+        self.connection = sqlite3.connect(self.database, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def execute(self, statement: str, parameters=()) -> sqlite3.Cursor:
+        if self.connection is None:
+            self.open()
+        with self.lock, self.connection:
+            return self.connection.execute(statement, parameters)
+
+    def add_job(self, job_id: str, job_type: str, speaker: Optional[str] = None, status="queued"):
+        """
+        Adds a job that was received, a job that is already in the store (sent again by the client) is kept as it is
+        :param job_id: The id of the job
+        :param job_type: meeting, enroll or stream
+        :param speaker: The speaker to enroll
+        :param status: queued, or running for a stream
+        :return:
+        """
+        self.execute("INSERT OR IGNORE INTO jobs (job_id, type, status, speaker, created_at) VALUES (?, ?, ?, ?, ?)",
+                     (job_id, job_type, status, speaker, time.time()))
+
+    def start(self, job_id: str):
+        self.execute("UPDATE jobs SET status = 'running', started_at = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def finish(self, job_id: str, text: Optional[str] = None, runs: Optional[list[dict]] = None,
+               guests: Optional[list[dict]] = None):
+        """
+        Stores the transcript of a job that is done
+        :param job_id: The id of the job
+        :param text: The transcript, None for an enrollment
+        :param runs: The speaker runs of the transcript, with their speaker, start and end in seconds, and text
+        :param guests: The unknown speakers of the transcript, with their name, number of segments and mean embedding,
+            see Guests.label_guests
+        :return:
+        """
+        if self.connection is None:
+            self.open()
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status = 'done', finished_at = ?, text = ?, error = NULL "
+                                    "WHERE job_id = ?", (time.time(), text, job_id))
+            self.connection.execute("DELETE FROM runs WHERE job_id = ?", (job_id,))
+            self.connection.executemany(
+                "INSERT INTO runs (job_id, position, speaker, start_seconds, end_seconds, text) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(job_id, position, run["speaker"], run["start"], run["end"], run["text"])
+                 for position, run in enumerate(runs or [])])
+            self.connection.execute("DELETE FROM guests WHERE job_id = ?", (job_id,))
+            self.connection.executemany(
+                "INSERT INTO guests (job_id, name, samples, embedding) VALUES (?, ?, ?, ?)",
+                [(job_id, guest["name"], guest["samples"], np.asarray(guest["embedding"], dtype=np.float32).tobytes())
+                 for guest in guests or []])
+
+    def fail(self, job_id: str, error: str):
+        self.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = ? WHERE job_id = ?",
+                     (time.time(), error, job_id))
+
+    def get(self, job_id: str) -> Optional[dict]:
+        """
+        Looks up a job
+        :param job_id: The id of the job
+        :return: The job with its status, timestamps, text and runs, or None if there is no such job
+        """
+        job = self.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if job is None:
+            return None
+        runs = self.execute("SELECT speaker, start_seconds, end_seconds, text FROM runs WHERE job_id = ? "
+                            "ORDER BY position", (job_id,)).fetchall()
+        return {**dict(job), "runs": [{"speaker": run["speaker"], "start": run["start_seconds"],
+                                       "end": run["end_seconds"], "text": run["text"]} for run in runs]}
+
+    def get_guests(self, job_id: str) -> list[dict]:
+        """
+        Looks up the unknown speakers of a meeting
+        :param job_id: The id of the meeting
+        :return: The guests with their name, number of segments and mean embedding, in the order they first spoke
+        """
+        guests = self.execute("SELECT name, samples, embedding FROM guests WHERE job_id = ? ORDER BY rowid",
+                              (job_id,)).fetchall()
+        return [{"name": guest["name"], "samples": guest["samples"],
+                 "embedding": np.frombuffer(guest["embedding"], dtype=np.float32)} for guest in guests]
+
+    def rename_speaker(self, job_id: str, name: str, new_name: str):
+        """
+        Renames a speaker in the transcript of a job, e.g. a guest that was enrolled. A guest of that name is removed.
+        :param job_id: The id of the job
+        :param name: The speaker to rename
+        :param new_name: The new name of the speaker
+        :return:
+        """
+        if self.connection is None:
+            self.open()
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE runs SET speaker = ? WHERE job_id = ? AND speaker = ?",
+                                    (new_name, job_id, name))
+            self.connection.execute("DELETE FROM guests WHERE job_id = ? AND name = ?", (job_id, name))
+            runs = self.connection.execute("SELECT speaker, text FROM runs WHERE job_id = ? ORDER BY position",
+                                           (job_id,)).fetchall()
+            self.connection.execute("UPDATE jobs SET text = ? WHERE job_id = ?",
+                                    (format_transcript([dict(run) for run in runs]), job_id))
+
+    def list_jobs(self, limit=20, speaker: Optional[str] = None) -> list[dict]:
+        """
+        Lists the latest jobs, without their runs
+        :param limit: The max number of jobs
+        :param speaker: Only the meetings in which this speaker spoke
+        :return: The jobs, newest first
+        """
+        if speaker:
+            rows = self.execute("SELECT * FROM jobs WHERE job_id IN (SELECT job_id FROM runs WHERE speaker = ?) "
+                                "ORDER BY created_at DESC LIMIT ?", (speaker, limit))
+        else:
+            rows = self.execute("SELECT * FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,))
+        return [dict(row) for row in rows.fetchall()]
+
+
+# The result store of the server
+results = ResultStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Looks up jobs and their transcripts in the result store")
+    parser.add_argument("job_id", nargs="?", help="The job to show, the latest jobs are listed if not given")
+    parser.add_argument("--speaker", help="Only list the meetings in which this speaker spoke")
+    parser.add_argument("--limit", type=int, default=20, help="The number of jobs to list")
+    parser.add_argument("--json", action="store_true", help="Print the jobs as JSON")
+    args = parser.parse_args()
+
+    if args.job_id:
+        job = results.get(args.job_id)
+        if job is None:
+            print(f"No job {args.job_id}")
+        elif args.json:
+            print(json.dumps(job, indent=2))
+        else:
+            print(f"{job['type']} job {job['job_id']}: {job['status']}" +
+                  (f" ({job['error']})" if job["error"] else ""))
+            print(job["text"] or "")
+        return
+
+    jobs = results.list_jobs(args.limit, args.speaker)
+    if args.json:
+        print(json.dumps(jobs, indent=2))
+        return
+    for job in jobs:
+        print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['created_at']))} {job['job_id']} "
+              f"{job['type']} {job['status']}")
+
+
+if __name__ == '__main__':
+    main()
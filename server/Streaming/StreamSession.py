@@ -0,0 +1,167 @@
+import asyncio
+import logging
+from typing import Callable, Optional
+
+# Bytes per sample of the raw 16-bit PCM audio that the clients stream
+BYTES_PER_SAMPLE = 2
+# Seconds to wait for a missing chunk before it is skipped, the clients don't send a chunk again once it is lost
+MISSING_CHUNK_SECONDS = 2.0
+# Max number of chunks held back behind a missing chunk, the missing chunk is skipped when there are more
+MAX_PENDING_CHUNKS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class StreamSession:
+    """
+    A live meeting that a client streams to the server in chunks. The chunks are put back in order by their sequence
+    number, and every time a window of audio fills up it is processed and its text is added to the speaker runs of the
+    transcript. A chunk that doesn't arrive within MISSING_CHUNK_SECONDS (or before MAX_PENDING_CHUNKS later chunks) is
+    skipped, and replaced by silence so the offsets of the later chunks stay right.
+    """
+
+    def __init__(self, session_id: str, process_window: Callable, sample_rate: int, window_samples: int,
+                 timeout: float, on_done: Optional[Callable] = None):
+        """
+        :param session_id: The id of the session, chosen by the client
+        :param process_window: Coroutine function that takes the raw PCM bytes of a window and returns a tuple of the
+            speaker name (or None) and the text of the window
+        :param sample_rate: The sample rate of the stream
+        :param window_samples: The number of samples in each window
+        :param timeout: Seconds without new audio before the session is closed, in case the client disappeared
+        :param on_done: Called with the session when the transcript is complete
+        """
+        self.session_id = session_id
+        self.process_window = process_window
+        self.window_bytes = window_samples * BYTES_PER_SAMPLE
+        self.timeout = timeout
+        self.on_done = on_done
+        self.bytes_per_second = sample_rate * BYTES_PER_SAMPLE
+        # The speaker runs of the transcript so far, like the runs of a whole meeting (see process_audio)
+        self.runs: list[dict] = []
+
+        # Chunks that arrived before the chunks in front of them, by sequence number
+        self.pending_chunks: dict[int, bytes] = {}
+        self.next_sequence = 0
+        self.end_sequence: Optional[int] = None
+        # The length of the last chunk, which is the length of the silence that replaces a missing chunk
+        self.chunk_bytes = 0
+        # Skips the missing chunk once MISSING_CHUNK_SECONDS have passed
+        self.skip_timer: Optional[asyncio.TimerHandle] = None
+        # Audio that doesn't fill a window yet
+        self.buffer = bytearray()
+        # Full windows waiting to be processed, None marks the end of the session
+        self.windows = asyncio.Queue()
+
+        self.task = asyncio.create_task(self.run())
+
+    def add_chunk(self, sequence: int, pcm: bytes):
+        if sequence < self.next_sequence:
+            logger.debug("Ignoring duplicate chunk %d of session %s", sequence, self.session_id)
+            return
+
+        self.pending_chunks[sequence] = pcm
+        self.chunk_bytes = len(pcm)
+        self.add_pending_chunks()
+        if len(self.pending_chunks) > MAX_PENDING_CHUNKS:
+            self.skip_missing_chunks()
+
+    def add_pending_chunks(self):
+        """
+        Adds the chunks that are next in order to the buffer, and queues the windows that fill up
+        :return:
+        """
+        while self.next_sequence in self.pending_chunks:
+            self.buffer += self.pending_chunks.pop(self.next_sequence)
+            self.next_sequence += 1
+        while len(self.buffer) >= self.window_bytes:
+            self.windows.put_nowait(bytes(self.buffer[:self.window_bytes]))
+            del self.buffer[:self.window_bytes]
+
+        self.check_finished()
+
+        # Wait for the missing chunk for a while, if there is one
+        missing = self.pending_chunks or (self.end_sequence is not None and self.next_sequence < self.end_sequence)
+        if missing and self.skip_timer is None:
+            self.skip_timer = asyncio.get_running_loop().call_later(MISSING_CHUNK_SECONDS, self.skip_missing_chunks)
+        elif not missing and self.skip_timer is not None:
+            self.skip_timer.cancel()
+            self.skip_timer = None
+
+    def skip_missing_chunks(self):
+        """
+        Gives up on the missing chunks in front of the first chunk that did arrive (or in front of the end), and goes on
+        with the chunks after them
+        :return:
+        """
+        if self.skip_timer is not None:
+            self.skip_timer.cancel()
+            self.skip_timer = None
+        next_sequence = min(self.pending_chunks) if self.pending_chunks else self.end_sequence
+        if next_sequence is None or next_sequence <= self.next_sequence:
+            return
+
+        missing = next_sequence - self.next_sequence
+        logger.warning(f"Skipping {missing} missing chunks of session {self.session_id} from {self.next_sequence}")
+        # At most MAX_PENDING_CHUNKS of silence, a chunk far ahead of the others shouldn't blow up the buffer
+        self.buffer += bytes(min(missing, MAX_PENDING_CHUNKS) * self.chunk_bytes)
+        self.next_sequence = next_sequence
+        self.add_pending_chunks()
+
+    def finish(self, sequence: int):
+        """
+        Marks the end of the session
+        :param sequence: The sequence number after the last chunk, i.e. the number of chunks in the session
+        :return:
+        """
+        self.end_sequence = sequence
+        self.add_pending_chunks()
+
+    def check_finished(self):
+        if self.end_sequence is None or self.next_sequence < self.end_sequence:
+            return
+
+        # Process whatever is left, even though it doesn't fill a window
+        if self.buffer:
+            self.windows.put_nowait(bytes(self.buffer))
+            self.buffer.clear()
+        self.windows.put_nowait(None)
+        self.end_sequence = None
+        self.pending_chunks.clear()
+
+    async def run(self):
+        # Offset of the next window in the stream
+        offset = 0
+        while True:
+            try:
+                window = await asyncio.wait_for(self.windows.get(), self.timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"No audio received for session {self.session_id} in {self.timeout} seconds, closing...")
+                break
+            if window is None:
+                break
+
+            start = offset / self.bytes_per_second
+            offset += len(window)
+            try:
+                speaker_name, text = await self.process_window(window)
+            except Exception as e:
+                logger.exception(f"An error occurred while processing a window of session {self.session_id}: {e}")
+                continue
+            # If the text is empty, then we can skip the window
+            if not text:
+                continue
+
+            # Windows of the same speaker continue the same run
+            if self.runs and self.runs[-1]["speaker"] == speaker_name:
+                self.runs[-1]["text"] += f" {text}"
+                self.runs[-1]["end"] = offset / self.bytes_per_second
+            else:
+                self.runs.append({"speaker": speaker_name, "start": start, "end": offset / self.bytes_per_second,
+                                  "text": text})
+
+        if self.skip_timer is not None:
+            self.skip_timer.cancel()
+        logger.info(f"Finished transcript of session {self.session_id} with {len(self.runs)} speaker runs")
+        if self.on_done:
+            self.on_done(self)
@@ -1,85 +1,521 @@
+import argparse
 import asyncio
-import math
+import functools
+import json
+import logging
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional
 import aiofiles
 import os
+import time
 import uuid
 import zmq
 import zmq.asyncio
-import wave
+import torch
+import torchaudio
 from pydub import AudioSegment
 
 # Import models
-from SpeechRecognition.SpeechBrain import SpeechBrain as Speech
+from SpeechRecognition.SpeechBrain import SpeechBrain as Speech, ASR_MODELS
 from SpeakerRecognition.SpeechBrain import SpeechBrain as Speaker
-
-# Initialize models
+from AudioProcessing.Decoding import read_windows, pcm_to_waveform, convert_to_pcm_wav, MODEL_SAMPLE_RATE
+from AudioProcessing.Preprocessing import preprocessor
+from Messaging.Protocol import parse_message, peek_header, build_acknowledgement
+from Streaming.StreamSession import StreamSession
+from Models.ModelRegistry import preload_models, warm_up_models
+from AudioProcessing.Segmentation import split_segments, merge_speaker_runs
+from AudioProcessing.VoiceActivity import detect_speech
+from Monitoring.Metrics import metrics, serve_metrics
+from Caching.AudioCache import audio_cache
+from Distributed.Broker import Broker
+from Distributed.Worker import Worker
+from Storage.ResultStore import results, format_transcript
+from SpeakerRecognition.Guests import label_guests, GUEST_SIMILARITY_THRESHOLD
+
+# Initialize models, in the server process these stay None since the models are loaded by the worker processes
 speech: Optional[Speech] = None
 speaker: Optional[Speaker] = None
+worker_pool: Optional[ProcessPoolExecutor] = None
+# In broker mode, the jobs go to the workers that are connected to the broker instead of the worker pool
+broker: Optional[Broker] = None
+# Finished jobs are published here, see SERVER_RESULT_PORT
+result_socket: Optional[zmq.asyncio.Socket] = None
+# Ids of the last received jobs, oldest first
+recent_job_ids: OrderedDict = OrderedDict()
+# Ids of the last stream sessions that are done, oldest first. Their transcript is final, so late chunks are dropped.
+finished_session_ids: OrderedDict = OrderedDict()
 
 SERVER_PORT = "5555"
+SERVER_REQUEST_PORT = "5556"
+# Clients subscribe to the results of their jobs here, every finished job is published with its job id as topic. The
+# result of a job can also be fetched on SERVER_REQUEST_PORT, see Storage.ResultStore.
+SERVER_RESULT_PORT = "5558"
+# local: run the jobs in worker processes on this host. broker: receive the messages of the clients and send the jobs
+# to workers on any host (see Distributed.Broker). worker: run the jobs of a broker (see Distributed.Worker).
+SERVER_MODE = "local"
+# Workers connect to the broker here
+BROKER_WORKER_PORT = "5557"
+BROKER_ADDRESS = f"tcp://localhost:{BROKER_WORKER_PORT}"
+# Max number of jobs that the broker hands out to its workers or holds for them at once, the server stops receiving
+# when these and the job queue are full
+BROKER_MAX_JOBS = 32
+# Number of jobs a worker is sent at the same time, they run one after the other (see Distributed.Worker)
+WORKER_CAPACITY = 1
 SECONDS_PER_AUDIO_SEGMENT = 2
+# The speech recognition model, see SpeechRecognition.SpeechBrain.ASR_MODELS
+ASR_MODEL = "wav2vec2"
+# Load the models of a worker at the same time
+PARALLEL_MODEL_LOADING = True
+# Use int8 versions of the models, faster on the CPU but slightly less accurate. Check the accuracy on your own audio
+# with Benchmark.AccuracyCheck before turning this on.
+FAST_INFERENCE = False
+# Threads that torch uses in each worker, None to split the cores evenly between the workers
+TORCH_THREADS_PER_WORKER: Optional[int] = None
+# Save each segment to the segment directory of the audio cache, only needed for debugging since the models use the
+# audio in memory. The segment files are deleted when the job is done.
+SAVE_SEGMENT_FILES = False
+# Only send the speech to the models, see AudioProcessing.VoiceActivity
+VOICE_ACTIVITY_DETECTION = True
+# Split the speech at the speaker changes instead of into segments of SECONDS_PER_AUDIO_SEGMENT, such that turns
+# aren't cut mid-word and the speaker model runs once over the speech, see SpeechBrain.recognize_turns. Check the
+# accuracy on your own audio with Benchmark.Benchmark --adaptive before turning this on.
+ADAPTIVE_SEGMENTATION = False
+# The min and max length of a speaker turn with ADAPTIVE_SEGMENTATION, speaker changes that would give a shorter turn
+# are skipped and longer turns are split
+MIN_TURN_SECONDS = 1.0
+MAX_TURN_SECONDS = 20
+# Tell the unknown speakers of a meeting apart as Guest 1, Guest 2 and so on instead of a single Unknown Speaker, see
+# SpeakerRecognition.Guests. A guest can be enrolled afterwards with python -m SpeakerRecognition.Guests.
+CLUSTER_UNKNOWN_SPEAKERS = True
+# Pauses up to this long don't split a speaker run, so a speaker taking a breath stays on the same line
+MAX_RUN_GAP_SECONDS = 1.5
+# Meetings are decoded and processed in windows of this many seconds, so a meeting of any length fits in memory
+PROCESSING_WINDOW_SECONDS = 120
+# Number of worker processes, each of them holds its own copy of the models
+NUM_WORKERS = 2
+# Max number of received jobs waiting for a worker, the server stops receiving when the queue is full
+JOB_QUEUE_SIZE = 8
+# Seconds without new audio before a live meeting is closed
+STREAM_SESSION_TIMEOUT = 60
+# Number of job ids (and ids of finished stream sessions) to remember, to recognize messages that a client sent again
+RECENT_JOB_IDS_SIZE = 1000
+# Seconds between deleting the uploaded audio that is too old, see Caching.AudioCache
+AUDIO_CACHE_CLEANUP_INTERVAL = 10 * 60
+# Prometheus scrapes the metrics of the server here, see Monitoring.Metrics. Only local by default.
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9100
+# DEBUG shows the details of every message, segment and speaker run
+LOG_LEVEL = "INFO"
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(processName)s] %(name)s: %(message)s"
+
+logger = logging.getLogger("server")
 
 
 async def server() -> None:
+    global worker_pool, broker, result_socket
+
+    results.open()
+    # Index the uploaded audio of earlier runs, so it counts towards the budget of the audio cache
+    audio_cache.load()
+    asyncio.create_task(clean_audio_cache())
+
+    if SERVER_MODE == "broker":
+        # The workers load their models before they register, so they never get a job while cold
+        broker = Broker(f"tcp://*:{BROKER_WORKER_PORT}")
+        await broker.start()
+        num_job_workers = BROKER_MAX_JOBS
+    else:
+        # Load the models in every worker before we accept any messages, so no request waits for a cold start
+        worker_pool = create_worker_pool()
+        await wait_for_workers()
+        num_job_workers = NUM_WORKERS
+
     context = zmq.asyncio.Context()
+    # Old clients push their messages here without expecting a reply
     socket = context.socket(zmq.PULL)
+    # Don't buffer more messages than fit in the job queue, so a full queue pushes back on the clients
+    socket.setsockopt(zmq.RCVHWM, JOB_QUEUE_SIZE)
     socket.bind(f"tcp://*:{SERVER_PORT}")
+    # Clients connect here with a DEALER socket, and every message is acknowledged once it is queued
+    request_socket = context.socket(zmq.ROUTER)
+    request_socket.setsockopt(zmq.RCVHWM, JOB_QUEUE_SIZE)
+    request_socket.bind(f"tcp://*:{SERVER_REQUEST_PORT}")
+    result_socket = context.socket(zmq.PUB)
+    result_socket.bind(f"tcp://*:{SERVER_RESULT_PORT}")
+
+    await serve_metrics(METRICS_HOST, METRICS_PORT)
+
+    logger.info(f"Server ready, listening on port {SERVER_PORT} and {SERVER_REQUEST_PORT}, publishing results on "
+                f"{SERVER_RESULT_PORT}, metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+    # The models run in worker processes, so receiving messages never waits for a job to finish
+    jobs = asyncio.Queue(maxsize=JOB_QUEUE_SIZE)
+    workers = [asyncio.create_task(job_worker(jobs)) for _ in range(num_job_workers)]
+    # Live meetings that clients are streaming, by session id
+    stream_sessions: dict[str, StreamSession] = {}
+
+    # The job workers are awaited as well, so an error that kills one of them stops the server instead of silently
+    # shrinking the pool
+    await asyncio.gather(receive_messages(socket, jobs, stream_sessions),
+                         receive_messages(request_socket, jobs, stream_sessions, acknowledge=True), *workers)
+
+
+async def clean_audio_cache() -> None:
+    """
+    Deletes the uploaded audio that is too old every AUDIO_CACHE_CLEANUP_INTERVAL seconds, the size budget is enforced
+    whenever a file is added
+    :return:
+    """
+    while True:
+        await asyncio.sleep(AUDIO_CACHE_CLEANUP_INTERVAL)
+        audio_cache.enforce()
+
+
+async def receive_messages(socket, jobs: asyncio.Queue, stream_sessions: dict, acknowledge=False) -> None:
+    """
+    Receives messages from a socket and handles them
+    :param socket: A PULL socket, or a ROUTER socket if acknowledge is set
+    :param jobs: The job queue
+    :param stream_sessions: The active stream sessions by session id
+    :param acknowledge: Reply to every message with an acknowledgement, after the message is handled
+    :return:
+    """
+    while True:
+        # Receive without copying, the audio frame is only copied once when it is saved
+        frames = await socket.recv_multipart(copy=False)
+        # The ROUTER socket puts the identity of the client in front, which we need to reply to it
+        identity = frames.pop(0).bytes if acknowledge else None
+
+        error = None
+        header = {}
+        result = None
+        try:
+            header, audio_clip = parse_message(frames)
+            if header["type"] == "fetch":
+                if not acknowledge:
+                    raise ValueError("Results can only be fetched on the request port")
+                metrics.increment("messages_received_total", type="fetch")
+                result = results.get(header["job_id"])
+            else:
+                await handle_message(header, audio_clip, jobs, stream_sessions)
+        except ValueError as e:
+            logger.warning(f"Invalid message: {e}")
+            metrics.increment("messages_rejected_total")
+            header = header or peek_header(frames)
+            error = str(e)
+        except Exception as e:
+            logger.exception(f"An error occurred while handling the message: {e}")
+            metrics.increment("messages_rejected_total")
+            error = str(e)
+
+        if acknowledge:
+            await socket.send_multipart([identity, build_acknowledgement(header, error, result)])
+
+
+async def handle_message(header: dict, audio_clip: memoryview, jobs: asyncio.Queue, stream_sessions: dict) -> None:
+    processing_type = header["type"]
+    metrics.increment("messages_received_total", type=processing_type)
+    metrics.increment("bytes_received_total", len(audio_clip), type=processing_type)
+    logger.debug("Received %s message (job %s, codec %s) with audio of length %d", processing_type, header["job_id"],
+                 header["codec"], len(audio_clip))
+
+    if processing_type in ("stream", "stream-end"):
+        handle_stream_message(header, audio_clip, stream_sessions)
+        return
+
+    # Clients resend a message if the acknowledgement got lost, don't process it twice
+    if header["job_id"] in recent_job_ids:
+        logger.info(f"Job {header['job_id']} was already received, skipping it")
+        return
+
+    # Decompress FLAC (and convert WAV of other sample formats) here, so the rest of the pipeline only ever sees 16-bit
+    # PCM WAV files that it can memory-map. The file is converted in blocks, in a thread since a long meeting takes a
+    # while and the event loop has to keep receiving messages in the meantime.
+    received_file = await save_audio(audio_clip, audio_id=header["job_id"], extension=header["codec"])
+    try:
+        audio_file = await asyncio.to_thread(convert_to_pcm_wav, received_file, audio_cache.get_path(header["job_id"]))
+    except Exception:
+        audio_cache.remove([received_file])
+        raise
+    logger.debug("Saved audio clip to %s", audio_file)
+    # The file stays pinned in the audio cache until its job is done
+    audio_cache.add(audio_file)
+    results.add_job(header["job_id"], processing_type, header["speaker"])
+
+    # If the queue is full, we wait here and stop receiving until a worker picks up a job
+    if jobs.full():
+        logger.warning(f"Job queue is full ({jobs.qsize()} jobs), waiting for a worker...")
+    await jobs.put((processing_type, header["job_id"], audio_file, header["speaker"]))
+    metrics.set("job_queue_depth", jobs.qsize())
+    logger.info(f"Queued {processing_type} job for {audio_file} ({jobs.qsize()} jobs in queue)")
+
+    recent_job_ids[header["job_id"]] = True
+    if len(recent_job_ids) > RECENT_JOB_IDS_SIZE:
+        recent_job_ids.popitem(last=False)
+
+
+def handle_stream_message(header: dict, pcm: memoryview, stream_sessions: dict) -> None:
+    """
+    Handles a chunk of a live meeting, or the end of one. For the end, the sequence number is the number of chunks.
+    :param header: The header of the message, job_id is the id of the session
+    :param pcm: The raw 16-bit PCM audio of the chunk
+    :param stream_sessions: The active sessions by session id
+    :return:
+    """
+    session_id, sequence = header["job_id"], header["sequence"]
+
+    def end_session(done_session: StreamSession):
+        stream_sessions.pop(done_session.session_id, None)
+        finished_session_ids[done_session.session_id] = True
+        if len(finished_session_ids) > RECENT_JOB_IDS_SIZE:
+            finished_session_ids.popitem(last=False)
+        metrics.set("stream_sessions", len(stream_sessions))
+        results.finish(done_session.session_id, format_transcript(done_session.runs), done_session.runs)
+        publish_result(done_session.session_id)
+
+    # A chunk that arrives late (or is sent again) after the session is done would start a new, empty session, which
+    # would overwrite the transcript when it times out
+    if session_id in finished_session_ids:
+        logger.debug("Dropping %s message %d of finished session %s", header["type"], sequence, session_id)
+        return
+
+    session = stream_sessions.get(session_id)
+    if not session:
+        logger.info(f"Starting stream session {session_id}")
+        process_window = functools.partial(process_stream_window, sample_rate=header["sample_rate"])
+        session = StreamSession(session_id, process_window, sample_rate=header["sample_rate"],
+                                window_samples=SECONDS_PER_AUDIO_SEGMENT * header["sample_rate"],
+                                timeout=STREAM_SESSION_TIMEOUT, on_done=end_session)
+        stream_sessions[session_id] = session
+        metrics.set("stream_sessions", len(stream_sessions))
+        results.add_job(session_id, "stream", status="running")
+        results.start(session_id)
+
+    if header["type"] == "stream-end":
+        logger.info(f"Stream session {session_id} ended after {sequence} chunks")
+        session.finish(sequence)
+    else:
+        session.add_chunk(sequence, pcm)
 
-    print(f"Server listening on port {SERVER_PORT}")
 
-    while True:
-        message = await socket.recv()
-        print(f"Received message of length {len(message)}")
+async def process_stream_window(pcm: bytes, sample_rate: int) -> tuple[Optional[str], str]:
+    if broker:
+        result = await broker.submit("window", pcm, {"sample_rate": sample_rate})
+        return result["speaker"], result["text"]
 
-        if b':' not in message or (message.split(b':')[0] != b'meeting' and message.split(b':')[0] != b'enroll'):
-            print(f"Invalid message {message}")
-            continue
+    loop = asyncio.get_running_loop()
+    result, worker_metrics = await loop.run_in_executor(worker_pool, run_stream_window, pcm, sample_rate)
+    metrics.merge(worker_metrics)
+    return result
 
-        audio_clip = b':'.join(message.split(b':')[2:])
-        print(f"Received audio clip of length {len(audio_clip)}")
 
-        audio_file = await save_audio(audio_clip)
-        print(f"Saved audio clip to {audio_file}")
+def create_worker_pool() -> ProcessPoolExecutor:
+    # Spawn instead of fork, so the workers don't inherit any torch threads or the ZMQ context
+    return ProcessPoolExecutor(max_workers=NUM_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=init_worker)
 
-        processing_type = message.split(b':')[0].decode("utf-8")
-        print(f"Processing audio using type = {processing_type}...")
-        data = message.split(b':')[1].split(b':')[0].decode("utf-8")
 
-        if processing_type == "enroll":
-            print(f"Enrolling speaker {data}...")
-            speaker_person = await enroll_speaker(audio_file, data)
-            if not speaker_person:
-                print(f"Failed to enroll speaker {data}!")
-            else:
-                print(f"Successfully enrolled speaker {speaker_person.name}!")
-        else:
-            print(f"Processing audio...")
-            result = await process_audio(audio_file)
-            print(f"Result:\n{result}")
+async def wait_for_workers() -> None:
+    """
+    Starts all worker processes and waits until they have loaded their models
+    :return:
+    """
+    logger.info(f"Starting {NUM_WORKERS} workers and loading models...")
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    # A task for every worker at once makes the pool start all of them, and a task only runs after the initializer
+    worker_ids = await asyncio.gather(*[loop.run_in_executor(worker_pool, get_worker_id) for _ in range(NUM_WORKERS)])
+    logger.info(f"Workers {sorted(set(worker_ids))} are ready after {time.perf_counter() - start:.1f} seconds")
+
+
+def get_worker_id() -> int:
+    # Give the other workers a moment to pick up their task, so every worker gets one
+    time.sleep(0.1)
+    return os.getpid()
+
 
-            # Save the result to a file
-            if not os.path.exists("results"):
-                os.mkdir("results")
+def init_worker() -> None:
+    """
+    Initializer of the worker processes, loads and warms up the models
+    """
+    global speaker, speech
+    # The worker processes are spawned, so they don't inherit the logging configuration of the server
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
 
-            async with aiofiles.open(f"results/{str(uuid.uuid4())}.txt", "w") as f:
-                await f.write(result)
+    # By default every worker would use all cores, and the workers would fight over them
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER or max(1, (os.cpu_count() or 1) // NUM_WORKERS))
 
+    model_names = ["spkrec-ecapa-voxceleb", ASR_MODELS[ASR_MODEL]]
+    preload_models(model_names, parallel=PARALLEL_MODEL_LOADING, quantized=FAST_INFERENCE)
+    warm_up_models(model_names, quantized=FAST_INFERENCE)
 
-async def save_audio(audio_clip, is_segment=False, audio_id=None) -> str:
-    # If audio directory does not exist, create it
-    if not os.path.exists("audio_cache"):
-        os.mkdir("audio_cache")
-    if is_segment:
-        if not os.path.exists("audio_cache/segments"):
-            os.mkdir("audio_cache/segments")
+    speaker = Speaker(fast_inference=FAST_INFERENCE)
+    speech = Speech(ASR_MODEL, fast_inference=FAST_INFERENCE)
+    asyncio.run(speaker.load())
 
+
+async def job_worker(jobs: asyncio.Queue) -> None:
+    """
+    Takes jobs from the queue and runs them in the worker pool or on the workers of the broker, one at a time
+    :param jobs: The queue of (processing_type, job_id, audio_file, data) jobs
+    :return:
+    """
+    global worker_pool
+    loop = asyncio.get_running_loop()
+
+    while True:
+        processing_type, job_id, audio_file, data = await jobs.get()
+        metrics.set("job_queue_depth", jobs.qsize())
+        status = "failed"
+        try:
+            results.start(job_id)
+            with metrics.timer("job_seconds", type=processing_type):
+                if broker:
+                    result = await submit_job(processing_type, audio_file, data)
+                else:
+                    result, worker_metrics = await loop.run_in_executor(worker_pool, run_job, processing_type,
+                                                                        audio_file, data)
+                    metrics.merge(worker_metrics)
+            with metrics.timer("stage_seconds", stage="write"):
+                await write_results(job_id, result)
+            status = "done"
+        except BrokenProcessPool:
+            # A worker process died (e.g. out of memory), so replace the pool for the jobs after this one
+            logger.error(f"Worker process died while processing {audio_file}, restarting worker pool...")
+            worker_pool.shutdown(wait=False)
+            worker_pool = create_worker_pool()
+            results.fail(job_id, "The worker process died")
+            publish_result(job_id)
+        except Exception as e:
+            logger.exception(f"An error occurred while processing {audio_file}: {e}")
+            results.fail(job_id, str(e))
+            publish_result(job_id)
+        finally:
+            metrics.increment("jobs_total", type=processing_type, status=status)
+            audio_cache.release(audio_file)
+            jobs.task_done()
+
+
+async def submit_job(processing_type: str, audio_file: str, data: str) -> dict:
+    """
+    Runs a job on one of the workers of the broker. Enrolled speakers are added to the speaker store of the broker,
+    which sends them on to all workers.
+    :return: The result of the job, see handle_job
+    """
+    async with aiofiles.open(audio_file, "rb") as f:
+        audio_clip = await f.read()
+    result = await broker.submit(processing_type, audio_clip, {"speaker": data})
+
+    if processing_type == "enroll":
+        await broker.enroll(data, audio_file, result["embedding"])
+        logger.info(f"Successfully enrolled speaker {data}!")
+        return {"text": None, "runs": []}
+    logger.debug("Result:\n%s", result["text"])
+    return result
+
+
+async def handle_broker_job(job_type: str, audio_clip: memoryview, data: dict) -> dict:
+    """
+    Entrypoint of the workers of a broker, see Distributed.Worker
+    :param job_type: The processing type of the job, or window for a window of a live meeting
+    :param audio_clip: The audio of the job, a WAV file or the raw PCM of a window
+    :param data: The parameters of the job
+    :return: The result, which the broker handles in submit_job and process_stream_window
+    """
+    if job_type == "window":
+        window_speaker, text = await process_window(preprocess_window(audio_clip, data["sample_rate"]))
+        return {"speaker": window_speaker, "text": text}
+
+    audio_file = await save_audio(audio_clip, is_segment=True)
+    try:
+        if job_type == "enroll":
+            global speaker
+            if not speaker:
+                speaker = Speaker(fast_inference=FAST_INFERENCE)
+            # Only the embedding, the broker adds the speaker to the speaker store of every worker
+            embeddings = await speaker.get_embeddings(audio_file)
+            return {"embedding": embeddings.reshape(-1).tolist()}
+
+        logger.info(f"Processing {audio_file} using type = {job_type}...")
+        return await process_audio(audio_file)
+    finally:
+        audio_cache.remove([audio_file])
+
+
+def run_job(processing_type: str, audio_file: str, data: str) -> tuple[dict, dict]:
+    """
+    Entrypoint of the worker processes, each worker process loads its own models on the first job
+    :return: Tuple of the result of the job (see handle_job), and the metrics of the worker that changed during the job
+        (see Metrics.drain)
+    """
+    result = asyncio.run(handle_job(processing_type, audio_file, data))
+    return result, metrics.drain()
+
+
+def run_stream_window(pcm: bytes, sample_rate: int) -> tuple[tuple[Optional[str], str], dict]:
+    """
+    Entrypoint of the worker processes for a window of a live meeting
+    :return: Tuple of the speaker name and text of the window, and the metrics of the worker that changed
+    """
+    return asyncio.run(process_window(preprocess_window(pcm, sample_rate))), metrics.drain()
+
+
+def preprocess_window(pcm, sample_rate: int) -> torch.Tensor:
+    # Windows are not normalized, that would blow up the background noise of a quiet window to the level of speech
+    waveform = preprocessor(pcm_to_waveform(pcm), sample_rate, normalize=False)
+    metrics.increment("audio_seconds_total", waveform.shape[-1] / MODEL_SAMPLE_RATE, type="stream")
+    return waveform
+
+
+async def handle_job(processing_type: str, audio_file: str, data: str) -> dict:
+    """
+    Runs a job in a worker process
+    :return: The result of the job, the text and speaker runs of the transcript (both empty for an enrollment)
+    """
+    logger.info(f"Processing {audio_file} using type = {processing_type}...")
+    if processing_type == "enroll":
+        logger.info(f"Enrolling speaker {data}...")
+        if not await enroll_speaker(audio_file, data):
+            raise RuntimeError(f"Failed to enroll speaker {data}")
+        return {"text": None, "runs": []}
+
+    result = await process_audio(audio_file)
+    logger.debug("Result:\n%s", result["text"])
+    return result
+
+
+async def write_results(job_id: str, result: dict) -> None:
+    """
+    Saves the result of a job to the result store, and publishes it to the clients that subscribed to it
+    :param job_id: The id of the job
+    :param result: The text, speaker runs and guests of the transcript, see process_audio
+    :return:
+    """
+    results.finish(job_id, result["text"], result["runs"], result.get("guests"))
+    publish_result(job_id)
+
+
+def publish_result(job_id: str) -> None:
+    """
+    Sends a job that is done (or failed) to the clients that subscribed to it, see SERVER_RESULT_PORT
+    :param job_id: The id of the job, which is the topic
+    :return:
+    """
+    if result_socket is None:
+        return
+    result_socket.send_multipart([job_id.encode("utf-8"), json.dumps(results.get(job_id)).encode("utf-8")])
+
+
+async def save_audio(audio_clip, is_segment=False, audio_id=None, sample_rate=16000, extension="wav") -> str:
     if not audio_id:
         audio_id = str(uuid.uuid4())
 
-    # Save the audio clip to a file
-    filename = f"audio_cache{'/segments' if is_segment else ''}/{audio_id}.wav"
-    if isinstance(audio_clip, bytes):
+    # Save the audio clip to a file in the audio cache
+    filename = audio_cache.get_path(audio_id, is_segment, extension)
+    if isinstance(audio_clip, (bytes, memoryview)):
         async with aiofiles.open(filename, "wb") as f:
             await f.write(audio_clip)
 
@@ -87,129 +523,219 @@ async def save_audio(audio_clip, is_segment=False, audio_id=None) -> str:
     elif isinstance(audio_clip, AudioSegment):
         audio_clip.export(filename, format="wav")
         return filename
+    elif isinstance(audio_clip, torch.Tensor):
+        # 16-bit PCM like the clients send, in a thread so the event loop isn't blocked by a long recording
+        await asyncio.to_thread(torchaudio.save, filename,
+                                audio_clip if audio_clip.dim() == 2 else audio_clip.reshape(1, -1), sample_rate,
+                                encoding="PCM_S", bits_per_sample=16)
+        return filename
     else:
-        raise TypeError(f"Invalid audio clip type {type(audio_clip)}, expected Bytes or AudioSegment")
+        raise TypeError(f"Invalid audio clip type {type(audio_clip)}, expected Bytes, AudioSegment or Tensor")
 
 
 async def enroll_speaker(audio_file: str, speaker_name: str):
+    return (await enroll_speakers([(speaker_name, audio_file)]))[0]
+
+
+async def enroll_speakers(clips: list[tuple[str, str]]) -> list:
+    """
+    Enrolls many clips at once, with batched embeddings and a single write to the speaker store. A speaker that is
+    already enrolled gets the new clips added to its embeddings, see SpeechBrain.enroll_batch.
+    :param clips: (speaker name, audio file) of every clip
+    :return: The enrolled speaker of every clip
+    """
     global speaker
     if not speaker:
-        speaker = Speaker()
-        # Load the speakers from file, so we don't accidentally delete all speakers if the first thing we do is enroll
-        await speaker.load()
-    speaker_person = await speaker.enroll(audio_file, speaker_name)
-    if not speaker_person:
-        print(f"Failed to enroll speaker {speaker_name}!")
-    else:
-        print(f"Successfully enrolled speaker {speaker_person.name}!")
-        print("Saving speakers...")
-        await speaker.save()
-    return speaker_person
+        speaker = Speaker(fast_inference=FAST_INFERENCE)
+    # Load the speakers from file, so we don't accidentally delete all speakers if the first thing we do is enroll.
+    # This also picks up the speakers that other workers enrolled since our last job.
+    await speaker.load()
+    speaker_people = await speaker.enroll_batch(clips)
+    await speaker.save()
+    for speaker_person in dict.fromkeys(speaker_people):
+        logger.info(f"Successfully enrolled speaker {speaker_person.name}!")
+    return speaker_people
 
 
 # comment this out when testing file sending!!
-async def process_audio(audio_file: str):
-    file_id = audio_file.split("/")[1].split(".")[0]
-
-    # Load the audio file to get info from audio file
-    with wave.open(audio_file, "rb") as wave_file:
-        frame_rate = wave_file.getframerate()
-        num_frames = wave_file.getnframes()
-        num_channels = wave_file.getnchannels()
-        sample_width = wave_file.getsampwidth()
-
-    # Get duration of audio file in seconds
-    audio_duration = num_frames / frame_rate
-
-    print(f"Audio file information:\n"
-          f"- Frame rate: {frame_rate}\n"
-          f"- Number of frames: {num_frames}\n"
-          f"- Number of channels: {num_channels}\n"
-          f"- Sample width: {sample_width}\n"
-          f"- Duration: {audio_duration} seconds\n")
-
-    audio_segment = AudioSegment.from_wav(audio_file)
-
-    # Split the audio file into segments
-    segments = []
-    async with aiofiles.open(audio_file, "rb") as f:
-        for i in range(0, math.floor(audio_duration * 1000), math.floor(SECONDS_PER_AUDIO_SEGMENT * 1000)):
-            segment = audio_segment[i:i + SECONDS_PER_AUDIO_SEGMENT * 1000]
-            # Save each segment to a file
-            segment_file = await save_audio(segment, is_segment=True, audio_id=f"{file_id}-{i}")
-
-            # Add the segment to the list of segments
-            segments.append({
-                "file": segment_file,
-                "start": i,
-                "end": i + frame_rate * SECONDS_PER_AUDIO_SEGMENT
-            })
-
-    # First we want to recognize the speaker in each segment
+async def process_audio(audio_file: str) -> dict:
+    """
+    Transcribes a meeting, one window of PROCESSING_WINDOW_SECONDS at a time so the memory use doesn't grow with the
+    length of the meeting. The last speaker run of a window may go on in the next window, so its audio is carried over
+    and processed again with the next window, see process_audio_window.
+    :param audio_file: The WAV file of the meeting
+    :return: The transcript as text, as speaker runs with their speaker name (or None), start and end in seconds, and
+        text, and the guests of the meeting (see Guests.label_guests)
+    """
+    file_id = os.path.splitext(os.path.basename(audio_file))[0]
+
     global speaker
     if not speaker:
-        speaker = Speaker()
-        # Load the speakers from file
-        await speaker.load()
-
-    shift = 0
-    for i in range(len(segments)):
-        current_index = i + shift
-
-        segment = segments[current_index]
-        segments[current_index]["speaker"] = await speaker.recognize(segment["file"])
-
-        # If this speaker is the same as last segment, then we can merge the segments
-        print(f"Speaker in segment {current_index}: {segments[current_index]['speaker']}")
-        if current_index > 0: print(f"Speaker in segment {current_index - 1}: {segments[current_index - 1]['speaker']}")
-        if current_index > 0 and segments[current_index]["speaker"] == segments[current_index - 1]["speaker"]:
-            print(f"Speaker in segment {current_index} is the same as segment {current_index - 1}! Merging segments...")
-            segments[current_index - 1]["end"] = segments[current_index]["end"]
-
-            # Load both audio files into memory and merge them into one file
-            # async with aiofiles.open(segments[i - 1]["file"], "rb") as f1, aiofiles.open(segments[i]["file"], "rb") as f2:
-            #     audio1 = await f1.read()
-            #     audio2 = await f2.read()
-            #
-            #     merged_audio = audio1 + audio2
-            #     merged_audio_file = await save_audio(merged_audio, is_segment=True, audio_id=f"{file_id}-{i - 1}")
-            #     segments[i - 1]["file"] = merged_audio_file
-
-            # use pydub to merge the audio files
-            audio1_segment = AudioSegment.from_wav(segments[current_index - 1]["file"])
-            audio2_segment = AudioSegment.from_wav(segments[current_index]["file"])
-
-            merged_audio = audio1_segment + audio2_segment
-            merged_audio_file = await save_audio(merged_audio, is_segment=True,
-                                                 audio_id=f"{file_id}-{current_index - 1}")
-            segments[current_index - 1]["file"] = merged_audio_file
-
-            segments.pop(current_index)
-
-            # Since we merged the segments, we need to go back one index
-            shift -= 1
-
-    # Now, time to parse the audio file segments to get the text
-    print("Finished processing audio file segments. Getting text from each segment...")
+        speaker = Speaker(fast_inference=FAST_INFERENCE)
+    # Load the speakers from file, including the ones other workers enrolled since our last job
+    await speaker.load()
+
     global speech
     if not speech:
-        speech = Speech("wav2vec2")
+        speech = Speech(ASR_MODEL, fast_inference=FAST_INFERENCE)
 
-    for segment in segments:
-        segment["text"] = await speech.get_text(segment["file"])
-        print(f"Segment {segment['file']} text: {segment['text']}")
+    transcript_runs = []
+    segment_files = set()
+    # The audio of the last, unfinished run of the previous window, and its offset in the whole meeting
+    carry, carry_offset = None, 0
+    audio_samples = 0
 
-    # Now we can merge the text from each segment into one text
-    text = ""
-    for segment in segments:
-        # If the text is empty, then we can skip the segment
-        if not segment["text"]:
+    # Windows are decoded and preprocessed when they are needed, the whole file is never in memory
+    windows = read_windows(audio_file, PROCESSING_WINDOW_SECONDS)
+    while True:
+        with metrics.timer("stage_seconds", stage="decode"):
+            window = next(windows, None)
+        if window is None:
+            break
+        waveform, offset = window
+        audio_samples += waveform.shape[-1]
+
+        if carry is not None:
+            waveform, offset = torch.cat([carry, waveform]), carry_offset
+        runs = await process_audio_window(waveform, offset, file_id, segment_files, final=False)
+        carry = None
+
+        # Hold back the last run if it reaches the end of the window, unless it is already longer than a window
+        max_gap = int(MAX_RUN_GAP_SECONDS * MODEL_SAMPLE_RATE)
+        if runs and runs[-1]["end"] >= waveform.shape[-1] - max_gap and \
+                waveform.shape[-1] - runs[-1]["start"] < PROCESSING_WINDOW_SECONDS * MODEL_SAMPLE_RATE:
+            held_run = runs.pop()
+            # Copied, so the rest of the window can be freed
+            carry, carry_offset = waveform[held_run["start"]:].clone(), offset + held_run["start"]
+        await transcribe_runs(runs, waveform, offset, transcript_runs)
+
+    if carry is not None:
+        runs = await process_audio_window(carry, carry_offset, file_id, segment_files, final=True)
+        await transcribe_runs(runs, carry, carry_offset, transcript_runs)
+
+    audio_duration = audio_samples / MODEL_SAMPLE_RATE
+    metrics.increment("audio_seconds_total", audio_duration, type="meeting")
+    logger.info(f"Transcribed {audio_file}, {audio_duration:.1f} seconds of audio")
+
+    # The segment files are only for debugging this job, segments left behind by a crash are deleted on startup
+    audio_cache.remove(list(segment_files))
+
+    # The unknown speakers are told apart once the whole meeting is done, so a guest gets the same label in every window
+    guests = []
+    if CLUSTER_UNKNOWN_SPEAKERS:
+        with metrics.timer("stage_seconds", stage="merge"):
+            transcript_runs, guests = label_guests(transcript_runs, max_gap=MAX_RUN_GAP_SECONDS)
+
+    # Now we can merge the text from each run into one text
+    return {"text": format_transcript(transcript_runs), "runs": transcript_runs, "guests": guests}
+
+
+async def process_audio_window(waveform, offset: int, file_id: str, segment_files: set, final: bool) -> list[dict]:
+    """
+    Finds the speaker runs of a window of a meeting
+    :param waveform: The 1D waveform of the window (16kHz mono)
+    :param offset: The offset of the window in the whole meeting, in samples
+    :param file_id: The id of the meeting, for the segment files
+    :param segment_files: The set that the saved segment files are added to
+    :param final: Whether this is the audio that was carried over from the last window
+    :return: List of runs with start, end (sample offsets into the window) and speaker, and the embeddings of the runs
+        of unknown speakers with CLUSTER_UNKNOWN_SPEAKERS
+    """
+    # Only the speech needs to go through the models, silence just costs time and gives "Unknown Speaker" lines
+    speech_regions = None
+    if VOICE_ACTIVITY_DETECTION:
+        with metrics.timer("stage_seconds", stage="vad"):
+            speech_regions = detect_speech(waveform, MODEL_SAMPLE_RATE)
+        speech_samples = sum(end - start for start, end in speech_regions)
+        logger.debug("Found %d speech regions at %d%s, %.0f%% of the audio", len(speech_regions), offset,
+                     " (carried over)" if final else "", 100 * speech_samples / max(1, waveform.shape[-1]))
+
+    if ADAPTIVE_SEGMENTATION:
+        # One segment per speaker turn, whose speakers are recognized along the way
+        with metrics.timer("stage_seconds", stage="embed"):
+            segments = await speaker.recognize_turns(
+                waveform, speech_regions if speech_regions is not None else [(0, waveform.shape[-1])],
+                min_seconds=MIN_TURN_SECONDS, max_seconds=MAX_TURN_SECONDS)
+    else:
+        # Split the window into segments
+        with metrics.timer("stage_seconds", stage="segment"):
+            segments = split_segments(waveform, MODEL_SAMPLE_RATE, SECONDS_PER_AUDIO_SEGMENT, regions=speech_regions)
+    if SAVE_SEGMENT_FILES:
+        for segment in segments:
+            segment["file"] = await save_audio(segment["audio"], is_segment=True,
+                                               audio_id=f"{file_id}-{offset + segment['start']}",
+                                               sample_rate=MODEL_SAMPLE_RATE)
+            segment_files.add(segment["file"])
+
+    if not ADAPTIVE_SEGMENTATION:
+        # Recognize the speakers of all segments at once, so the model runs in a few batched passes
+        with metrics.timer("stage_seconds", stage="embed"):
+            segments = await speaker.recognize_segments(segments)
+
+    # If consecutive segments have the same speaker, then we can merge them into one run
+    with metrics.timer("stage_seconds", stage="merge"):
+        runs = merge_speaker_runs(segments, max_gap=int(MAX_RUN_GAP_SECONDS * MODEL_SAMPLE_RATE),
+                                  unknown_similarity=GUEST_SIMILARITY_THRESHOLD if CLUSTER_UNKNOWN_SPEAKERS else None)
+    logger.debug("Merged %d segments into %d speaker runs", len(segments), len(runs))
+    return runs
+
+
+async def transcribe_runs(runs: list[dict], waveform, offset: int, transcript_runs: list[dict]):
+    """
+    Transcribes the speaker runs of a window and adds them to the transcript. A run that goes on from the last run of
+    the transcript (a run longer than a window) is joined with it.
+    :param runs: The runs, see process_audio_window
+    :param waveform: The 1D waveform of the window
+    :param offset: The offset of the window in the whole meeting, in samples
+    :param transcript_runs: The runs of the transcript so far, with speaker name, start and end in seconds, and text
+    :return:
+    """
+    # The audio of a run is only sliced out of the waveform here, where we need it
+    with metrics.timer("stage_seconds", stage="asr"):
+        run_texts = await speech.get_text_batch([waveform[run["start"]:run["end"]] for run in runs])
+
+    for run, run_text in zip(runs, run_texts):
+        logger.debug("Run %d-%d text: %s", offset + run["start"], offset + run["end"], run_text)
+        # If the text is empty, then we can skip the run
+        if not run_text:
             continue
+        transcript_run = {"speaker": run["speaker"].name if run["speaker"] else None,
+                          "start": (offset + run["start"]) / MODEL_SAMPLE_RATE,
+                          "end": (offset + run["end"]) / MODEL_SAMPLE_RATE, "text": run_text}
+        if "embeddings" in run:
+            # Unknown speakers are kept apart until they are told apart at the end, see label_guests
+            transcript_run["embeddings"] = run["embeddings"]
+        previous = transcript_runs[-1] if transcript_runs else None
+        if previous and previous["speaker"] == transcript_run["speaker"] and "embeddings" not in transcript_run and \
+                transcript_run["start"] - previous["end"] <= MAX_RUN_GAP_SECONDS:
+            previous["end"] = transcript_run["end"]
+            previous["text"] += " " + transcript_run["text"]
+        else:
+            transcript_runs.append(transcript_run)
 
-        # [Speaker] Text dialogue goes here...!
-        text += f"[{segment['speaker'].name if segment['speaker'] else 'Unknown Speaker'}] {segment['text']}\n"
 
-    return text
+async def process_window(waveform) -> tuple[Optional[str], str]:
+    """
+    Recognizes the speaker and the text of a single window of a live meeting
+    :param waveform: The 1D waveform of the window (16kHz mono)
+    :return: Tuple of the speaker name (or None if not recognized) and the text
+    """
+    # Skip silent windows, so they don't cost any model time
+    if VOICE_ACTIVITY_DETECTION and not detect_speech(waveform, MODEL_SAMPLE_RATE):
+        return None, ""
+
+    global speaker
+    if not speaker:
+        speaker = Speaker(fast_inference=FAST_INFERENCE)
+    await speaker.load()
+    window_speaker = (await speaker.recognize_batch([waveform]))[0]
+
+    global speech
+    if not speech:
+        speech = Speech(ASR_MODEL, fast_inference=FAST_INFERENCE)
+    text = (await speech.get_text_batch([waveform]))[0]
+
+    return window_speaker.name if window_speaker else None, text
 
 
 if __name__ == '__main__':
@@ -220,4 +746,24 @@ if __name__ == '__main__':
         from asyncio import WindowsSelectorEventLoopPolicy
 
         asyncio.set_event_loop_policy(WindowsSelectorEventLoopPolicy())
-    asyncio.run(server())
+    parser = argparse.ArgumentParser(description="Transcribes meetings and recognizes their speakers")
+    parser.add_argument("--mode", default=SERVER_MODE, choices=["local", "broker", "worker"],
+                        help="Run the jobs here, distribute them to workers, or be one of those workers")
+    parser.add_argument("--broker-address", default=BROKER_ADDRESS, help="The address of the broker, in worker mode")
+    parser.add_argument("--capacity", type=int, default=WORKER_CAPACITY,
+                        help="Number of jobs the broker sends at the same time, in worker mode. They run one after "
+                             "the other, the next ones are received while one is running.")
+    parser.add_argument("--threads", type=int, default=TORCH_THREADS_PER_WORKER,
+                        help="Threads that torch uses, in worker mode. By default the cores are split between "
+                             "NUM_WORKERS workers on the host.")
+    args = parser.parse_args()
+    SERVER_MODE = args.mode
+    TORCH_THREADS_PER_WORKER = args.threads
+
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
+    if SERVER_MODE == "worker":
+        # The worker only registers with the broker once its models are loaded
+        init_worker()
+        asyncio.run(Worker(args.broker_address, handle_broker_job, capacity=args.capacity).run())
+    else:
+        asyncio.run(server())
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+import main
+from AudioProcessing.Decoding import MODEL_SAMPLE_RATE
+from Benchmark.StubModels import StubSpeakerRecognition, StubSpeechRecognition, STUB_EMBEDDING_SIZE
+from Benchmark.Synthetic import generate_voices, generate_meeting
+from Distributed.Broker import Broker, BrokerJob, WorkerState, MAX_JOB_ATTEMPTS
+from Distributed.Worker import Worker
+
+# Seconds between heartbeats in these tests, so a dead worker is noticed quickly
+TEST_HEARTBEAT_INTERVAL = 0.1
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_until(condition, timeout=10.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline:
+            raise TimeoutError("Condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+class TestBroker(unittest.IsolatedAsyncioTestCase):
+    """
+    Runs a broker and two workers in this process, connected over localhost like the processes on a single host
+    """
+
+    async def asyncSetUp(self):
+        # Patched here rather than on the class, the broker starts heartbeating before the test runs
+        for module in ("Distributed.Broker", "Distributed.Worker"):
+            patcher = mock.patch(f"{module}.HEARTBEAT_INTERVAL", TEST_HEARTBEAT_INTERVAL)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        working_directory = os.getcwd()
+        # The workers save their segments in the audio cache, which is relative to the working directory
+        os.chdir(self.directory.name)
+        self.addCleanup(os.chdir, working_directory)
+
+        main.speaker, main.speech = StubSpeakerRecognition(), StubSpeechRecognition()
+        self.address = f"tcp://127.0.0.1:{get_free_port()}"
+        self.broker = Broker(self.address, speakers_directory="broker-speakers")
+        await self.broker.start()
+        self.worker_tasks: list[asyncio.Task] = []
+        self.workers: list[Worker] = []
+
+    async def asyncTearDown(self):
+        for worker, task in zip(self.workers, self.worker_tasks):
+            self.stop_worker(worker, task)
+            worker.context.term()
+        self.broker.close()
+
+    def start_worker(self, handle_job, name: str) -> tuple[Worker, asyncio.Task]:
+        worker = Worker(self.address, handle_job, speakers_directory=f"{name}-speakers")
+        worker.worker_id = name
+        task = asyncio.create_task(worker.run())
+        self.workers.append(worker)
+        self.worker_tasks.append(task)
+        return worker, task
+
+    @staticmethod
+    def stop_worker(worker: Worker, task: asyncio.Task):
+        # Like a worker process that is killed, it stops heartbeating and never answers its jobs
+        task.cancel()
+        for job_task in worker.tasks:
+            job_task.cancel()
+        if worker.socket is not None:
+            worker.socket.close(linger=0)
+
+    async def test_requeue_after_worker_dies(self):
+        meeting, _ = generate_meeting(10, generate_voices(2), seed=0)
+        meeting_file = await main.save_audio(meeting, audio_id="meeting", sample_rate=MODEL_SAMPLE_RATE)
+        with open(meeting_file, "rb") as f:
+            payload = f.read()
+
+        # The first worker hangs on its job until it is killed
+        started = asyncio.Event()
+        release = threading.Event()
+        loop = asyncio.get_running_loop()
+        self.addCleanup(release.set)
+
+        async def hang(job_type: str, payload: memoryview, data: dict) -> dict:
+            loop.call_soon_threadsafe(started.set)
+            await asyncio.to_thread(release.wait)
+            return {}
+
+        # The second worker runs the job with the stub models
+        jobs_run = []
+
+        async def run(job_type: str, payload: memoryview, data: dict) -> dict:
+            jobs_run.append(job_type)
+            return await main.handle_broker_job(job_type, payload, data)
+
+        first_worker, first_task = self.start_worker(hang, "first")
+        await wait_until(lambda: len(self.broker.workers) == 1)
+        row = await self.broker.enroll("Alice", meeting_file, [1.0] * STUB_EMBEDDING_SIZE)
+
+        job = asyncio.create_task(self.broker.submit("meeting", payload, {}))
+        await asyncio.wait_for(started.wait(), 10)
+        second_worker, _ = self.start_worker(run, "second")
+        await wait_until(lambda: len(self.broker.workers) == 2)
+        self.stop_worker(first_worker, first_task)
+
+        result = await asyncio.wait_for(job, 10)
+        self.assertEqual(jobs_run, ["meeting"])
+        self.assertTrue(result["text"])
+        self.assertTrue(result["runs"])
+        self.assertEqual([worker.worker_id for worker in self.broker.workers.values()], ["second"])
+        # The speaker that was enrolled on the broker came along with the requeued job
+        second_worker.store.refresh()
+        self.assertEqual(second_worker.store.records[row]["name"], "Alice")
+
+    async def test_give_up_after_max_attempts(self):
+        worker = WorkerState(b"dead", "dead", capacity=2)
+        failed_job = BrokerJob("meeting", b"", {})
+        failed_job.attempts = MAX_JOB_ATTEMPTS
+        retried_job = BrokerJob("meeting", b"", {})
+        retried_job.attempts = MAX_JOB_ATTEMPTS - 1
+        worker.jobs = {failed_job.job_id: failed_job, retried_job.job_id: retried_job}
+        self.broker.queue.append(BrokerJob("meeting", b"", {}))
+
+        self.broker.requeue(worker)
+
+        with self.assertRaises(RuntimeError):
+            await failed_job.future
+        # The job that may be retried goes in front of the queue, it has waited the longest
+        self.assertIs(self.broker.queue[0], retried_job)
+        self.assertEqual(len(self.broker.queue), 2)
+        self.assertEqual(worker.jobs, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
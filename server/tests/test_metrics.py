@@ -0,0 +1,42 @@
+import unittest
+from Monitoring.Metrics import Metrics
+
+
+class TestRender(unittest.TestCase):
+    def render_lines(self, registry: Metrics) -> list[str]:
+        return [line for line in registry.render().splitlines() if line.startswith("meeting_server_job_seconds")]
+
+    def test_histogram_above_last_bucket(self):
+        registry = Metrics(buckets=(1, 300))
+        for value in (0.5, 0.5, 0.5, 400):
+            registry.observe("job_seconds", value, type="meeting")
+
+        self.assertEqual(self.render_lines(registry), [
+            'meeting_server_job_seconds_bucket{type="meeting",le="1"} 3',
+            'meeting_server_job_seconds_bucket{type="meeting",le="300"} 3',
+            'meeting_server_job_seconds_bucket{type="meeting",le="+Inf"} 4',
+            'meeting_server_job_seconds_sum{type="meeting"} 401.5',
+            'meeting_server_job_seconds_count{type="meeting"} 4',
+        ])
+
+    def test_histogram_merge(self):
+        worker = Metrics(buckets=(1, 300))
+        worker.observe("job_seconds", 400, type="meeting")
+        server = Metrics(buckets=(1, 300))
+        server.observe("job_seconds", 0.5, type="meeting")
+        server.merge(worker.drain())
+
+        self.assertEqual(self.render_lines(server)[2:], [
+            'meeting_server_job_seconds_bucket{type="meeting",le="+Inf"} 2',
+            'meeting_server_job_seconds_sum{type="meeting"} 400.5',
+            'meeting_server_job_seconds_count{type="meeting"} 2',
+        ])
+
+    def test_counter(self):
+        registry = Metrics()
+        registry.increment("bytes_received_total", 1024, type="meeting")
+        self.assertIn('meeting_server_bytes_received_total{type="meeting"} 1024', registry.render().splitlines())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+from Messaging.Protocol import parse_message, PROTOCOL_VERSION
+
+
+class Frame:
+    """
+    Stands in for a zmq.Frame received with copy=False
+    """
+
+    def __init__(self, data: bytes):
+        self.bytes = data
+        self.buffer = memoryview(data)
+
+
+def build_frames(audio=b"audio", **header) -> list[Frame]:
+    header = {"version": PROTOCOL_VERSION, "type": "meeting", **header}
+    return [Frame(json.dumps(header).encode("utf-8")), Frame(audio)]
+
+
+class TestParseMessage(unittest.TestCase):
+    def test_defaults(self):
+        header, audio = parse_message(build_frames(job_id="job-1"))
+        self.assertEqual(header["codec"], "wav")
+        self.assertEqual(header["sample_rate"], 16000)
+        self.assertIsNone(header["speaker"])
+        self.assertEqual(bytes(audio), b"audio")
+
+    def test_invalid_sample_rate(self):
+        for sample_rate in (0, -16000, "16000", 16000.0, True, None):
+            with self.subTest(sample_rate=sample_rate), self.assertRaises(ValueError):
+                parse_message(build_frames(sample_rate=sample_rate))
+
+    def test_invalid_speaker(self):
+        for speaker in (1, ["Alice"], {"name": "Alice"}):
+            with self.subTest(speaker=speaker), self.assertRaises(ValueError):
+                parse_message(build_frames(type="enroll", speaker=speaker))
+
+    def test_pcm_only_for_streams(self):
+        for message_type in ("meeting", "enroll"):
+            with self.subTest(type=message_type), self.assertRaises(ValueError):
+                parse_message(build_frames(type=message_type, speaker="Alice", codec="pcm"))
+        header, _ = parse_message(build_frames(type="stream", codec="pcm", job_id="session-1", sequence=0))
+        self.assertEqual(header["codec"], "pcm")
+
+    def test_streams_only_pcm(self):
+        for message_type in ("stream", "stream-end"):
+            for codec in ("wav", "flac"):
+                with self.subTest(type=message_type, codec=codec), self.assertRaises(ValueError):
+                    parse_message(build_frames(type=message_type, codec=codec, job_id="session-1", sequence=0))
+            header, _ = parse_message(build_frames(type=message_type, job_id="session-1", sequence=0))
+            self.assertEqual(header["codec"], "pcm")
+
+    def test_invalid_sequence(self):
+        for sequence in (True, -5, "1", None):
+            with self.subTest(sequence=sequence), self.assertRaises(ValueError):
+                parse_message(build_frames(type="stream", codec="pcm", job_id="session-1", sequence=sequence))
+
+
+if __name__ == '__main__':
+    unittest.main()
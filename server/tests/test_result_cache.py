@@ -0,0 +1,47 @@
+import os
+import tempfile
+import unittest
+import torch
+from Caching.ResultCache import ResultCache
+
+
+def directory_bytes(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+
+class TestDiskTier(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_shared_between_caches(self):
+        first = ResultCache("model", disk_directory=self.directory.name)
+        second = ResultCache("model", disk_directory=self.directory.name)
+        key = first.key(torch.arange(10.0))
+        first.put(key, torch.ones(4))
+
+        self.assertTrue(torch.equal(second.get(key), torch.ones(4)))
+        self.assertEqual(second.disk_hits, 1)
+        self.assertEqual(os.path.dirname(first.disk_file(key)), os.path.join(self.directory.name, key[:2]))
+
+    def test_budget_of_all_caches(self):
+        # Two workers that write to the same directory, each of them only knows what it wrote itself
+        max_disk_bytes = 256 * 20 * 1024
+        caches = [ResultCache("model", max_memory_bytes=0, disk_directory=self.directory.name,
+                              max_disk_bytes=max_disk_bytes) for _ in range(2)]
+        for i in range(3000):
+            cache = caches[i % 2]
+            cache.put(cache.key(torch.tensor([float(i)])), torch.zeros(256))
+
+        self.assertLess(directory_bytes(self.directory.name), max_disk_bytes * 1.2)
+        self.assertGreater(directory_bytes(self.directory.name), max_disk_bytes * 0.5)
+
+    def test_remove_unsharded(self):
+        with open(os.path.join(self.directory.name, "old.pt"), "wb"):
+            pass
+        ResultCache("model", disk_directory=self.directory.name)
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+import tempfile
+import unittest
+import numpy as np
+from SpeakerRecognition.SpeakerStore import SpeakerStore
+
+
+class TestMergeMany(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def test_same_name_from_two_stores(self):
+        # Two processes that both enroll Bob before either of them saw the other's row
+        first, second = SpeakerStore(self.directory.name), SpeakerStore(self.directory.name)
+        first.merge_many([({"name": "Bob", "speaker_id": "first", "audio_file": "first.wav"}, [1, 0], 2)])
+        rows = second.merge_many([({"name": "Bob", "speaker_id": "second", "audio_file": "second.wav"}, [0, 1], 2),
+                                  ({"name": "Alice", "speaker_id": "alice", "audio_file": None}, [1, 0], 1)])
+
+        self.assertEqual(rows, [0, 1])
+        store = SpeakerStore(self.directory.name)
+        store.refresh()
+        self.assertEqual(len(store), 2)
+        record = store.records[0]
+        self.assertEqual((record["name"], record["speaker_id"], record["audio_file"], record["samples"]),
+                         ("Bob", "first", "first.wav", 4))
+        np.testing.assert_allclose(store.get_embedding(0), [0.5, 0.5])
+
+    def test_same_name_in_one_batch(self):
+        store = SpeakerStore(self.directory.name)
+        rows = store.merge_many([({"name": "Bob", "speaker_id": "a", "audio_file": None}, [1, 0], 1),
+                                 ({"name": "Bob", "speaker_id": "b", "audio_file": None}, [0, 1], 3)])
+
+        self.assertEqual(rows, [0, 0])
+        self.assertEqual(store.records[0]["samples"], 4)
+        np.testing.assert_allclose(store.get_embedding(0), [0.25, 0.75])
+
+
+if __name__ == '__main__':
+    unittest.main()